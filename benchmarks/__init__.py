@@ -0,0 +1,2 @@
+from .synthetic_data import make_synthetic_data, write_synthetic_data
+from .run_benchmarks import run_benchmarks
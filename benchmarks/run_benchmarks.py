@@ -0,0 +1,285 @@
+#! /usr/bin/python
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+from datetime import datetime
+from shutil import rmtree
+
+import numpy as np
+import luigi
+
+from cluster_tools.cluster_tasks import WorkflowBase
+from cluster_tools.utils.volume_utils import file_reader
+from cluster_tools.utils.task_utils import DummyTask
+from cluster_tools.watershed import WatershedWorkflow
+from cluster_tools.graph import GraphWorkflow
+from cluster_tools.features import EdgeFeaturesWorkflow
+from cluster_tools.costs import EdgeCostsWorkflow
+from cluster_tools.multicut import MulticutWorkflow
+from cluster_tools.relabel import RelabelWorkflow
+from cluster_tools.downscaling import DownscalingWorkflow
+from cluster_tools import write as write_tasks
+
+from .synthetic_data import make_synthetic_data, write_synthetic_data
+
+
+WORKFLOWS = ('watershed', 'graph', 'features', 'multicut',
+             'relabel', 'downscaling', 'write')
+# these workflows only support n5 / zarr
+N5_WORKFLOWS = ('graph', 'features', 'multicut', 'downscaling')
+
+# hard-coded keys, consistent with `MulticutSegmentationWorkflow`
+GRAPH_KEY = 's0/graph'
+FEATURES_KEY = 'features'
+COSTS_KEY = 's0/costs'
+
+
+def _write_configs(config_dir, configs, block_shape, n_threads):
+    os.makedirs(config_dir, exist_ok=True)
+    global_config = configs.pop('global')
+    global_config.update({'shebang': '#! %s' % sys.executable,
+                          'block_shape': list(block_shape)})
+    with open(os.path.join(config_dir, 'global.config'), 'w') as f:
+        json.dump(global_config, f)
+    for name, config in configs.items():
+        # `Write` reads the number of threads from 'threads_per_core'
+        config.update({'threads_per_job': n_threads, 'threads_per_core': n_threads})
+        with open(os.path.join(config_dir, '%s.config' % name), 'w') as f:
+            json.dump(config, f)
+
+
+def _all_configs():
+    return {**WatershedWorkflow.get_config(), **GraphWorkflow.get_config(),
+            **EdgeFeaturesWorkflow.get_config(), **EdgeCostsWorkflow.get_config(),
+            **MulticutWorkflow.get_config(), **RelabelWorkflow.get_config(),
+            **DownscalingWorkflow.get_config(),
+            'write': write_tasks.WriteLocal.default_task_config()}
+
+
+def _build(task):
+    t0 = time.time()
+    success = luigi.build([task], local_scheduler=True)
+    return success, time.time() - t0
+
+
+def _n_edges(problem_path):
+    with file_reader(problem_path, 'r') as f:
+        return int(f[GRAPH_KEY].attrs['numberOfEdges'])
+
+
+class BenchmarkCase(object):
+    """ Run the workflows of one benchmark case (block shape and number of threads)
+    in a separate folder, so that luigi does not consider them complete already.
+    """
+    def __init__(self, data_path, folder, block_shape, n_threads, max_jobs, target):
+        self.data_path = data_path
+        self.folder = folder
+        self.block_shape = block_shape
+        self.n_threads = n_threads
+        self.max_jobs = max_jobs
+        self.target = target
+        self.config_dir = os.path.join(folder, 'configs')
+        self.problem_path = os.path.join(folder, 'problem.n5')
+        _write_configs(self.config_dir, _all_configs(), block_shape, n_threads)
+        with file_reader(data_path, 'r') as f:
+            self.shape = f['boundaries'].shape
+        self.n_voxels = int(np.prod(self.shape))
+
+    def _kwargs(self, name):
+        return dict(tmp_folder=os.path.join(self.folder, 'tmp_%s' % name),
+                    max_jobs=self.max_jobs, config_dir=self.config_dir,
+                    target=self.target)
+
+    def _graph_task(self, name):
+        return GraphWorkflow(input_path=self.data_path, input_key='oversegmentation',
+                             graph_path=self.problem_path, output_key=GRAPH_KEY,
+                             n_scales=1, **self._kwargs(name))
+
+    def _features_task(self, name, dependency=DummyTask()):
+        return EdgeFeaturesWorkflow(input_path=self.data_path, input_key='boundaries',
+                                    labels_path=self.data_path, labels_key='oversegmentation',
+                                    graph_path=self.problem_path, graph_key=GRAPH_KEY,
+                                    output_path=self.problem_path, output_key=FEATURES_KEY,
+                                    dependency=dependency, **self._kwargs(name))
+
+    def _prepare(self, *tasks):
+        """ Run the dependencies of a benchmark without timing them.
+        """
+        for task in tasks:
+            success, _ = _build(task)
+            if not success:
+                raise RuntimeError("Preparing the benchmark failed")
+
+    def _copy_labels(self, key):
+        with file_reader(self.data_path) as f:
+            ds_in = f['oversegmentation']
+            ds = f.require_dataset(key, shape=ds_in.shape, chunks=ds_in.chunks,
+                                   dtype='uint64', compression='gzip')
+            ds[:] = ds_in[:]
+
+    def watershed(self):
+        key = 'watershed_%s' % os.path.split(self.folder)[1]
+        task = WatershedWorkflow(input_path=self.data_path, input_key='boundaries',
+                                 output_path=self.data_path, output_key=key,
+                                 **self._kwargs('watershed'))
+        return task, {}
+
+    def graph(self):
+        return self._graph_task('graph'), {'n_edges': lambda: _n_edges(self.problem_path)}
+
+    def features(self):
+        self._prepare(self._graph_task('graph_prep'))
+        task = self._features_task('features')
+        return task, {'n_edges': lambda: _n_edges(self.problem_path)}
+
+    def multicut(self):
+        dep = self._features_task('features_prep', self._graph_task('graph_prep'))
+        dep = EdgeCostsWorkflow(features_path=self.problem_path, features_key=FEATURES_KEY,
+                                output_path=self.problem_path, output_key=COSTS_KEY,
+                                dependency=dep, **self._kwargs('costs_prep'))
+        self._prepare(dep)
+        task = MulticutWorkflow(problem_path=self.problem_path, n_scales=1,
+                                assignment_path=self.problem_path, assignment_key='node_labels',
+                                **self._kwargs('multicut'))
+        return task, {'n_edges': lambda: _n_edges(self.problem_path)}
+
+    def relabel(self):
+        # relabeling works in-place, so we run it on a copy
+        key = 'relabel_%s' % os.path.split(self.folder)[1]
+        self._copy_labels(key)
+        task = RelabelWorkflow(input_path=self.data_path, input_key=key,
+                               **self._kwargs('relabel'))
+        return task, {}
+
+    def downscaling(self):
+        prefix = 'downscaled_%s' % os.path.split(self.folder)[1]
+        task = DownscalingWorkflow(input_path=self.data_path, input_key='boundaries',
+                                   scale_factors=[[1, 2, 2], 2], halos=[[0, 0, 0], [0, 0, 0]],
+                                   output_key_prefix=prefix,
+                                   **self._kwargs('downscaling'))
+        return task, {}
+
+    def write(self):
+        # map the over-segmentation to the ground-truth
+        with file_reader(self.data_path, 'r') as f:
+            overseg = f['oversegmentation'][:]
+            gt = f['groundtruth'][:]
+        assignments = np.zeros(int(overseg.max()) + 1, dtype='uint64')
+        assignments[overseg] = gt
+        assignment_path = os.path.join(self.folder, 'assignments.n5')
+        with file_reader(assignment_path) as f:
+            ds = f.require_dataset('assignments', shape=assignments.shape,
+                                   chunks=assignments.shape, dtype='uint64')
+            ds[:] = assignments
+
+        kwargs = self._kwargs('write')
+        kwargs.pop('target')
+        write_task = getattr(write_tasks,
+                             'Write%s' % WorkflowBase._target_dict[self.target.lower()])
+        key = 'write_%s' % os.path.split(self.folder)[1]
+        task = write_task(input_path=self.data_path, input_key='oversegmentation',
+                          output_path=self.data_path, output_key=key,
+                          assignment_path=assignment_path, assignment_key='assignments',
+                          identifier='benchmark', dependency=DummyTask(),
+                          **kwargs)
+        return task, {}
+
+    def run(self, name):
+        task, counters = getattr(self, name)()
+        success, runtime = _build(task)
+        result = {'workflow': name, 'block_shape': list(self.block_shape),
+                  'n_threads': self.n_threads, 'max_jobs': self.max_jobs,
+                  'shape': list(self.shape), 'success': success, 'runtime': runtime,
+                  'voxels_per_second': self.n_voxels / runtime}
+        if success and 'n_edges' in counters:
+            n_edges = counters['n_edges']()
+            result.update({'n_edges': n_edges, 'edges_per_second': n_edges / runtime})
+        return result
+
+
+def run_benchmarks(data_path, folder, workflows, block_shapes, threads,
+                   max_jobs=1, target='local'):
+    """ Run the benchmarks for all combinations of block shapes and threads.
+
+    Returns a list with one result per workflow and combination, with the runtime
+    and the throughput in voxels / s (and edges / s for the graph based workflows).
+    """
+    is_n5 = data_path.split('.')[-1].lower() in ('n5', 'zr', 'zarr')
+    results = []
+    for block_shape in block_shapes:
+        for n_threads in threads:
+            case_folder = os.path.join(folder, 'bs%s_t%i' % ('x'.join(map(str, block_shape)),
+                                                             n_threads))
+            case = BenchmarkCase(data_path, case_folder, block_shape, n_threads,
+                                 max_jobs, target)
+            for name in workflows:
+                if name in N5_WORKFLOWS and not is_n5:
+                    print("Skipping %s, it needs n5 input" % name)
+                    continue
+                print("Running %s with block shape %s and %i threads" % (name, str(block_shape),
+                                                                           n_threads))
+                results.append(case.run(name))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the workflows on synthetic data")
+    parser.add_argument('--shape', type=int, nargs=3, default=[64, 512, 512])
+    parser.add_argument('--block_shapes', type=str, nargs='+', default=['32,256,256'],
+                        help="block shapes to benchmark, given as comma separated values")
+    parser.add_argument('--threads', type=int, nargs='+', default=[1],
+                        help="threads per job to benchmark")
+    parser.add_argument('--workflows', type=str, nargs='+', default=list(WORKFLOWS),
+                        choices=WORKFLOWS)
+    parser.add_argument('--max_jobs', type=int, default=1)
+    parser.add_argument('--target', type=str, default='local')
+    parser.add_argument('--format', type=str, default='n5', choices=('n5', 'h5'))
+    parser.add_argument('--in_memory', action='store_true',
+                        help="keep data and tmp folders in shared memory (/dev/shm)")
+    parser.add_argument('--folder', type=str, default=None,
+                        help="folder in which the folder for this run is created, "
+                             "default: system temporary directory")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', type=str, default='benchmark_results.json')
+    parser.add_argument('--keep', action='store_true', help="keep the folder of this run")
+    args = parser.parse_args()
+
+    # we always run in a new folder, so that we only delete what this run has created
+    if args.folder is None:
+        parent = '/dev/shm' if args.in_memory else None
+    else:
+        parent = args.folder
+        os.makedirs(parent, exist_ok=True)
+    folder = tempfile.mkdtemp(prefix='cluster_tools_benchmark_', dir=parent)
+
+    block_shapes = [[int(bs) for bs in block_shape.split(',')]
+                    for block_shape in args.block_shapes]
+    try:
+        t0 = time.time()
+        data = make_synthetic_data(args.shape, seed=args.seed)
+        data_path = write_synthetic_data(os.path.join(folder, 'data.%s' % args.format),
+                                         data, chunks=[bs // 2 for bs in block_shapes[0]])
+        print("Made synthetic data in %f s" % (time.time() - t0,))
+        del data
+
+        results = run_benchmarks(data_path, folder, args.workflows, block_shapes,
+                                 args.threads, args.max_jobs, args.target)
+    finally:
+        if args.keep:
+            print("Kept data and tmp folders in %s" % folder)
+        else:
+            rmtree(folder)
+
+    with open(args.output, 'w') as f:
+        json.dump({'date': str(datetime.now()), 'shape': args.shape,
+                   'format': args.format, 'in_memory': args.in_memory,
+                   'results': results}, f, indent=2)
+    print("Written results to %s" % args.output)
+
+
+if __name__ == '__main__':
+    main()
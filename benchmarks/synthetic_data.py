@@ -0,0 +1,101 @@
+import numpy as np
+
+
+def _nearest_seeds(coords, seeds, cell_size, grid_shape):
+    """ Find the nearest and second nearest seed of a jittered seed grid for the coordinates.
+
+    Each grid cell holds one seed, so the two nearest seeds of a voxel
+    are in its own cell or in one of the adjacent cells.
+    """
+    cell = (coords // cell_size).astype('int64')
+    best = np.full((2, len(coords)), np.inf)
+    best_id = np.zeros(len(coords), dtype='uint64')
+    offsets = np.stack(np.meshgrid(*([[-1, 0, 1]] * 3), indexing='ij'), axis=-1).reshape(-1, 3)
+    for off in offsets:
+        neighbor = cell + off
+        valid = np.all((neighbor >= 0) & (neighbor < grid_shape), axis=1)
+        neighbor = np.clip(neighbor, 0, np.array(grid_shape) - 1)
+        seed_id = np.ravel_multi_index(tuple(neighbor.T), grid_shape)
+        dist = np.sum((coords - seeds[seed_id]) ** 2, axis=1)
+        dist[~valid] = np.inf
+
+        closer = dist < best[0]
+        second = ~closer & (dist < best[1])
+        best[1] = np.where(closer, best[0], np.where(second, dist, best[1]))
+        best[0] = np.where(closer, dist, best[0])
+        best_id[closer] = seed_id[closer]
+    return best_id, np.sqrt(best[0]), np.sqrt(best[1])
+
+
+def voronoi_volume(shape, cell_size, seed=None, return_distances=False):
+    """ Make a volume of voronoi cells with one seed per cell of a jittered grid.
+
+    Arguments:
+        shape [tuple] - shape of the volume
+        cell_size [tuple] - size of the grid cells, i.e. the average size of the segments
+        seed [int] - random seed
+        return_distances [bool] - return the distance to the closest cell boundary (default: False)
+    """
+    rng = np.random.RandomState(seed)
+    cell_size = np.array(cell_size, dtype='float64')
+    grid_shape = tuple(int(np.ceil(sh / cs)) for sh, cs in zip(shape, cell_size))
+    grid = np.stack(np.meshgrid(*[np.arange(gs) for gs in grid_shape], indexing='ij'), axis=-1)
+    seeds = (grid.reshape(-1, 3) + rng.uniform(size=(int(np.prod(grid_shape)), 3))) * cell_size
+
+    labels = np.zeros(shape, dtype='uint64')
+    distances = np.zeros(shape, dtype='float32') if return_distances else None
+    # process the volume slice by slice to bound the memory
+    plane = np.stack(np.meshgrid(np.arange(shape[1]), np.arange(shape[2]), indexing='ij'),
+                     axis=-1).reshape(-1, 2)
+    for z in range(shape[0]):
+        coords = np.concatenate([np.full((len(plane), 1), z), plane], axis=1).astype('float64')
+        seed_id, d1, d2 = _nearest_seeds(coords, seeds, cell_size, grid_shape)
+        labels[z] = (seed_id + 1).reshape(shape[1:])
+        if return_distances:
+            # approximates the distance to the boundary between the two closest cells
+            distances[z] = ((d2 - d1) / 2).reshape(shape[1:])
+    return (labels, distances) if return_distances else labels
+
+
+def make_synthetic_data(shape, cell_size=(8, 32, 32), overseg_factor=2,
+                        sigma=1., noise=0.05, seed=None):
+    """ Make a synthetic boundary map with matching ground-truth and over-segmentation.
+
+    Arguments:
+        shape [tuple] - shape of the volumes
+        cell_size [tuple] - average size of the ground-truth segments
+        overseg_factor [int] - factor by which the over-segmentation splits the segments per axis
+        sigma [float] - width of the boundaries
+        noise [float] - standard deviation of the gaussian noise added to the boundaries
+        seed [int] - random seed
+    """
+    rng = np.random.RandomState(seed)
+    groundtruth, distances = voronoi_volume(shape, cell_size, seed=rng.randint(2 ** 31),
+                                            return_distances=True)
+    boundaries = np.exp(-distances ** 2 / (2 * sigma ** 2))
+    boundaries += rng.normal(scale=noise, size=shape).astype('float32')
+    boundaries = np.clip(boundaries, 0, 1).astype('float32')
+
+    # split the ground-truth segments with a finer voronoi tesselation
+    fine_size = tuple(max(cs // overseg_factor, 1) for cs in cell_size)
+    fine = voronoi_volume(shape, fine_size, seed=rng.randint(2 ** 31))
+    _, overseg = np.unique(groundtruth * (int(fine.max()) + 1) + fine, return_inverse=True)
+    overseg = (overseg.reshape(shape) + 1).astype('uint64')
+
+    return {'boundaries': boundaries, 'groundtruth': groundtruth,
+            'oversegmentation': overseg}
+
+
+def write_synthetic_data(path, data, chunks):
+    """ Write synthetic data to n5 or hdf5, see `make_synthetic_data`.
+    """
+    from cluster_tools.utils.volume_utils import file_reader
+    with file_reader(path) as f:
+        for key, vol in data.items():
+            ds = f.require_dataset(key, shape=vol.shape, dtype=vol.dtype,
+                                   chunks=tuple(min(ch, sh) for ch, sh in zip(chunks, vol.shape)),
+                                   compression='gzip')
+            ds[:] = vol
+            if vol.dtype == np.dtype('uint64'):
+                ds.attrs['maxId'] = int(vol.max())
+    return path
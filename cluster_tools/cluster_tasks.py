@@ -1,18 +1,24 @@
 import os
+import re
+import sys
 import shutil
 import stat
 import json
 import time
+import atexit
 import fileinput
+import importlib
+import traceback
 from concurrent import futures
-from subprocess import call, check_output, CalledProcessError
+from contextlib import redirect_stdout, redirect_stderr
+from subprocess import call, check_output, run, CalledProcessError, PIPE
 from datetime import datetime, timedelta
 
 import numpy as np
 import luigi
 
-from .utils.parse_utils import parse_blocks_task, parse_jobs_task
-from .utils.task_utils import DummyTask
+from .utils.parse_utils import parse_blocks, parse_blocks_task, parse_jobs_task, parse_job
+from .utils.task_utils import DummyTask, partition_blocks_by_cost
 
 
 class FailedJobsError(Exception):
@@ -66,6 +72,9 @@ class BaseClusterTask(luigi.Task):
     allow_retry = True
     # number of retries already done
     n_retries = 0
+    # allow jobs to pull blocks from a shared queue, set to true in deriving class
+    # if the job function iterates over `fu.blocks_to_process`
+    allow_block_queue = False
 
     #
     # API
@@ -145,15 +154,21 @@ class BaseClusterTask(luigi.Task):
         """
         job_name = self.task_name if job_prefix is None else '%s_%s' % (self.task_name,
                                                                         job_prefix)
+        log_prefix = os.path.join(self.tmp_folder, 'logs', '%s_' % job_name)
         # for the jobs that have completely passed, we can add the block list from the config
         passed_blocks = []
-        for job_id in passed_blokcs:
+        for job_id in passed_jobs:
             config_path = self._config_path(job_id, job_prefix)
             with open(config_path, 'r') as f:
-                passed_blocks.extend(json.load(f)['block_list'])
+                job_config = json.load(f)
+            # if the jobs pulled blocks from a queue, a passed job may not have
+            # processed all the blocks in its block list, but others instead
+            if 'block_queue' in job_config:
+                passed_blocks.extend(parse_blocks(log_prefix + '%i.log' % job_id))
+            else:
+                passed_blocks.extend(job_config['block_list'])
 
         # for the failed jobs, we parse the output logs
-        log_prefix = os.path.join(self.tmp_folder, 'logs', '%s_' % job_name)
         passed_blocks.extend(parse_blocks_task(log_prefix, n_jobs, passed_jobs))
 
         # return the list of failed blocks
@@ -210,7 +225,15 @@ class BaseClusterTask(luigi.Task):
                 "roi_end": None,
                 "groupname": "kreshuk",
                 "max_num_retries": 0,
-                "block_list_path": None}
+                "block_list_path": None,
+                "local_executor": "subprocess",
+                "max_local_workers": None,
+                "min_poll_interval": 2,
+                "max_poll_interval": 60,
+                "max_array_size": 1000,
+                "max_concurrent_array_tasks": None,
+                "block_queue": False,
+                "instrumentation": True}
 
     def global_config_values(self, with_block_list_path=False):
         """ Load the global config values that are needed
@@ -240,7 +263,8 @@ class BaseClusterTask(luigi.Task):
     # Must implement API
     #
 
-    def prepare_jobs(self, n_jobs, block_list, config, job_prefix=None, consecutive_blocks=False):
+    def prepare_jobs(self, n_jobs, block_list, config, job_prefix=None, consecutive_blocks=False,
+                     block_costs=None):
         raise NotImplementedError("BaseClusterTask does not implement this functionality")
 
     def submit_jobs(self, n_jobs, job_prefix=None):
@@ -277,6 +301,7 @@ class BaseClusterTask(luigi.Task):
         mkdir(self.tmp_folder)
         mkdir(os.path.join(self.tmp_folder, 'logs'))
         mkdir(os.path.join(self.tmp_folder, 'error_logs'))
+        mkdir(os.path.join(self.tmp_folder, 'instrumentation'))
         self._write_log('created tmp-folder and log dirs @ %s' % self.tmp_folder)
 
     def _write_single_job_config(self, config, job_prefix):
@@ -285,10 +310,18 @@ class BaseClusterTask(luigi.Task):
             json.dump(config, f)
 
     def _write_multiple_job_configs(self, n_jobs, block_list, config, job_prefix,
-                                    consecutive_blocks):
-
+                                    consecutive_blocks, block_costs=None):
+
+        # if we have costs for the blocks, balance the total cost per job
+        if block_costs is not None:
+            prepartiion = partition_blocks_by_cost(block_list, block_costs, n_jobs,
+                                                   consecutive=consecutive_blocks)
+            costs_per_job = [sum(block_costs.get(block_id, 0) for block_id in blocks)
+                             for blocks in prepartiion]
+            self._write_log("partitioned blocks by cost, max / mean cost per job: %f / %f" % (max(costs_per_job),
+                                                                                              np.mean(costs_per_job)))
         # TODO there must be a more elegant way of doing this
-        if consecutive_blocks:
+        elif consecutive_blocks:
             # distribute blocks to jobs as equal as possible
             blocks_per_job = np.zeros(n_jobs, dtype='uint32')
             block_count = len(block_list)
@@ -307,22 +340,73 @@ class BaseClusterTask(luigi.Task):
                 prepartiion.append(list(range(block_id, block_id + bpj)))
                 block_id += bpj
 
+        # check if the jobs pull their blocks from a shared queue
+        use_queue = self.allow_block_queue and self.get_global_config().get('block_queue', False)
+        if use_queue:
+            queue_folder = self._make_block_queue(block_list, job_prefix)
+            config = {**config, 'block_queue': queue_folder}
+
+        # check if the jobs record per-block timings, see `function_utils.instrument_block`
+        instrument = self.get_global_config().get('instrumentation', True)
+
         # write the configurations for all jobs to the tmp folder
         for job_id in range(n_jobs):
             # if `consecutive_blocks` is true, we keep the block_ids in
             # block_jobs consecutive
-            if consecutive_blocks:
+            if consecutive_blocks or block_costs is not None:
                 block_jobs = prepartiion[job_id]
             else:
                 block_jobs = block_list[job_id::n_jobs]
             job_config = {'block_list': block_jobs, **config}
+            if instrument:
+                instrumentation_path = self._instrumentation_path(job_id, job_prefix)
+                # the records of a retry are appended, but a new run starts from scratch
+                if self.n_retries == 0 and os.path.exists(instrumentation_path):
+                    os.remove(instrumentation_path)
+                job_config['instrumentation_path'] = instrumentation_path
             config_path = self._config_path(job_id, job_prefix)
             with open(config_path, 'w') as f:
                 json.dump(job_config, f)
 
+    def _make_block_queue(self, block_list, job_prefix):
+        """ Make the file-system backed block queue for the jobs of this task.
+
+        There is one file per block in 'queue'; jobs claim a block by atomically
+        renaming its file to 'claimed', see `function_utils.blocks_to_process`.
+        """
+        job_name = self.task_name if job_prefix is None else '%s_%s' % (self.task_name,
+                                                                        job_prefix)
+        queue_folder = os.path.join(self.tmp_folder, '%s_block_queue' % job_name)
+        # clean up the queue of a previous try
+        if os.path.exists(queue_folder):
+            shutil.rmtree(queue_folder)
+        os.makedirs(os.path.join(queue_folder, 'queue'))
+        os.makedirs(os.path.join(queue_folder, 'claimed'))
+        for block_id in block_list:
+            open(os.path.join(queue_folder, 'queue', str(block_id)), 'w').close()
+        self._write_log("made block queue with %i blocks @ %s" % (len(block_list), queue_folder))
+        return queue_folder
+
+    def _load_block_costs(self):
+        """ Load the per-block costs from `block_costs_path` in the task config, if given.
+
+        The costs are stored as json mapping block ids to costs, e.g. the block runtimes of
+        a previous run (see `parse_utils.parse_block_runtimes_task`) or the mask occupancy
+        (see `volume_utils.block_costs_from_volume`).
+        """
+        block_costs_path = self.get_task_config().get('block_costs_path', None)
+        if block_costs_path is None:
+            return None
+        self._write_log("reading block costs from %s" % block_costs_path)
+        with open(block_costs_path) as f:
+            block_costs = json.load(f)
+        # json keys are always strings
+        return {int(block_id): cost for block_id, cost in block_costs.items()}
+
     # TODO allow config for individual blocks
     def _write_job_config(self, n_jobs, block_list, config,
-                          job_prefix=None, consecutive_blocks=False):
+                          job_prefix=None, consecutive_blocks=False,
+                          block_costs=None):
         # check f we have a reduce style block, that is
         # not distributed over blocks
         if block_list is None:
@@ -333,10 +417,104 @@ class BaseClusterTask(luigi.Task):
             # we add the block list to this class to know all the blocks
             # that were scheduled if we need to rerun this task
             self.block_list = block_list
+            if block_costs is None:
+                block_costs = self._load_block_costs()
             self._write_multiple_job_configs(n_jobs, block_list, config,
-                                             job_prefix, consecutive_blocks)
+                                             job_prefix, consecutive_blocks,
+                                             block_costs)
         self._write_log('written config for %i jobs' % n_jobs)
 
+    def _register_submitted_jobs(self, scheduler_ids, job_prefix):
+        """ Remember the scheduler ids of submitted jobs.
+
+        `scheduler_ids` maps the id returned by the scheduler to the job id.
+        """
+        if not hasattr(self, '_submitted_jobs'):
+            self._submitted_jobs = {}
+        self._submitted_jobs.setdefault(job_prefix, {}).update(scheduler_ids)
+        self._write_log("submitted %i jobs with scheduler ids %s" % (len(scheduler_ids),
+                                                                   ', '.join(scheduler_ids)))
+
+    def _log_path(self, job_id, job_prefix=None):
+        job_name = self.task_name if job_prefix is None else '%s_%s' % (self.task_name,
+                                                                        job_prefix)
+        return os.path.join(self.tmp_folder, 'logs', '%s_%i.log' % (job_name, job_id))
+
+    def _instrumentation_path(self, job_id, job_prefix=None):
+        job_name = self.task_name if job_prefix is None else '%s_%s' % (self.task_name,
+                                                                        job_prefix)
+        return os.path.join(self.tmp_folder, 'instrumentation', '%s_%i.jsonl' % (job_name, job_id))
+
+    def _wait_for_submitted_jobs(self, job_prefix, query_active_jobs):
+        """ Wait until all jobs submitted by this task have left the scheduler.
+
+        Only the jobs registered via `_register_submitted_jobs` are tracked,
+        jobs of other tasks or workflows of the same user are ignored.
+        `query_active_jobs` receives a list of scheduler ids and returns the subset
+        of ids that are still queued or running, or None if the query failed.
+        Failed jobs are reported as soon as they leave the queue.
+        """
+        submitted = getattr(self, '_submitted_jobs', {})
+        # some tasks submit with a prefix, but wait without it;
+        # in this case we wait for all jobs this task has submitted
+        prefixes = [job_prefix] if job_prefix in submitted else list(submitted.keys())
+        pending = {scheduler_id: (prefix, job_id)
+                   for prefix in prefixes
+                   for scheduler_id, job_id in submitted.pop(prefix).items()}
+
+        config = self.get_global_config()
+        min_wait_time = config.get('min_poll_interval', 2)
+        max_wait_time = config.get('max_poll_interval', 60)
+        wait_time = min_wait_time
+
+        n_failed = 0
+        while pending:
+            time.sleep(wait_time)
+            active = query_active_jobs(list(pending.keys()))
+            if active is None:
+                self._write_log("querying the scheduler failed, will try again")
+                wait_time = min(2 * wait_time, max_wait_time)
+                continue
+
+            finished = [scheduler_id for scheduler_id in pending if scheduler_id not in active]
+            for scheduler_id in finished:
+                prefix, job_id = pending.pop(scheduler_id)
+                if not parse_job(self._log_path(job_id, prefix), job_id):
+                    n_failed += 1
+                    self._write_log("job %i (scheduler id %s) failed, %i jobs are still running" % (job_id,
+                                                                                                   scheduler_id,
+                                                                                                   len(pending)))
+            # poll fast while jobs are finishing, back off otherwise
+            wait_time = min_wait_time if finished else min(2 * wait_time, max_wait_time)
+
+        if n_failed > 0:
+            self._write_log("%i jobs failed" % n_failed)
+
+    def _array_chunks(self, n_jobs):
+        """ Split the job ids into chunks that fit into one array job.
+
+        Returns a list of (job id offset, number of array tasks).
+        Schedulers limit the size of array jobs (e.g. `MaxArraySize` for slurm),
+        so we may need to submit more than one array for many jobs.
+        """
+        max_array_size = self.get_global_config().get('max_array_size', 1000)
+        return [(offset, min(max_array_size, n_jobs - offset))
+                for offset in range(0, n_jobs, max_array_size)]
+
+    def _array_job_command(self, job_prefix, job_id_expr):
+        """ Shell command that runs the job whose id is given by the shell expression
+        `job_id_expr` and writes to the usual log and error log.
+        """
+        job_name = self.task_name if job_prefix is None else '%s_%s' % (self.task_name,
+                                                                        job_prefix)
+        trgt_file = os.path.join(self.tmp_folder, self.task_name + '.py')
+        config_file = self._config_path('${job_id}', job_prefix)
+        log_file = os.path.join(self.tmp_folder, 'logs', '%s_${job_id}.log' % job_name)
+        err_file = os.path.join(self.tmp_folder, 'error_logs', '%s_${job_id}.err' % job_name)
+        return ("job_id=$((%s))\n"
+                "%s %s > %s 2> %s\n") % (job_id_expr, trgt_file, config_file,
+                                          log_file, err_file)
+
     # copy the python script to the temp folder and replace the shebang
     def _write_script_file(self, shebang):
         assert os.path.exists(self.src_file), self.src_file
@@ -392,11 +570,9 @@ class SlurmTask(BaseClusterTask):
         mem_limit = self._parse_mem_limit(task_config.get("mem_limit", 2))
         qos = task_config.get("qos", "normal")
 
-        # get file paths
-        trgt_file = os.path.join(self.tmp_folder, self.task_name + '.py')
-        config_tmpl = self._config_path('$1', job_prefix)
+        # the job id is given by the array index, offset by
+        # JOB_ID_OFFSET if we need more than one array job
         job_name = self.task_name if job_prefix is None else '%s_%s' % (self.task_name, job_prefix)
-        # TODO set the job-name so that we can parse the squeue output properly
         slurm_template = ("#!/bin/bash\n"
                           "#SBATCH -A %s\n"
                           "#SBATCH -N 1\n"
@@ -404,17 +580,19 @@ class SlurmTask(BaseClusterTask):
                           "#SBATCH --mem %s\n"
                           "#SBATCH -t %s\n"
                           "#SBATCH --qos=%s\n"
-                          "%s %s") % (groupname, n_threads,
-                                      mem_limit, time_limit, qos,
-                                      trgt_file, config_tmpl)
+                          "%s") % (groupname, n_threads,
+                                   mem_limit, time_limit, qos,
+                                   self._array_job_command(job_prefix,
+                                                           'SLURM_ARRAY_TASK_ID + JOB_ID_OFFSET'))
         script_path = os.path.join(self.tmp_folder, 'slurm_%s.sh' % job_name)
         with open(script_path, 'w') as f:
             f.write(slurm_template)
 
     def prepare_jobs(self, n_jobs, block_list, config,
-                     job_prefix=None, consecutive_blocks=False):
+                     job_prefix=None, consecutive_blocks=False, block_costs=None):
         # write the job configs
-        self._write_job_config(n_jobs, block_list, config, job_prefix, consecutive_blocks)
+        self._write_job_config(n_jobs, block_list, config, job_prefix,
+                               consecutive_blocks, block_costs)
         # write the slurm script file
         self._write_slurm_file(job_prefix)
 
@@ -422,26 +600,98 @@ class SlurmTask(BaseClusterTask):
         job_name = self.task_name if job_prefix is None else '%s_%s' % (self.task_name,
                                                                         job_prefix)
         script_path = os.path.join(self.tmp_folder, 'slurm_%s.sh' % job_name)
-        for job_id in range(n_jobs):
-            out_file = os.path.join(self.tmp_folder, 'logs', '%s_%i.log' % (job_name, job_id))
-            err_file = os.path.join(self.tmp_folder, 'error_logs', '%s_%i.err' % (job_name,
-                                                                                  job_id))
-            call(['sbatch', '-o', out_file, '-e', err_file,
-                  '-J', '%s_%i' % (job_name, job_id),
-                  script_path, str(job_id)])
+        # output of slurm itself, e.g. messages about jobs that were killed
+        out_file = os.path.join(self.tmp_folder, 'error_logs', '%s_slurm_%%A_%%a.out' % job_name)
+        max_concurrent = self.get_global_config().get('max_concurrent_array_tasks', None)
+
+        scheduler_ids = {}
+        for offset, n_tasks in self._array_chunks(n_jobs):
+            array = '0-%i' % (n_tasks - 1,)
+            if max_concurrent is not None:
+                array += '%%%i' % max_concurrent
+            out = check_output(['sbatch', '--parsable', '--array=%s' % array,
+                                '--export=ALL,JOB_ID_OFFSET=%i' % offset,
+                                '-o', out_file, '-J', job_name,
+                                script_path]).decode()
+            array_id = self._parse_job_id(out)
+            scheduler_ids.update({'%s_%i' % (array_id, index): offset + index
+                                  for index in range(n_tasks)})
+        self._register_submitted_jobs(scheduler_ids, job_prefix)
+
+    @staticmethod
+    def _parse_job_id(sbatch_output):
+        """ Parse the job id from the output of `sbatch --parsable`,
+        which is either 'job_id' or 'job_id;cluster_name'.
+        """
+        return sbatch_output.strip().split('\n')[-1].split(';')[0]
+
+    @staticmethod
+    def _query_active_jobs(scheduler_ids, batch_size=500):
+        """ Return the ids of jobs that are still known to squeue.
+
+        Array tasks are identified by 'array_id'_'index', we query the array ids
+        and let squeue list the array tasks individually (`-r`).
+        """
+        query_ids = sorted(set(scheduler_id.split('_')[0] for scheduler_id in scheduler_ids))
+        active = set()
+        for batch_start in range(0, len(query_ids), batch_size):
+            batch = query_ids[batch_start:batch_start + batch_size]
+            res = run(['squeue', '-h', '-r', '-o', '%i', '-j', ','.join(batch)],
+                      stdout=PIPE, stderr=PIPE)
+            # squeue fails if none of the jobs is known anymore;
+            # any other error means that we could not reach the controller
+            if res.returncode != 0 and 'Invalid job id' not in res.stderr.decode():
+                return None
+            active.update(line.strip() for line in res.stdout.decode().split('\n')
+                          if line.strip())
+        return active
 
     def wait_for_jobs(self, job_prefix=None):
-        # TODO move to some config
-        wait_time = 10
-        while True:
-            time.sleep(wait_time)
-            # TODO filter for job name pattern
-            n_running = check_output(['squeue -u $USER | wc -l'], shell=True).decode()
-            # n_running = check_output(['squeue -u $USER | grep %f | wc -l' % self.task_name], shell=True).decode()
-            # need to substract 1 due to header # TODO drop this once we filter for job-name
-            n_running = int(n_running.strip('\n')) - 1
-            if n_running == 0:
-                break
+        self._wait_for_submitted_jobs(job_prefix, self._query_active_jobs)
+
+
+# long-lived worker pools for the in-process local executor,
+# indexed by the number of workers. we keep them alive for the whole
+# luigi run, so that the task modules are only imported once per worker
+_local_worker_pools = {}
+
+
+def _get_local_worker_pool(n_workers):
+    pool = _local_worker_pools.get(n_workers, None)
+    if pool is None:
+        pool = futures.ProcessPoolExecutor(n_workers)
+        _local_worker_pools[n_workers] = pool
+    return pool
+
+
+@atexit.register
+def _shutdown_local_worker_pools():
+    for pool in _local_worker_pools.values():
+        pool.shutdown(wait=False)
+    _local_worker_pools.clear()
+
+
+def _run_job_in_process(module_name, function_name, job_id,
+                        config_path, log_file, err_file):
+    """ Run the job function of a task module inside of a worker process.
+
+    The module is imported only the first time a worker sees it, subsequent
+    jobs re-use the cached module. Stdout and stderr are redirected to the
+    same files the subprocess executor writes to, so `check_jobs` and the
+    retry mechanism can parse the logs as usual.
+    """
+    with open(log_file, 'w') as f_out, open(err_file, 'w') as f_err:
+        with redirect_stdout(f_out), redirect_stderr(f_err):
+            try:
+                module = importlib.import_module(module_name)
+                getattr(module, function_name)(job_id, config_path)
+            # we only need to print the traceback, the job is marked as failed
+            # because the log does not end with 'processed job'
+            except Exception:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
 
 
 class LocalTask(BaseClusterTask):
@@ -452,36 +702,70 @@ class LocalTask(BaseClusterTask):
     # don't want to start to many local jobs, because
     # this is usually a sign that forgot to set the target
     # to slurm or lsf
-    # TODO could also set this from cpu count
+    # (this limit does not apply to the in-process executor,
+    # which runs jobs on a fixed number of workers)
     max_local_jobs = 12
 
     def prepare_jobs(self, n_jobs, block_list, config,
-                     job_prefix=None, consecutive_blocks=False):
+                     job_prefix=None, consecutive_blocks=False, block_costs=None):
         # write the job configs
-        self._write_job_config(n_jobs, block_list, config, job_prefix, consecutive_blocks)
-
-    def _submit(self, job_id, job_prefix):
-        script_path = os.path.join(self.tmp_folder, self.task_name + '.py')
-        assert os.path.exists(script_path), script_path
-        config_file = self._config_path(job_id, job_prefix)
-        assert os.path.exists(config_file), config_file
+        self._write_job_config(n_jobs, block_list, config, job_prefix,
+                               consecutive_blocks, block_costs)
 
+    def _job_files(self, job_id, job_prefix):
         job_name = self.task_name if job_prefix is None else '%s_%s' % (self.task_name,
                                                                         job_prefix)
         log_file = os.path.join(self.tmp_folder, 'logs',
                                 '%s_%i.log' % (job_name, job_id))
         err_file = os.path.join(self.tmp_folder, 'error_logs',
                                 '%s_%i.err' % (job_name, job_id))
+        return log_file, err_file
+
+    def _submit(self, job_id, job_prefix):
+        script_path = os.path.join(self.tmp_folder, self.task_name + '.py')
+        assert os.path.exists(script_path), script_path
+        config_file = self._config_path(job_id, job_prefix)
+        assert os.path.exists(config_file), config_file
+
+        log_file, err_file = self._job_files(job_id, job_prefix)
         with open(log_file, 'w') as f_out, open(err_file, 'w') as f_err:
             call([script_path, config_file], stdout=f_out, stderr=f_err)
 
-    def submit_jobs(self, n_jobs, job_prefix=None):
+    def _submit_jobs_subprocess(self, n_jobs, job_prefix):
         assert n_jobs < self.max_local_jobs,\
             "Trying to submit %i local jobs, did you forget to set the target to slurm or lsf?" % n_jobs
         with futures.ProcessPoolExecutor(n_jobs) as pp:
             tasks = [pp.submit(self._submit, job_id, job_prefix) for job_id in range(n_jobs)]
             [t.result() for t in tasks]
 
+    def _submit_jobs_in_process(self, n_jobs, job_prefix, max_workers):
+        # the job function has the same name as the task by convention,
+        # see the `__main__` block of the task modules
+        module_name = type(self).__module__
+        n_workers = os.cpu_count() if max_workers is None else max_workers
+        n_workers = max(1, min(n_workers, n_jobs))
+        self._write_log("running %i jobs in-process on %i workers" % (n_jobs, n_workers))
+
+        pool = _get_local_worker_pool(n_workers)
+        tasks = []
+        for job_id in range(n_jobs):
+            config_file = self._config_path(job_id, job_prefix)
+            assert os.path.exists(config_file), config_file
+            log_file, err_file = self._job_files(job_id, job_prefix)
+            tasks.append(pool.submit(_run_job_in_process, module_name, self.task_name,
+                                     job_id, config_file, log_file, err_file))
+        [t.result() for t in tasks]
+
+    def submit_jobs(self, n_jobs, job_prefix=None):
+        global_config = self.get_global_config()
+        executor = global_config.get('local_executor', 'subprocess')
+        assert executor in ('subprocess', 'in_process'), executor
+        if executor == 'subprocess':
+            self._submit_jobs_subprocess(n_jobs, job_prefix)
+        else:
+            self._submit_jobs_in_process(n_jobs, job_prefix,
+                                         global_config.get('max_local_workers', None))
+
     # don't need to wait for process pool
     def wait_for_jobs(self, job_prefix=None):
         pass
@@ -493,10 +777,25 @@ class LSFTask(BaseClusterTask):
     (tested on Janelia cluster)
     """
 
+    def _write_lsf_file(self, job_prefix=None):
+        job_name = self.task_name if job_prefix is None else '%s_%s' % (self.task_name, job_prefix)
+        # the job id is given by the (1-based) array index, offset by
+        # JOB_ID_OFFSET if we need more than one array job
+        lsf_template = ("#!/bin/bash\n"
+                        "%s") % self._array_job_command(job_prefix,
+                                                        'LSB_JOBINDEX - 1 + JOB_ID_OFFSET')
+        script_path = os.path.join(self.tmp_folder, 'lsf_%s.sh' % job_name)
+        with open(script_path, 'w') as f:
+            f.write(lsf_template)
+        self._make_executable(script_path)
+
     def prepare_jobs(self, n_jobs, block_list, config,
-                     job_prefix=None, consecutive_blocks=False):
+                     job_prefix=None, consecutive_blocks=False, block_costs=None):
         # write the job configs
-        self._write_job_config(n_jobs, block_list, config, job_prefix, consecutive_blocks)
+        self._write_job_config(n_jobs, block_list, config, job_prefix,
+                               consecutive_blocks, block_costs)
+        # write the lsf script file
+        self._write_lsf_file(job_prefix)
 
     def submit_jobs(self, n_jobs, job_prefix=None):
         # read the task config to get number of threads and time limit
@@ -504,35 +803,69 @@ class LSFTask(BaseClusterTask):
         n_threads = task_config.get("threads_per_job", 1)
         time_limit = task_config.get("time_limit", 60)
         #
-        script_path = os.path.join(self.tmp_folder, self.task_name + '.py')
-        assert os.path.exists(script_path), script_path
         job_name = self.task_name if job_prefix is None else '%s_%s' % (self.task_name,
                                                                         job_prefix)
+        script_path = os.path.join(self.tmp_folder, 'lsf_%s.sh' % job_name)
+        assert os.path.exists(script_path), script_path
+        # output of lsf itself, e.g. messages about jobs that were killed
+        out_file = os.path.join(self.tmp_folder, 'error_logs', '%s_lsf_%%J_%%I.out' % job_name)
+        max_concurrent = self.get_global_config().get('max_concurrent_array_tasks', None)
+
+        scheduler_ids = {}
+        for offset, n_tasks in self._array_chunks(n_jobs):
+            array = '%s[1-%i]' % (job_name, n_tasks)
+            if max_concurrent is not None:
+                array += '%%%i' % max_concurrent
+            bsub_command = 'JOB_ID_OFFSET=%i bsub -n %i -J "%s" -We %i -o %s %s' % (offset, n_threads,
+                                                                                   array, time_limit,
+                                                                                   out_file, script_path)
+            out = check_output([bsub_command], shell=True).decode()
+            array_id = self._parse_job_id(out)
+            scheduler_ids.update({'%s[%i]' % (array_id, index + 1): offset + index
+                                  for index in range(n_tasks)})
+        self._register_submitted_jobs(scheduler_ids, job_prefix)
 
-        for job_id in range(n_jobs):
-            config_file = self._config_path(job_id, job_prefix)
-            command = '%s %s' % (script_path, config_file)
-            log_file = os.path.join(self.tmp_folder, 'logs',
-                                    '%s_%i.log' % (job_name, job_id))
-            err_file = os.path.join(self.tmp_folder, 'error_logs',
-                                    '%s_%i.err' % (job_name, job_id))
-            bsub_command = 'bsub -n %i -J %s_%i -We %i -o %s -e %s \'%s\'' % (n_threads,
-                                                                              self.task_name,
-                                                                              job_id, time_limit,
-                                                                              log_file, err_file,
-                                                                              command)
-            call([bsub_command], shell=True)
+    @staticmethod
+    def _parse_job_id(bsub_output):
+        """ Parse the job id from the output of `bsub`,
+        e.g. 'Job <1234> is submitted to queue <normal>.'
+        """
+        match = re.search(r'Job <(\d+)>', bsub_output)
+        assert match is not None, "Could not parse job id from %s" % bsub_output
+        return match.group(1)
+
+    # job states that mean that a job has left the queue, see `man bjobs`
+    _finished_states = ('DONE', 'EXIT')
+
+    @classmethod
+    def _query_active_jobs(cls, scheduler_ids, batch_size=500):
+        """ Return the ids of jobs that are still pending or running according to bjobs.
+
+        Array tasks are identified by 'array_id'['index'], we query the array ids
+        and let bjobs list the array tasks individually.
+        """
+        query_ids = sorted(set(scheduler_id.split('[')[0] for scheduler_id in scheduler_ids))
+        active = set()
+        for batch_start in range(0, len(query_ids), batch_size):
+            batch = query_ids[batch_start:batch_start + batch_size]
+            res = run(['bjobs', '-noheader', '-o', 'jobid jobindex stat'] + batch,
+                      stdout=PIPE, stderr=PIPE)
+            # bjobs reports jobs it does not know anymore on stderr;
+            # any other error means that we could not reach the scheduler
+            errors = [line for line in res.stderr.decode().split('\n')
+                      if line.strip() and 'is not found' not in line]
+            if errors:
+                return None
+            for line in res.stdout.decode().split('\n'):
+                line = line.split()
+                if len(line) != 3 or line[2] in cls._finished_states:
+                    continue
+                # non-array jobs have job index 0
+                active.add(line[0] if line[1] == '0' else '%s[%s]' % (line[0], line[1]))
+        return active
 
     def wait_for_jobs(self, job_prefix=None):
-        # TODO move to some config
-        wait_time = 10
-        while True:
-            time.sleep(wait_time)
-            # TODO filter for job name pattern
-            n_running = check_output(['bjobs | grep $USER | wc -l'], shell=True).decode()
-            n_running = int(n_running.strip('\n'))
-            if n_running == 0:
-                break
+        self._wait_for_submitted_jobs(job_prefix, self._query_active_jobs)
 
     # TODO I think LSF appends to the output and logfile
     # so we need to clean them up here in order to have clean logs
@@ -105,41 +105,18 @@ class BlockComponentsLSF(BlockComponentsBase, LSFTask):
     pass
 
 
-def _cc_block(block_id, blocking, ds_in, ds_out):
-    fu.log("start processing block %i" % block_id)
-    block = blocking.getBlock(block_id)
-    bb = vu.block_to_bb(block)
-    input_ = ds_in[bb]
+def _cc_block(input_, threshold):
+    if threshold is not None:
+        input_ = input_ > threshold
+
     if np.sum(input_) == 0:
-        fu.log_block_success(block_id)
-        return 0
+        return None
 
     # TODO we should check that the max value in labels is smaller
     # than uint32 max
-    components = vigra.analysis.labelVolumeWithBackground(input_.astype('uint32'))
-    components = components.astype('uint64')
-    ds_out[bb] = components
-    fu.log_block_success(block_id)
-    return int(components.max()) + 1
-
-
-def _cc_block_with_threshold(block_id, blocking,
-                             ds_in, ds_out, threshold):
-    fu.log("start processing block %i" % block_id)
-    block = blocking.getBlock(block_id)
-    bb = vu.block_to_bb(block)
-    input_ = ds_in[bb]
-    input_ = input_ > threshold
-
-    if np.sum(input_) == 0:
-        fu.log_block_success(block_id)
-        return 0
-
-    components = vigra.analysis.labelVolumeWithBackground(input_.view('uint8'))
-    components = components.astype('uint64')
-    ds_out[bb] = components
-    fu.log_block_success(block_id)
-    return int(components.max()) + 1
+    input_ = input_.astype('uint32') if threshold is None else input_.view('uint8')
+    components = vigra.analysis.labelVolumeWithBackground(input_)
+    return components.astype('uint64')
 
 
 def block_components(job_id, config_path):
@@ -168,15 +145,23 @@ def block_components(job_id, config_path):
         shape = ds_in.shape
         blocking = nt.blocking([0, 0, 0], list(shape), block_shape)
 
-        if threshold is None:
-            offsets = [_cc_block(block_id, blocking,
-                                 ds_in, ds_out) for block_id in block_list]
-        else:
-            offsets = [_cc_block_with_threshold(block_id, blocking,
-                                                ds_in, ds_out, threshold) for block_id in block_list]
+        offsets = {}
+
+        def _read(block_id, stats):
+            return stats.read(ds_in, vu.block_to_bb(blocking.getBlock(block_id)))
+
+        def _compute(block_id, input_):
+            components = _cc_block(input_, threshold)
+            offsets[block_id] = 0 if components is None else int(components.max()) + 1
+            return components
+
+        def _write(block_id, components, stats):
+            stats.write(ds_out, vu.block_to_bb(blocking.getBlock(block_id)), components)
 
+        # overlap reading and writing of blocks with labeling the components
+        fu.pipeline_blocks(block_list, _read, _compute, _write, config)
 
-    offset_dict = {block_id: off for block_id, off in zip(block_list, offsets)}
+    offset_dict = {block_id: offsets[block_id] for block_id in block_list}
     save_path = os.path.join(tmp_folder,
                              'connected_components_offsets_%i.json' % job_id)
     with open(save_path, 'w') as f:
@@ -26,6 +26,7 @@ class CopyVolumeBase(luigi.Task):
 
     task_name = 'copy_volume'
     src_file = os.path.abspath(__file__)
+    allow_block_queue = True
 
     # input and output volumes
     input_path = luigi.Parameter()
@@ -175,27 +176,31 @@ def cast_type(data, dtype):
         return data.astype(dtype)
 
 
-def _copy_blocks(ds_in, ds_out, blocking, block_list, roi_begin):
-    dtype = ds_out.dtype
-    for block_id in block_list:
-        fu.log("start processing block %i" % block_id)
-        block = blocking.getBlock(block_id)
-        bb = tuple(slice(beg, end) for beg, end in zip(block.begin, block.end))
-        data = ds_in[bb]
-
-        # don't write empty blocks
-        if sum(data).sum() == 0:
-            fu.log_block_success(block_id)
-            continue
-
-        # if we have a roi begin, we need to substract it
-        # from the output bounding box, because in this case
-        # the output shape has been fit to the roi
-        if roi_begin is not None:
-            bb = tuple(slice(b.start - off, b.stop - off)
-                       for b, off in zip(bb, roi_begin))
-        ds_out[bb] = cast_type(data, dtype)
+def _copy_block(ds_in, ds_out, blocking, block_id, roi_begin, stats):
+    fu.log("start processing block %i" % block_id)
+    block = blocking.getBlock(block_id)
+    bb = tuple(slice(beg, end) for beg, end in zip(block.begin, block.end))
+    data = stats.read(ds_in, bb)
+
+    # don't write empty blocks
+    if sum(data).sum() == 0:
         fu.log_block_success(block_id)
+        return
+
+    # if we have a roi begin, we need to substract it
+    # from the output bounding box, because in this case
+    # the output shape has been fit to the roi
+    if roi_begin is not None:
+        bb = tuple(slice(b.start - off, b.stop - off)
+                   for b, off in zip(bb, roi_begin))
+    stats.write(ds_out, bb, cast_type(data, ds_out.dtype))
+    fu.log_block_success(block_id)
+
+
+def _copy_blocks(ds_in, ds_out, blocking, block_list, roi_begin, config):
+    for block_id in block_list:
+        with fu.instrument_block(config, block_id) as stats:
+            _copy_block(ds_in, ds_out, blocking, block_id, roi_begin, stats)
 
 
 def copy_volume(job_id, config_path):
@@ -209,7 +214,6 @@ def copy_volume(job_id, config_path):
     input_key = config['input_key']
 
     block_shape = list(config['block_shape'])
-    block_list = config['block_list']
 
     # read the output config
     output_path = config['output_path']
@@ -230,7 +234,8 @@ def copy_volume(job_id, config_path):
         shape = list(ds_in.shape)
         blocking = nt.blocking([0, 0, 0], shape, block_shape)
 
-        _copy_blocks(ds_in, ds_out, blocking, block_list, roi_begin)
+        _copy_blocks(ds_in, ds_out, blocking,
+                     fu.blocks_to_process(job_id, config), roi_begin, config)
 
     # log success
     fu.log_job_success(job_id)
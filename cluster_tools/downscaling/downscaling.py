@@ -4,7 +4,6 @@ import os
 import sys
 import json
 from functools import partial
-from concurrent import futures
 
 import numpy as np
 import luigi
@@ -155,8 +154,11 @@ class DownscalingBase(luigi.Task):
             self._write_log("ROI after scaling: %s to %s" % (str(roi_begin), str(roi_end)))
 
         if self.n_retries == 0:
+            # blocks with empty input stay empty, so we skip them
             block_list = vu.blocks_in_volume(shape, block_shape, roi_begin, roi_end,
-                                             block_list_path)
+                                             block_list_path,
+                                             occupancy=(self.input_path, self.input_key),
+                                             occupancy_halo=self.halo if self.halo else None)
             self._write_log("scheduled %i blocks to run" % len(block_list))
         else:
             block_list = self.block_list
@@ -202,9 +204,7 @@ class DownscalingLSF(DownscalingBase, LSFTask):
 #
 
 
-def _ds_block(blocking, block_id, ds_in, ds_out, scale_factor, halo, sampler):
-    fu.log("start processing block %i" % block_id)
-
+def _ds_bbs(blocking, block_id, ds_in, scale_factor, halo):
     # load the block (output dataset / downsampled) coordinates
     if halo is None:
         block = blocking.getBlock(block_id)
@@ -228,13 +228,13 @@ def _ds_block(blocking, block_id, ds_in, ds_out, scale_factor, halo, sampler):
     else:
         in_bb = tuple(slice(ib.start * sf, min(ib.stop * sf, sh))
                       for ib, sf, sh in zip(in_bb, scale_factor, ds_in.shape))
+    return in_bb, out_bb, local_bb, out_shape
 
-    x = ds_in[in_bb]
 
+def _ds_block(x, out_shape, local_bb, scale_factor, sampler):
     # don't sample empty blocks
     if np.sum(x != 0) == 0:
-        fu.log_block_success(block_id)
-        return
+        return None
 
     dtype = x.dtype
     if np.dtype(dtype) != np.dtype('float32'):
@@ -255,32 +255,34 @@ def _ds_block(blocking, block_id, ds_in, ds_out, scale_factor, halo, sampler):
         np.round(out, out=out)
 
     try:
-        ds_out[out_bb] = out[local_bb].astype(dtype)
+        return out[local_bb].astype(dtype)
     except IndexError as e:
-        raise(IndexError("%s, %s, %s" % (str(out_bb), str(local_bb), str(out.shape))))
-
-    # log block success
-    fu.log_block_success(block_id)
+        raise(IndexError("%s, %s" % (str(local_bb), str(out.shape))))
 
 
 def _submit_blocks(ds_in, ds_out, block_shape, block_list,
                    scale_factor, halo, library,
-                   library_kwargs, n_threads):
+                   library_kwargs, n_threads, config):
 
     # get the blocking
     shape = ds_out.shape
     blocking = nt.blocking([0, 0, 0], shape, block_shape)
     sampler = partial(vigra.sampling.resize, **library_kwargs)
 
-    if n_threads <= 1:
-        for block_id in block_list:
-            _ds_block(blocking, block_id, ds_in, ds_out,
-                      scale_factor, halo, sampler)
-    else:
-        with futures.ThreadPoolExecutor(n_threads) as tp:
-            tasks = [tp.submit(_ds_block, blocking, block_id, ds_in, ds_out,
-                               scale_factor, halo, sampler) for block_id in block_list]
-            [t.result() for t in tasks]
+    def _read(block_id, stats):
+        in_bb, _, _, _ = _ds_bbs(blocking, block_id, ds_in, scale_factor, halo)
+        return stats.read(ds_in, in_bb)
+
+    def _compute(block_id, x):
+        _, _, local_bb, out_shape = _ds_bbs(blocking, block_id, ds_in, scale_factor, halo)
+        return _ds_block(x, out_shape, local_bb, scale_factor, sampler)
+
+    def _write(block_id, out, stats):
+        _, out_bb, _, _ = _ds_bbs(blocking, block_id, ds_in, scale_factor, halo)
+        stats.write(ds_out, out_bb, out)
+
+    # overlap reading and writing of blocks with downsampling
+    fu.pipeline_blocks(block_list, _read, _compute, _write, config, n_threads)
 
 
 def downscaling(job_id, config_path):
@@ -316,14 +318,14 @@ def downscaling(job_id, config_path):
             ds_in  = f[input_key]
             ds_out = f[output_key]
             _submit_blocks(ds_in, ds_out, block_shape, block_list, scale_factor, halo,
-                           library, library_kwargs, n_threads)
+                           library, library_kwargs, n_threads, config)
 
     else:
         with vu.file_reader(input_path, 'r') as f_in, vu.file_reader(output_path) as f_out:
             ds_in  = f_in[input_key]
             ds_out = f_out[output_key]
             _submit_blocks(ds_in, ds_out, block_shape, block_list, scale_factor, halo,
-                           library, library_kwargs, n_threads)
+                           library, library_kwargs, n_threads, config)
 
     # log success
     fu.log_job_success(job_id)
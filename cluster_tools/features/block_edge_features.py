@@ -164,19 +164,13 @@ def _accumulate_filter(input_, graph, labels, bb_local,
                                      response.min(), response.max())
 
 
-def _accumulate_block(block_id, blocking,
-                      ds_in, ds_labels,
-                      out_prefix, graph_block_prefix,
-                      filters, sigmas, halo, ignore_label,
-                      apply_in_2d, channel_agglomeration):
-
-    fu.log("start processing block %i" % block_id)
+def _read_block(block_id, blocking, ds_in, ds_labels,
+                graph_block_prefix, halo, channel_agglomeration, stats):
     # load graph and check if this block has edges
     graph = ndist.Graph(graph_block_prefix + str(block_id))
     if graph.numberOfEdges == 0:
         fu.log("block %i has no edges" % block_id)
-        fu.log_block_success(block_id)
-        return
+        return None
 
     shape = ds_labels.shape
     # get the bounding
@@ -206,13 +200,21 @@ def _accumulate_block(block_id, blocking,
     if input_dim == 4:
         bb_in = (slice(0, 3),) + bb_in
 
-    input_ = vu.normalize(ds_in[bb_in])
+    input_ = vu.normalize(stats.read(ds_in, bb_in))
     if input_dim == 4:
         assert channel_agglomeration is not None
         input_ = getattr(np, channel_agglomeration)(input_, axis=0)
 
     # load labels
-    labels = ds_labels[bb]
+    labels = stats.read(ds_labels, bb)
+    return graph, input_, labels, bb_local
+
+
+def _accumulate_block(data, filters, sigmas, ignore_label, apply_in_2d):
+    # the block has no edges
+    if data is None:
+        return None
+    graph, input_, labels, bb_local = data
 
     # TODO pre-smoothing ?!
     # accumulate the edge features
@@ -221,8 +223,10 @@ def _accumulate_block(block_id, blocking,
                                         filter_name==filters[-1] and sigma==sigmas[-1],
                                         apply_in_2d)
                      for filter_name in filters for sigma in sigmas]
-    edge_features = np.concatenate(edge_features, axis=1)
+    return np.concatenate(edge_features, axis=1)
 
+
+def _write_block(block_id, edge_features, out_prefix):
     # save the features
     save_path = out_prefix + str(block_id)
     fu.log("saving feature result of shape %s to %s" % (str(edge_features.shape),
@@ -232,15 +236,13 @@ def _accumulate_block(block_id, blocking,
         f.create_dataset(save_key, data=edge_features,
                          chunks=edge_features.shape)
 
-    fu.log_block_success(block_id)
-
 
 def _accumulate_with_filters(input_path, input_key,
                              labels_path, labels_key,
                              output_path, graph_block_prefix,
                              block_list, block_shape,
                              filters, sigmas, halo,
-                             apply_in_2d, channel_agglomeration):
+                             apply_in_2d, channel_agglomeration, config):
 
     fu.log("accumulate features with applying filters:")
     # TODO log filter and sigma values
@@ -263,12 +265,17 @@ def _accumulate_with_filters(input_path, input_key,
     with vu.file_reader(input_path) as f, vu.file_reader(labels_path) as f_l:
         ds_in = f[input_key]
         ds_labels = f_l[labels_key]
-        for block_id in block_list:
-            _accumulate_block(block_id, blocking,
-                              ds_in, ds_labels,
-                              out_prefix, graph_block_prefix,
-                              filters, sigmas, halo, ignore_label,
-                              apply_in_2d, channel_agglomeration)
+        fu.pipeline_blocks(block_list,
+                           lambda block_id, stats: _read_block(block_id, blocking,
+                                                               ds_in, ds_labels,
+                                                               graph_block_prefix, halo,
+                                                               channel_agglomeration, stats),
+                           lambda block_id, data: _accumulate_block(data, filters, sigmas,
+                                                                    ignore_label, apply_in_2d),
+                           lambda block_id, edge_features, stats: _write_block(block_id,
+                                                                               edge_features,
+                                                                               out_prefix),
+                           config)
 
 
 def block_edge_features(job_id, config_path):
@@ -311,7 +318,7 @@ def block_edge_features(job_id, config_path):
                                  output_path, graph_block_prefix,
                                  block_list, block_shape,
                                  filters, sigmas, halo,
-                                 apply_in_2d, channel_agglomeration)
+                                 apply_in_2d, channel_agglomeration, config)
 
     fu.log_job_success(job_id)
 
@@ -14,6 +14,9 @@ class GraphWorkflow(WorkflowBase):
     graph_path = luigi.Parameter()
     output_key = luigi.Parameter()
     n_scales = luigi.IntParameter()
+    # serialize the sub-problems of the blocks for the blockwise multicut,
+    # see `MergeSubGraphs`
+    serialize_sub_problems = luigi.BoolParameter(default=False)
 
     # for now we only support n5 / zarr input labels
     def _check_input(self):
@@ -53,6 +56,7 @@ class GraphWorkflow(WorkflowBase):
                         output_key=self.output_key,
                         scale=self.n_scales - 1,
                         merge_complete_graph=True,
+                        serialize_sub_problems=self.serialize_sub_problems,
                         dependency=t_prev)
 
 
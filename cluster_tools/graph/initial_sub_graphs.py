@@ -24,6 +24,7 @@ class InitialSubGraphsBase(luigi.Task):
 
     task_name = 'initial_sub_graphs'
     src_file = os.path.abspath(__file__)
+    allow_block_queue = True
 
     # input volumes and graph
     input_path = luigi.Parameter()
@@ -131,7 +132,6 @@ def initial_sub_graphs(job_id, config_path):
     input_path = config['input_path']
     input_key = config['input_key']
     block_shape = config['block_shape']
-    block_list = config['block_list']
     graph_path = config['graph_path']
     ignore_label = config.get('ignore_label', True)
 
@@ -140,7 +140,7 @@ def initial_sub_graphs(job_id, config_path):
                            roiEnd=list(shape),
                            blockShape=list(block_shape))
 
-    for block_id in block_list:
+    for block_id in fu.blocks_to_process(job_id, config):
         _graph_block(block_id, blocking, input_path, input_key, graph_path,
                      ignore_label)
     fu.log_job_success(job_id)
@@ -10,6 +10,7 @@ import nifty.distributed as ndist
 
 import cluster_tools.utils.volume_utils as vu
 import cluster_tools.utils.function_utils as fu
+import cluster_tools.utils.graph_utils as gu
 from cluster_tools.cluster_tasks import SlurmTask, LocalTask, LSFTask
 
 
@@ -29,6 +30,9 @@ class MergeSubGraphsBase(luigi.Task):
     scale = luigi.IntParameter()
     output_key = luigi.Parameter(default='')
     merge_complete_graph = luigi.BoolParameter(default=False)
+    # serialize the sub-problems of the blocks for the blockwise multicut,
+    # only used if we merge the complete graph
+    serialize_sub_problems = luigi.BoolParameter(default=False)
     # dependency
     dependency = luigi.TaskParameter()
 
@@ -93,7 +97,8 @@ class MergeSubGraphsBase(luigi.Task):
         # as well as block shape
         config.update({'graph_path': self.graph_path, 'block_shape': block_shape,
                        'scale': self.scale, 'merge_complete_graph': self.merge_complete_graph,
-                       'output_key': self.output_key})
+                       'output_key': self.output_key,
+                       'serialize_sub_problems': self.serialize_sub_problems})
 
         if self.merge_complete_graph:
             self._run_last_scale(config, block_shape, roi_begin, roi_end)
@@ -131,7 +136,7 @@ class MergeSubGraphsLSF(MergeSubGraphsBase, LSFTask):
 
 
 def _merge_graph(graph_path, output_key, scale,
-                 block_list, blocking, shape, n_threads):
+                 block_list, blocking, shape, n_threads, serialize_sub_problems):
     block_prefix = 's%i/sub_graphs/block_' % scale
     ndist.mergeSubgraphs(graph_path,
                          blockPrefix=block_prefix,
@@ -141,6 +146,20 @@ def _merge_graph(graph_path, output_key, scale,
     with vu.file_reader(graph_path) as f:
         f[output_key].attrs['shape'] = shape
 
+    # for multicut problems, we serialize the sub-problems of the blocks,
+    # so that the blockwise multicut doesn't need to load the whole graph
+    if serialize_sub_problems:
+        assert output_key == 's%i/graph' % scale,\
+            "Can only serialize sub-problems for the graph at 's%i/graph'" % scale
+        fu.log("serializing sub-problems for %i blocks" % len(block_list))
+        gu.require_sub_problems(graph_path, scale, blocking.blockShape)
+        gu.serialize_sub_problems(graph_path, scale, blocking.blockShape,
+                                  block_list, n_threads)
+    elif output_key == 's%i/graph' % scale:
+        # sub-problems of a previous run refer to the old graph, but the blockwise multicut
+        # would still use them, so we need to remove them
+        gu.remove_sub_problems(graph_path, scale)
+
 
 def _merge_subblocks(block_id, blocking, previous_blocking, graph_path, scale):
     fu.log("start processing block %i" % block_id)
@@ -186,7 +205,8 @@ def merge_sub_graphs(job_id, config_path):
         output_key = config.get('output_key', '')
         assert output_key != ''
         _merge_graph(graph_path, output_key, scale,
-                     block_list, blocking, shape, n_threads)
+                     block_list, blocking, shape, n_threads,
+                     config.get('serialize_sub_problems', False))
 
     else:
         fu.log("merging subgraphs at scale %i" % scale)
@@ -311,9 +311,9 @@ def inference(job_id, config_path):
         ds_out = f_in[outputt_key]
 
         if mask_path in config:
-            mask = vu.load_mask(config['mask_path'], config['mask_key'], shape)
-            _run_inference_with_mask(blocking, block_list, halo, ds_in, ds_out, mask,
-                                     predict, dtype, n_channels)
+            with vu.load_mask(config['mask_path'], config['mask_key'], shape) as mask:
+                _run_inference_with_mask(blocking, block_list, halo, ds_in, ds_out, mask,
+                                         predict, dtype, n_channels)
         else:
             _run_inference(blocking, block_list, halo, ds_in, ds_out,
                            preprocess, predict, dtype, n_channels, n_threads)
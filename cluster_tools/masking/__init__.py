@@ -1 +1,3 @@
 from .minfilter import MinfilterLocal, MinfilterSlurm, MinfilterLSF
+from .blocks_from_mask import BlocksFromMaskLocal, BlocksFromMaskSlurm, BlocksFromMaskLSF
+from .blocks_from_mask_workflow import BlocksFromMaskWorkflow
@@ -2,9 +2,8 @@
 
 import os
 import sys
-import argparse
-import pickle
 import json
+from itertools import product
 
 import numpy as np
 import luigi
@@ -15,26 +14,37 @@ import cluster_tools.utils.function_utils as fu
 from cluster_tools.cluster_tasks import SlurmTask, LocalTask, LSFTask
 
 
-# NOTE we don't exclude the ignore label here, but ignore
-# it in the graph extraction already
 class BlocksFromMaskBase(luigi.Task):
     """ BlocksFromMask base class
+
+    Find the blocks of the global block shape that intersect with a (possibly downsampled) mask
+    and save them as json block list that can be used as `block_list_path` in the global config.
     """
 
     task_name = 'blocks_from_mask'
     src_file = os.path.abspath(__file__)
     allow_retry = False
 
-    # input and output volumes
+    # input mask and shape of the volume we compute the blocks for
     mask_path = luigi.Parameter()
     mask_key = luigi.Parameter()
+    shape = luigi.ListParameter()
+    # path to the json with the block list
     output_path = luigi.Parameter()
-    output_key = luigi.Parameter()
     dependency = luigi.TaskParameter()
 
     def requires(self):
         return self.dependency
 
+    @staticmethod
+    def default_task_config():
+        # we use this to get also get the common default config
+        config = LocalTask.default_task_config()
+        # the block shape for processing the mask (in mask coordinates),
+        # defaults to the global block shape
+        config.update({'mask_block_shape': None})
+        return config
+
     def run_impl(self):
         # get the global config and init configs
         shebang, block_shape, roi_begin, roi_end = self.global_config_values()
@@ -43,29 +53,46 @@ class BlocksFromMaskBase(luigi.Task):
         # load the task config
         config = self.get_task_config()
 
-        with vu.file_reader(self.input_path) as f:
-            n_edges = f[self.input_key].shape[0]
-        # chunk size = 64**3
-        chunk_size = min(262144, n_edges)
+        mask_shape = vu.get_shape(self.mask_path, self.mask_key)
+        assert len(mask_shape) == len(self.shape), "%i, %i" % (len(mask_shape), len(self.shape))
+        assert all(msh <= sh for msh, sh in zip(mask_shape, self.shape)),\
+            "Mask can't be larger than the volume, got %s %s" % (str(mask_shape), str(self.shape))
 
-        # require output dataset
-        with vu.file_reader(self.output_path) as f:
-            f.require_dataset(self.output_key, shape=(n_edges,), compression='gzip',
-                              dtype='float32', chunks=(chunk_size,))
+        mask_block_shape = config.pop('mask_block_shape', None)
+        if mask_block_shape is None:
+            mask_block_shape = block_shape
+        mask_block_shape = [min(bs, msh) for bs, msh in zip(mask_block_shape, mask_shape)]
 
-        # update the config with input and output paths and keys
-        # as well as block shape
-        config.update({'input_path': self.input_path, 'input_key': self.input_key,
-                       'output_path': self.output_path, 'output_key': self.output_key,
-                       'features_path': self.features_path, 'features_key': self.features_key})
+        # we process the mask blocks in parallel and skip the blocks without mask chunks
+        mask_block_list = vu.blocks_in_volume(mask_shape, mask_block_shape,
+                                              occupancy=(self.mask_path, self.mask_key))
+        self._write_log("scheduled %i mask blocks to run" % len(mask_block_list))
 
+        config.update({'mask_path': self.mask_path, 'mask_key': self.mask_key,
+                       'shape': list(self.shape), 'block_shape': block_shape,
+                       'mask_block_shape': mask_block_shape, 'tmp_folder': self.tmp_folder})
+
+        n_jobs = min(len(mask_block_list), self.max_jobs)
         # prime and run the jobs
-        self.prepare_jobs(1, None, config)
-        self.submit_jobs(1)
+        self.prepare_jobs(n_jobs, mask_block_list, config)
+        self.submit_jobs(n_jobs)
 
         # wait till jobs finish and check for job success
         self.wait_for_jobs()
-        self.check_jobs(1)
+        self.check_jobs(n_jobs)
+
+        # merge the blocks found by the jobs and restrict them to the roi
+        block_list = set()
+        for job_id in range(n_jobs):
+            with open(_job_path(self.tmp_folder, job_id)) as f:
+                block_list.update(json.load(f))
+        if roi_begin is not None:
+            block_list.intersection_update(vu.blocks_in_volume(self.shape, block_shape,
+                                                               roi_begin, roi_end))
+        block_list = sorted(block_list)
+        self._write_log("found %i blocks in mask" % len(block_list))
+        with open(self.output_path, 'w') as f:
+            json.dump(block_list, f)
 
 
 class BlocksFromMaskLocal(BlocksFromMaskBase, LocalTask):
@@ -90,6 +117,60 @@ class BlocksFromMaskLSF(BlocksFromMaskBase, LSFTask):
 # Implementation
 #
 
+
+def _job_path(tmp_folder, job_id):
+    return os.path.join(tmp_folder, 'blocks_from_mask_job_%i.json' % job_id)
+
+
+def _block_ranges(begin, end, mask_size, size, block_size):
+    """ Find the range of blocks covered by the mask voxels in [begin, end) along one axis.
+
+    Mask voxel m covers the voxels [m * size / mask_size, (m + 1) * size / mask_size)
+    of the volume. If the mask is downsampled, we add a margin of one mask voxel,
+    because the interpolation of the mask may shift its boundary.
+    """
+    coords = np.arange(begin, end, dtype='int64')
+    margin = 0 if mask_size == size else 1
+    start = np.maximum(coords - margin, 0) * size // mask_size
+    stop = -(-np.minimum(coords + 1 + margin, mask_size) * size // mask_size)
+    return start // block_size, (stop - 1) // block_size
+
+
+def _blocks_in_mask_block(mask, mask_bb, mask_shape, shape, block_shape):
+    """ Find the ids of the blocks that intersect with the foreground of a mask block.
+    """
+    ranges = [_block_ranges(bb.start, bb.stop, msh, sh, bs)
+              for bb, msh, sh, bs in zip(mask_bb, mask_shape, shape, block_shape)]
+
+    # the mask voxels with the same block range are equivalent, so we reduce them
+    # to a single voxel before we look at the foreground
+    group_starts = []
+    for axis, (lo, hi) in enumerate(ranges):
+        change = np.concatenate([[True], (lo[1:] != lo[:-1]) | (hi[1:] != hi[:-1])])
+        starts = np.where(change)[0]
+        mask = np.logical_or.reduceat(mask, starts, axis=axis)
+        group_starts.append(starts)
+
+    foreground = np.nonzero(mask)
+    if len(foreground[0]) == 0:
+        return []
+    los = [lo[starts][fg] for (lo, _), starts, fg in zip(ranges, group_starts, foreground)]
+    his = [hi[starts][fg] for (_, hi), starts, fg in zip(ranges, group_starts, foreground)]
+
+    # a mask voxel can cover more than one block along an axis
+    blocks_per_axis = [(sh + bs - 1) // bs for sh, bs in zip(shape, block_shape)]
+    max_spans = [int((hi - lo).max()) + 1 for lo, hi in zip(los, his)]
+    block_ids = []
+    for offsets in product(*[range(span) for span in max_spans]):
+        coords = [lo + off for lo, off in zip(los, offsets)]
+        valid = np.ones(len(coords[0]), dtype='bool')
+        for coord, hi in zip(coords, his):
+            valid &= coord <= hi
+        block_ids.append(np.ravel_multi_index(tuple(coord[valid] for coord in coords),
+                                              blocks_per_axis))
+    return np.unique(np.concatenate(block_ids)).tolist()
+
+
 def blocks_from_mask(job_id, config_path):
 
     fu.log("start processing job %i" % job_id)
@@ -100,9 +181,31 @@ def blocks_from_mask(job_id, config_path):
 
     mask_path = config['mask_path']
     mask_key = config['mask_key']
-    output_path = config['output_path']
-    output_key = config['output_key']
-
+    shape = config['shape']
+    block_shape = config['block_shape']
+    mask_block_shape = config['mask_block_shape']
+    block_list = config['block_list']
+    tmp_folder = config['tmp_folder']
+    n_threads = config.get('threads_per_job', 1)
+
+    found_blocks = set()
+    with vu.file_reader(mask_path, 'r') as f:
+        ds = f[mask_key]
+        mask_shape = ds.shape
+        blocking = nt.blocking([0] * len(mask_shape), list(mask_shape), mask_block_shape)
+
+        def _find_blocks(mask_block_id):
+            fu.log("start processing block %i" % mask_block_id)
+            mask_bb = vu.block_to_bb(blocking.getBlock(mask_block_id))
+            mask = vu.read_block(ds, mask_bb).astype('bool')
+            found_blocks.update(_blocks_in_mask_block(mask, mask_bb, mask_shape,
+                                                      shape, block_shape))
+            fu.log_block_success(mask_block_id)
+
+        fu.map_blocks(_find_blocks, block_list, n_threads)
+
+    with open(_job_path(tmp_folder, job_id), 'w') as f:
+        json.dump(sorted(found_blocks), f)
     fu.log_job_success(job_id)
 
 
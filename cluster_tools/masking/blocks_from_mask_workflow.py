@@ -1,5 +1,3 @@
-import os
-import json
 import luigi
 
 from ..cluster_tasks import WorkflowBase
@@ -10,22 +8,18 @@ class BlocksFromMaskWorkflow(WorkflowBase):
     mask_path = luigi.Parameter()
     mask_key = luigi.Parameter()
 
-    output_path = luigi.Parameter()
-    output_key_prefix = luigi.Parameter()
-
+    # shape of the volume we compute the block list for
     shape = luigi.ListParameter()
-    effective_scales = luigi.ListParameter()
+    # path to the json with the block list, can be used as `block_list_path`
+    output_path = luigi.Parameter()
 
     def requires(self):
         task = getattr(mask_tasks,
                        self._get_task_name('BlocksFromMask'))
-        dep = self.dependency
-        for scale, scale_factor in enumerate(self.effecive_scales):
-            output_key = self.output_key_prefix + 's%i' % scale
-            dep = task(tmp_folder=self.tmp_folder, max_jobs=self.max_jobs,
-                       config_dir=self.config_dir,
-                       mask_path=self.mask_path, mask_key=self.mask_key,
-                       output_path=self.output_path, output_key=output_key)
+        dep = task(tmp_folder=self.tmp_folder, max_jobs=self.max_jobs,
+                   config_dir=self.config_dir, dependency=self.dependency,
+                   mask_path=self.mask_path, mask_key=self.mask_key,
+                   shape=self.shape, output_path=self.output_path)
         return dep
 
     @staticmethod
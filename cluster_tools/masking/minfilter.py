@@ -157,4 +157,4 @@ if __name__ == '__main__':
     path = sys.argv[1]
     assert os.path.exists(path), path
     job_id = int(os.path.split(path)[1].split('.')[0].split('_')[-1])
-    watershed(job_id, path)
+    minfilter(job_id, path)
@@ -3,6 +3,8 @@ import json
 import luigi
 
 from ..cluster_tasks import WorkflowBase
+from ..utils.task_utils import DummyTask
+from ..utils.volume_utils import file_reader
 from .. import write as write_tasks
 from . import solve_subproblems as subproblem_tasks
 from . import reduce_problem as reduce_tasks
@@ -10,31 +12,164 @@ from . import solve_global as solve_tasks
 from . import sub_solutions as sub_tasks
 
 
+def _hierarchical_tasks(wf, dependency, n_scales, first_scale=0):
+    subproblem_task = getattr(subproblem_tasks,
+                              wf._get_task_name('SolveSubproblems'))
+    reduce_task = getattr(reduce_tasks,
+                          wf._get_task_name('ReduceProblem'))
+    dep = dependency
+    for scale in range(first_scale, n_scales):
+        dep = subproblem_task(tmp_folder=wf.tmp_folder,
+                              max_jobs=wf.max_jobs,
+                              config_dir=wf.config_dir,
+                              problem_path=wf.problem_path,
+                              scale=scale,
+                              dependency=dep)
+        dep = reduce_task(tmp_folder=wf.tmp_folder,
+                          max_jobs=wf.max_jobs,
+                          config_dir=wf.config_dir,
+                          problem_path=wf.problem_path,
+                          scale=scale,
+                          dependency=dep)
+    return dep
+
+
+class MulticutHierarchyLevel(WorkflowBase):
+    """ Level of the hierarchical multicut at `scale`, which requires all previous levels.
+
+    This task is used as dynamic dependency in `MulticutHierarchy`. Luigi re-creates
+    dynamic dependencies from their string parameters, which does not work for `dependency`,
+    so it is not used here and must be done before this task is scheduled.
+    """
+    problem_path = luigi.Parameter()
+    scale = luigi.IntParameter()
+
+    def requires(self):
+        dep = self.clone(scale=self.scale - 1) if self.scale > 0 else DummyTask()
+        return _hierarchical_tasks(self, dep, self.scale + 1, first_scale=self.scale)
+
+
+class MulticutHierarchy(WorkflowBase):
+    """ Run the levels of the hierarchical multicut until the reduced problem is small enough.
+
+    The levels are added at runtime via dynamic dependencies: after each level,
+    we stop if the reduced problem fits into the node and edge budget, if the level
+    has reduced the number of nodes by less than `min_reduction` or after `max_scales` levels.
+    We always run at least one level, because the final tasks need the node labeling
+    that is only written by `ReduceProblem`.
+    The number of levels is written to the output, see `get_n_scales`.
+    """
+    problem_path = luigi.Parameter()
+    max_scales = luigi.IntParameter()
+    # budget for the global problem, 0 means no budget
+    max_nodes = luigi.IntParameter(default=0)
+    max_edges = luigi.IntParameter(default=0)
+    # minimal relative reduction of the number of nodes per level
+    min_reduction = luigi.FloatParameter(default=0.)
+
+    def requires(self):
+        return self.dependency
+
+    def _problem_size(self, scale):
+        with file_reader(self.problem_path, 'r') as f:
+            attrs = f['s%i/graph' % scale].attrs
+            return attrs['numberOfNodes'], attrs['numberOfEdges']
+
+    def _fits_budget(self, n_nodes, n_edges):
+        if self.max_nodes == 0 and self.max_edges == 0:
+            return False
+        return (self.max_nodes == 0 or n_nodes <= self.max_nodes) and\
+            (self.max_edges == 0 or n_edges <= self.max_edges)
+
+    def run(self):
+        assert self.max_scales > 0, "Need at least one level"
+        scale = 0
+        n_nodes, n_edges = self._problem_size(scale)
+        while scale < self.max_scales and (scale == 0 or not self._fits_budget(n_nodes, n_edges)):
+            # luigi runs the level and calls `run` again once it is done,
+            # so the levels that were already done are skipped when we get here the next time
+            yield MulticutHierarchyLevel(tmp_folder=self.tmp_folder,
+                                         max_jobs=self.max_jobs,
+                                         config_dir=self.config_dir,
+                                         target=self.target,
+                                         problem_path=self.problem_path,
+                                         scale=scale)
+            scale += 1
+
+            n_new_nodes, n_edges = self._problem_size(scale)
+            reduction = 1. - float(n_new_nodes) / n_nodes
+            n_nodes = n_new_nodes
+            if reduction < self.min_reduction:
+                break
+
+        with self.output().open('w') as f:
+            json.dump({'n_scales': scale, 'numberOfNodes': n_nodes,
+                       'numberOfEdges': n_edges}, f)
+
+    def get_n_scales(self):
+        with self.output().open('r') as f:
+            return json.load(f)['n_scales']
+
+    def output(self):
+        return luigi.LocalTarget(os.path.join(self.tmp_folder, 'multicut_hierarchy.json'))
+
+
 class MulticutWorkflowBase(WorkflowBase):
     problem_path = luigi.Parameter()
+    # number of levels of the hierarchical solver,
+    # in adaptive mode this is the maximal number of levels, see `MulticutHierarchy`
     n_scales = luigi.IntParameter()
+    adaptive_scales = luigi.BoolParameter(default=False)
+    max_global_nodes = luigi.IntParameter(default=0)
+    max_global_edges = luigi.IntParameter(default=0)
+    min_reduction = luigi.FloatParameter(default=0.)
 
     # tasks for the hierarchical solver solutions
-    def _hierarchical_tasks(self, dependency, n_scales):
-        subproblem_task = getattr(subproblem_tasks,
-                                  self._get_task_name('SolveSubproblems'))
-        reduce_task = getattr(reduce_tasks,
-                              self._get_task_name('ReduceProblem'))
-        dep = dependency
-        for scale in range(n_scales):
-            dep = subproblem_task(tmp_folder=self.tmp_folder,
-                                  max_jobs=self.max_jobs,
-                                  config_dir=self.config_dir,
-                                  problem_path=self.problem_path,
-                                  scale=scale,
-                                  dependency=dep)
-            dep = reduce_task(tmp_folder=self.tmp_folder,
-                              max_jobs=self.max_jobs,
-                              config_dir=self.config_dir,
-                              problem_path=self.problem_path,
-                              scale=scale,
-                              dependency=dep)
-        return dep
+    def _hierarchical_tasks(self, dependency, n_scales, first_scale=0):
+        return _hierarchical_tasks(self, dependency, n_scales, first_scale)
+
+    # the tasks after the hierarchical solver with n_scales levels,
+    # need to be implemented by the workflows
+    def _final_task(self, dependency, n_scales):
+        raise NotImplementedError
+
+    def _hierarchy(self):
+        return MulticutHierarchy(tmp_folder=self.tmp_folder,
+                                 max_jobs=self.max_jobs,
+                                 config_dir=self.config_dir,
+                                 target=self.target,
+                                 dependency=self.dependency,
+                                 problem_path=self.problem_path,
+                                 max_scales=self.n_scales,
+                                 max_nodes=self.max_global_nodes,
+                                 max_edges=self.max_global_edges,
+                                 min_reduction=self.min_reduction)
+
+    # the workflow with the number of levels found by the hierarchy
+    def _fixed_workflow(self, hierarchy):
+        return self.clone(adaptive_scales=False, n_scales=hierarchy.get_n_scales())
+
+    def requires(self):
+        if self.adaptive_scales:
+            return self._hierarchy()
+        # luigi can't re-create `dependency` if this was scheduled as dynamic dependency
+        # by the adaptive workflow, see `_fixed_workflow`; but then it is done already
+        dep = self.dependency if isinstance(self.dependency, luigi.Task) else DummyTask()
+        dep = self._hierarchical_tasks(dep, self.n_scales)
+        return self._final_task(dep, self.n_scales)
+
+    def run(self):
+        if self.adaptive_scales:
+            yield self._fixed_workflow(self.requires())
+
+    def output(self):
+        if not self.adaptive_scales:
+            return super().output()
+        hierarchy = self._hierarchy()
+        # we don't know the final task before the hierarchy has run
+        if not hierarchy.complete():
+            return hierarchy.output()
+        return self._fixed_workflow(hierarchy).output()
 
     @staticmethod
     def get_config():
@@ -47,19 +182,30 @@ class MulticutWorkflowBase(WorkflowBase):
 class MulticutWorkflow(MulticutWorkflowBase):
     assignment_path = luigi.Parameter()
     assignment_key = luigi.Parameter()
+    # solve the sub-problems at the last scale and start the global solver from their solutions
+    warm_start = luigi.BoolParameter(default=False)
 
-    def requires(self):
+    def _final_task(self, dependency, n_scales):
+        if self.warm_start:
+            subproblem_task = getattr(subproblem_tasks,
+                                      self._get_task_name('SolveSubproblems'))
+            dependency = subproblem_task(tmp_folder=self.tmp_folder,
+                                         max_jobs=self.max_jobs,
+                                         config_dir=self.config_dir,
+                                         problem_path=self.problem_path,
+                                         scale=n_scales,
+                                         dependency=dependency)
         solve_task = getattr(solve_tasks,
                              self._get_task_name('SolveGlobal'))
-        dep = self._hierarchical_tasks(self.dependency, self.n_scales)
         t_solve = solve_task(tmp_folder=self.tmp_folder,
                              max_jobs=self.max_jobs,
                              config_dir=self.config_dir,
                              problem_path=self.problem_path,
                              assignment_path=self.assignment_path,
                              assignment_key=self.assignment_key,
-                             scale=self.n_scales,
-                             dependency=dep)
+                             scale=n_scales,
+                             warm_start=self.warm_start,
+                             dependency=dependency)
         return t_solve
 
     @staticmethod
@@ -77,10 +223,11 @@ class SubSolutionsWorkflow(MulticutWorkflowBase):
     roi_begin = luigi.ListParameter(default=None)
     roi_end = luigi.ListParameter(default=None)
 
-    def requires(self):
+    def _final_task(self, dependency, n_scales):
         sub_task = getattr(sub_tasks,
                            self._get_task_name('SubSolutions'))
-        dep = self._hierarchical_tasks(self.dependency, self.n_scales + 1)
+        # we need the sub-problem results at the last scale
+        dep = self._hierarchical_tasks(dependency, n_scales + 1, first_scale=n_scales)
         t_sub = sub_task(tmp_folder=self.tmp_folder,
                          max_jobs=self.max_jobs,
                          config_dir=self.config_dir,
@@ -89,7 +236,7 @@ class SubSolutionsWorkflow(MulticutWorkflowBase):
                          ws_key=self.ws_key,
                          output_path=self.output_path,
                          output_key=self.output_key,
-                         scale=self.n_scales,
+                         scale=n_scales,
                          dependency=dep,
                          roi_begin=self.roi_begin,
                          roi_end=self.roi_end)
@@ -108,15 +255,14 @@ class ReducedSolutionWorkflow(MulticutWorkflowBase):
     output_path = luigi.Parameter()
     output_key = luigi.Parameter()
 
-    def requires(self):
+    def _final_task(self, dependency, n_scales):
         write_task = getattr(write_tasks,
                              self._get_task_name('Write'))
-        dep = self._hierarchical_tasks(self.dependency, self.n_scales)
-        assignment_key = 's%i/node_labeling' % self.n_scales
+        assignment_key = 's%i/node_labeling' % n_scales
         return write_task(tmp_folder=self.tmp_folder,
                           max_jobs=self.max_jobs,
                           config_dir=self.config_dir,
-                          dependency=dep,
+                          dependency=dependency,
                           input_path=self.ws_path,
                           input_key=self.ws_key,
                           output_path=self.output_path,
@@ -3,19 +3,17 @@
 import os
 import sys
 import json
-from concurrent import futures
 
 import numpy as np
 import luigi
-import z5py
 
 import nifty.tools as nt
 import nifty.ufd as nufd
 import nifty.distributed as ndist
-from vigra.analysis import relabelConsecutive
 
 import cluster_tools.utils.volume_utils as vu
 import cluster_tools.utils.function_utils as fu
+import cluster_tools.utils.graph_utils as gu
 from cluster_tools.cluster_tasks import SlurmTask, LocalTask, LSFTask
 
 #
@@ -44,7 +42,8 @@ class ReduceProblemBase(luigi.Task):
     def default_task_config():
         # we use this to get also get the common default config
         config = LocalTask.default_task_config()
-        config.update({'accumulation_method': 'sum'})
+        config.update({'accumulation_method': 'sum', 'chunk_size': 262144,
+                       'samples_per_job': 1000})
         return config
 
     def _log_reduction(self):
@@ -58,6 +57,90 @@ class ReduceProblemBase(luigi.Task):
         self._write_log("Reduced graph from %i to %i nodes; %i to %i edges." % (n_nodes, n_new_nodes,
                                                                                 n_edges, n_new_edges))
 
+    def _run_step(self, step, block_list, config, consecutive_blocks=False):
+        config.update({'step': step})
+        prefix = 's%i_%s' % (self.scale, step)
+        n_jobs = min(len(block_list), self.max_jobs)
+        self.prepare_jobs(n_jobs, block_list, config, prefix,
+                          consecutive_blocks=consecutive_blocks)
+        self.submit_jobs(n_jobs, prefix)
+        self.wait_for_jobs(prefix)
+        self.check_jobs(n_jobs, prefix)
+        return n_jobs
+
+    def _reduce_nodes(self, config, shape, block_shape, roi_begin, roi_end, edge_chunks):
+        # collect the cut edges of the sub-problems
+        block_list = vu.blocks_in_volume(shape, block_shape, roi_begin, roi_end)
+        config['n_cut_jobs'] = self._run_step('cut_edges', block_list, config)
+        # merge the nodes of the edges that were not cut for disjoint edge ranges
+        config['n_merge_jobs'] = self._run_step('merge_nodes', edge_chunks, config,
+                                                consecutive_blocks=True)
+        # find the new node labeling in a single job
+        self._run_step('node_labeling', [0], config)
+        node_labeling = np.load(_tmp_path(self.tmp_folder, self.scale, 'node_labeling'),
+                                mmap_mode='r')
+        n_new_nodes = int(node_labeling.max()) + 1
+        self._write_log("have %i nodes in new node labeling" % n_new_nodes)
+        return n_new_nodes
+
+    def _reduce_edges(self, config, n_edges, edge_chunks):
+        # map the edges to the new node labeling for disjoint edge ranges
+        np.lib.format.open_memmap(_tmp_path(self.tmp_folder, self.scale, 'edge_keys'),
+                                  mode='w+', dtype='uint64', shape=(n_edges,))
+        n_map_jobs = self._run_step('map_edges', edge_chunks, config,
+                                    consecutive_blocks=True)
+
+        # split the new edges into ranges with about the same number of edges
+        # and merge them for each range
+        key_paths = [_tmp_path(self.tmp_folder, self.scale, 'keys_job', job_id)
+                     for job_id in range(n_map_jobs)]
+        splits = _find_splits(key_paths, self.max_jobs, config.get('samples_per_job', 1000))
+        range_list = list(range(len(splits) + 1))
+        self._write_log("merge new edges for %i key ranges" % len(range_list))
+        config.update({'n_map_jobs': n_map_jobs, 'splits': splits})
+        self._run_step('merge_edges', range_list, config, consecutive_blocks=True)
+
+        counts = [len(np.load(_tmp_path(self.tmp_folder, self.scale, 'keys_range', range_id),
+                              mmap_mode='r'))
+                  for range_id in range_list]
+        offsets = np.cumsum([0] + counts).tolist()
+        config['offsets'] = offsets
+        return offsets[-1]
+
+    def _write_new_problem(self, config, n_edges, n_new_nodes, n_new_edges, edge_chunks):
+        next_scale = self.scale + 1
+        chunk_size = min(config['chunk_size'], n_new_edges)
+        with vu.file_reader(self.problem_path) as f:
+            ignore_label = f['s%i/graph' % self.scale].attrs['ignoreLabel']
+            g_out = f['s%i' % next_scale]
+            graph_out = g_out.require_group('graph')
+            graph_out.attrs['ignoreLabel'] = ignore_label
+            graph_out.attrs['numberOfNodes'] = n_new_nodes
+            graph_out.attrs['numberOfEdges'] = n_new_edges
+            # NOTE we don not need to serialize the nodes cause they are
+            # consecutive anyway
+            graph_out.require_dataset('edges', shape=(n_new_edges, 2), chunks=(chunk_size, 2),
+                                      compression='gzip', dtype='uint64')
+            g_out.require_dataset('costs', shape=(n_new_edges,), chunks=(chunk_size,),
+                                  compression='gzip', dtype='float32')
+
+        # write the new edges and costs for chunk-aligned rows
+        new_edge_chunks = vu.blocks_in_volume([n_new_edges], [chunk_size])
+        config.update({'n_new_edges': n_new_edges, 'new_chunk_size': chunk_size})
+        self._run_step('write_edges', new_edge_chunks, config, consecutive_blocks=True)
+
+        # write the mapping of old to new edge ids, which is needed to serialize the sub-graphs
+        np.lib.format.open_memmap(_tmp_path(self.tmp_folder, self.scale, 'edge_labeling'),
+                                  mode='w+', dtype='int64', shape=(n_edges,))
+        self._run_step('edge_labeling', edge_chunks, config, consecutive_blocks=True)
+
+    def _serialize_sub_graphs(self, config, shape, block_shape, roi_begin, roi_end):
+        # serialize the sub-graphs and sub-problems of the new blocks
+        new_block_shape = [2 * bs for bs in block_shape]
+        gu.require_sub_problems(self.problem_path, self.scale + 1, new_block_shape)
+        block_list = vu.blocks_in_volume(shape, new_block_shape, roi_begin, roi_end)
+        self._run_step('serialize', block_list, config)
+
     def run_impl(self):
         # get the global config and init configs
         shebang, block_shape, roi_begin, roi_end = self.global_config_values()
@@ -65,31 +148,42 @@ class ReduceProblemBase(luigi.Task):
 
         # load the task config
         config = self.get_task_config()
+        assert config.get('accumulation_method', 'sum') in ACCUMULATORS,\
+            "Invalid accumulation method %s" % config['accumulation_method']
 
         # update the config with input and graph paths and keys
         # as well as block shape
         config.update({'problem_path': self.problem_path, 'scale': self.scale,
-                       'block_shape': block_shape})
+                       'block_shape': block_shape, 'tmp_folder': self.tmp_folder})
         if roi_begin is not None:
             assert roi_end is not None
             config.update({'roi_begin': roi_begin,
                            'roi_end': roi_end})
 
-        with vu.file_reader(self.problem_path, 'r') as f:
+        with vu.file_reader(self.problem_path) as f:
             shape = f.attrs['shape']
+            n_edges = f['s%i/graph' % self.scale].attrs['numberOfEdges']
+            g_out = f.require_group('s%i' % (self.scale + 1))
+            g_out.require_group('sub_graphs')
 
         factor = 2**self.scale
-        block_shape = tuple(bs * factor for bs in block_shape)
-
-        # prime and run the job
-        prefix = 's%i' % self.scale
-        block_list = vu.blocks_in_volume(shape, block_shape, roi_begin, roi_end)
-        self.prepare_jobs(1, block_list, config, prefix)
-        self.submit_jobs(1, prefix)
-
-        # wait till jobs finish and check for job success
-        self.wait_for_jobs()
-        self.check_jobs(1, prefix)
+        block_shape = [bs * factor for bs in block_shape]
+
+        # we reduce the problem in several steps that run in parallel
+        # over blocks or ranges of edges, so that no job needs to hold all the edges:
+        # 1.) merge the nodes of the edges that were not cut in the sub-problems
+        # and find the new node labeling (this is the only step that runs in a single job)
+        # 2.) map the edges to the new nodes and merge the resulting edges
+        # 3.) write the new edges and costs as well as the mapping from old to new edges
+        # 4.) serialize the sub-graphs and sub-problems for the next scale
+        config.update({'n_edges': n_edges, 'chunk_size': config.get('chunk_size', 262144)})
+        edge_chunks = vu.blocks_in_volume([n_edges], [config['chunk_size']])
+        n_new_nodes = self._reduce_nodes(config, shape, block_shape, roi_begin, roi_end,
+                                        edge_chunks)
+        config['n_new_nodes'] = n_new_nodes
+        n_new_edges = self._reduce_edges(config, n_edges, edge_chunks)
+        self._write_new_problem(config, n_edges, n_new_nodes, n_new_edges, edge_chunks)
+        self._serialize_sub_graphs(config, shape, block_shape, roi_begin, roi_end)
 
         # log the problem reduction
         self._log_reduction()
@@ -122,110 +216,252 @@ class ReduceProblemLSF(ReduceProblemBase, LSFTask):
 # Implementation
 #
 
-def _load_cut_edges(problem_path, scale, blocking,
-                    block_list, n_threads):
-    key = 's%i/sub_results/cut_edge_ids' % scale
-    ds = z5py.File(problem_path)[key]
-
-    def load_block_res(block_id):
-        block = blocking.getBlock(block_id)
-        chunk_id = tuple(beg // sh for beg, sh
-                         in zip(block.begin, blocking.blockShape))
-        return ds.read_chunk(chunk_id)
-
-    with futures.ThreadPoolExecutor(n_threads) as tp:
-        tasks = [tp.submit(load_block_res, block_id)
-                 for block_id in block_list]
-        cut_edge_ids = [t.result() for t in tasks]
-        cut_edge_ids = np.concatenate([ids for ids in cut_edge_ids
-                                       if ids is not None])
-
-    return np.unique(cut_edge_ids)
-
-
-def _merge_nodes(problem_path, scale, blocking,
-                 block_list, nodes, uv_ids,
-                 initial_node_labeling, n_threads):
-    # load the cut edge ids
-    n_edges = len(uv_ids)
-    cut_edge_ids = _load_cut_edges(problem_path, scale, blocking,
-                                   block_list, n_threads)
-    assert len(cut_edge_ids) < n_edges, "%i = %i, does not reduce problem" % (len(cut_edge_ids),
-                                                                              n_edges)
-
-    merge_edges = np.ones(n_edges, dtype='bool')
-    merge_edges[cut_edge_ids] = False
-    fu.log('merging %i / %i edges' % (np.sum(merge_edges), n_edges))
-
-    # merge node pairs with ufd
+# accumulate the costs of edges that are merged into the same new edge
+# (for 'mean', we accumulate the sum and divide by the counts when writing the costs)
+ACCUMULATORS = {'sum': np.add, 'mean': np.add, 'min': np.minimum, 'max': np.maximum}
+# key of the edges that are merged, i.e. map to a self-loop in the new graph
+MERGED_EDGE = np.iinfo('uint64').max
+
+
+def _tmp_path(tmp_folder, scale, name, job_id=None):
+    name = 'reduce_problem_s%i_%s' % (scale, name)
+    if job_id is not None:
+        name += '_%i' % job_id
+    return os.path.join(tmp_folder, name + '.npy')
+
+
+def _sorted_range(data, lower, upper):
+    # the slice of the sorted data with values in [lower, upper)
+    begin = 0 if lower is None else int(np.searchsorted(data, lower))
+    end = len(data) if upper is None else int(np.searchsorted(data, upper))
+    return slice(begin, end)
+
+
+def _find_splits(paths, n_ranges, samples_per_job):
+    """ Find the split points of key ranges with about the same number of keys,
+    by sampling the sorted keys of the jobs.
+    """
+    samples = []
+    for path in paths:
+        keys = np.load(path, mmap_mode='r')
+        if len(keys) == 0:
+            continue
+        index = np.linspace(0, len(keys) - 1,
+                            min(len(keys), samples_per_job)).astype('int64')
+        samples.append(np.array(keys[index]))
+    if len(samples) == 0:
+        return []
+    samples = np.unique(np.concatenate(samples))
+    index = np.linspace(0, len(samples), n_ranges + 1)[1:-1].astype('int64')
+    return [int(split) for split in np.unique(samples[index])]
+
+
+def _accumulate(keys, values, accumulation_method):
+    """ Sort the edge keys and accumulate the values of duplicate keys.
+
+    The values hold the costs in the first and the counts in the second column.
+    """
+    order = np.argsort(keys, kind='stable')
+    keys, values = keys[order], values[order]
+    if len(keys) == 0:
+        return keys, values
+    starts = np.where(np.concatenate([[True], keys[1:] != keys[:-1]]))[0]
+    costs = ACCUMULATORS[accumulation_method].reduceat(values[:, 0], starts)
+    counts = np.add.reduceat(values[:, 1], starts)
+    return keys[starts], np.concatenate([costs[:, None], counts[:, None]], axis=1)
+
+
+def _edge_range(block_list, n_edges, chunk_size):
+    # assert that the chunk list is consecutive
+    diff_list = np.diff(block_list)
+    assert (diff_list == 1).all()
+    blocking = nt.blocking([0], [n_edges], [chunk_size])
+    return blocking.getBlock(block_list[0]).begin[0], blocking.getBlock(block_list[-1]).end[0]
+
+
+def _merge_nodes(problem_path, scale, tmp_folder, n_cut_jobs, begin, end):
+    # load the cut edges in our edge range from the (sorted) cut edges of all jobs
+    cut_edge_ids = []
+    for job_id in range(n_cut_jobs):
+        ids = np.load(_tmp_path(tmp_folder, scale, 'cut_edges_job', job_id), mmap_mode='r')
+        cut_edge_ids.append(np.array(ids[_sorted_range(ids, begin, end)]))
+    cut_edge_ids = np.concatenate(cut_edge_ids).astype('int64')
+
+    merge_edges = np.ones(end - begin, dtype='bool')
+    merge_edges[cut_edge_ids - begin] = False
+    fu.log('merging %i / %i edges' % (np.sum(merge_edges), end - begin))
+
+    with vu.file_reader(problem_path, 'r') as f:
+        uv_ids = f['s%i/graph/edges' % scale][begin:end, :]
+    uv_ids = uv_ids[merge_edges]
+
+    # merge node pairs with ufd and keep the equivalences of the merged nodes,
+    # they are combined for all edge ranges to get the global node labeling
+    if len(uv_ids) == 0:
+        return np.zeros((0, 2), dtype='uint64')
+    nodes = np.unique(uv_ids)
     ufd = nufd.boost_ufd(nodes)
-    ufd.merge(uv_ids[merge_edges])
-
-    # get the node results and label them consecutively
-    node_labeling = ufd.find(nodes)
-    node_labeling, max_new_id, _ = relabelConsecutive(node_labeling, start_label=0, keep_zeros=False)
-    assert node_labeling[0] == 0
-    # FIXME this looks fishy, redo !!!
-    # # make sure that zero is still mapped to zero
-    # if node_labeling[0] != 0:
-    #     # if it isn't, swap labels accordingly
-    #     zero_label = node_labeling[0]
-    #     to_relabel = node_labeling == 0
-    #     node_labeling[node_labeling == zero_label] = 0
-    #     node_labeling[to_relabel] = zero_laebl
-    n_new_nodes = max_new_id + 1
-    fu.log("have %i nodes in new node labeling" % n_new_nodes)
-
-    # get the labeling of initial nodes
-    if initial_node_labeling is None:
-        # if we don't have an initial node labeling, we are in the first scale.
-        # here, the graph nodes might not be consecutive / not start at zero.
-        # to keep the node labeling valid, we must make the labeling consecutive by inserting zeros
-        fu.log("don't have an initial node labeling")
-
-        # check if `nodes` are consecutive and start at zero
-        node_max_id = int(nodes.max())
-        if node_max_id + 1 != len(nodes):
-            fu.log("nodes are not consecutve and/or don't start at zero")
-            fu.log("inflating node labels accordingly")
-            node_labeling = nt.inflateLabeling(nodes, node_labeling, node_max_id)
-
-        new_initial_node_labeling = node_labeling
-    else:
+    ufd.merge(uv_ids)
+    roots = ufd.find(nodes)
+    merged = nodes != roots
+    return np.concatenate([nodes[merged][:, None], roots[merged][:, None]], axis=1)
+
+
+def _find_node_labeling(problem_path, scale, tmp_folder, n_merge_jobs, n_threads):
+    with vu.file_reader(problem_path, 'r') as f:
+        group = f['s%i/graph' % scale]
+        # we only need to load the nodes for scale 0
+        # otherwise, we already know that they are consecutive
+        if scale == 0:
+            ds = group['nodes']
+            ds.n_threads = n_threads
+            nodes = ds[:]
+        else:
+            nodes = np.arange(group.attrs['numberOfNodes'], dtype='uint64')
+
+    # merge the node equivalences of all edge ranges with ufd
+    equivalences = np.concatenate([np.load(_tmp_path(tmp_folder, scale, 'merge_job', job_id))
+                                   for job_id in range(n_merge_jobs)], axis=0)
+    assert len(equivalences) > 0, "No edges are merged, does not reduce problem"
+    ufd = nufd.boost_ufd(nodes)
+    ufd.merge(equivalences)
+
+    # get the node results and label them consecutively,
+    # making sure that the first node (which is the ignore label, if we have it) is mapped to zero
+    _, node_labeling = np.unique(ufd.find(nodes), return_inverse=True)
+    first_label = node_labeling[0]
+    is_first = node_labeling == first_label
+    node_labeling[node_labeling < first_label] += 1
+    node_labeling[is_first] = 0
+    node_labeling = node_labeling.astype('uint64')
+
+    # at scale 0, the graph nodes might not be consecutive / not start at zero.
+    # to keep the node labeling valid, we must make the labeling consecutive by inserting zeros
+    node_max_id = int(nodes.max())
+    if node_max_id + 1 != len(nodes):
+        fu.log("nodes are not consecutve and/or don't start at zero")
+        fu.log("inflating node labels accordingly")
+        node_labeling = nt.inflateLabeling(nodes, node_labeling, node_max_id)
+    return node_labeling
+
+
+def _write_initial_node_labeling(problem_path, scale, node_labeling, n_threads):
+    # map the labeling of the initial (= scale 0) nodes to the new node labeling
+    with vu.file_reader(problem_path) as f:
+        key = 's%i/node_labeling' % (scale + 1)
+        if scale == 0:
+            fu.log("don't have an initial node labeling")
+            ds_out = f.require_dataset(key, shape=node_labeling.shape, dtype='uint64',
+                                       chunks=(min(len(node_labeling), 262144),),
+                                       compression='gzip')
+            ds_out.n_threads = n_threads
+            ds_out[:] = node_labeling
+            return
+
         fu.log("mapping new node labeling to labeling of inital (= scale 0) nodes")
+        ds_in = f['s%i/node_labeling' % scale]
+        ds_out = f.require_dataset(key, shape=ds_in.shape, chunks=ds_in.chunks,
+                                   dtype='uint64', compression='gzip')
+        ds_in.n_threads = n_threads
+        ds_out.n_threads = n_threads
         # NOTE access like this is ok because all node labelings will be consecutive
-        new_initial_node_labeling = node_labeling[initial_node_labeling]
-        assert len(new_initial_node_labeling) == len(initial_node_labeling)
+        chunk_size = ds_in.chunks[0]
+        for begin in range(0, ds_in.shape[0], chunk_size):
+            end = min(begin + chunk_size, ds_in.shape[0])
+            ds_out[begin:end] = node_labeling[ds_in[begin:end]]
+
+
+def _map_edges(problem_path, scale, tmp_folder, n_new_nodes, accumulation_method,
+               begin, end):
+    with vu.file_reader(problem_path, 'r') as f:
+        uv_ids = f['s%i/graph/edges' % scale][begin:end, :]
+        costs = f['s%i/costs' % scale][begin:end]
+    assert len(costs) == len(uv_ids), "%i, %i" % (len(costs), len(uv_ids))
+
+    node_labeling = np.load(_tmp_path(tmp_folder, scale, 'node_labeling'), mmap_mode='r')
+    new_uv_ids = np.sort(node_labeling[uv_ids], axis=1)
+
+    # encode the new edges as keys and mark the edges that were merged
+    keys = new_uv_ids[:, 0] * np.uint64(n_new_nodes) + new_uv_ids[:, 1]
+    keys[new_uv_ids[:, 0] == new_uv_ids[:, 1]] = MERGED_EDGE
+    edge_keys = np.load(_tmp_path(tmp_folder, scale, 'edge_keys'), mmap_mode='r+')
+    edge_keys[begin:end] = keys
+    edge_keys.flush()
+
+    valid = keys != MERGED_EDGE
+    values = np.ones((int(valid.sum()), 2), dtype='float64')
+    values[:, 0] = costs[valid]
+    return _accumulate(keys[valid], values, accumulation_method)
+
+
+def _merge_edge_range(tmp_folder, scale, n_map_jobs, splits, range_id, accumulation_method):
+    fu.log("start processing block %i" % range_id)
+    lower = np.uint64(splits[range_id - 1]) if range_id > 0 else None
+    upper = np.uint64(splits[range_id]) if range_id < len(splits) else None
+
+    # the keys of the jobs are sorted, so we can load only the edges in our range
+    keys, values = [], []
+    for job_id in range(n_map_jobs):
+        job_keys = np.load(_tmp_path(tmp_folder, scale, 'keys_job', job_id), mmap_mode='r')
+        job_values = np.load(_tmp_path(tmp_folder, scale, 'values_job', job_id), mmap_mode='r')
+        bb = _sorted_range(job_keys, lower, upper)
+        keys.append(np.array(job_keys[bb]))
+        values.append(np.array(job_values[bb]))
+    keys, values = _accumulate(np.concatenate(keys), np.concatenate(values, axis=0),
+                               accumulation_method)
+    np.save(_tmp_path(tmp_folder, scale, 'keys_range', range_id), keys)
+    np.save(_tmp_path(tmp_folder, scale, 'values_range', range_id), values)
+    fu.log_block_success(range_id)
+
+
+def _write_edges(problem_path, scale, tmp_folder, offsets, n_new_nodes, accumulation_method,
+                 begin, end):
+    # load the new edges of all ranges that overlap with the rows [begin, end)
+    keys, values = [], []
+    for range_id, (range_begin, range_end) in enumerate(zip(offsets[:-1], offsets[1:])):
+        if range_end <= begin or range_begin >= end:
+            continue
+        bb = slice(max(begin - range_begin, 0), end - range_begin)
+        keys.append(np.load(_tmp_path(tmp_folder, scale, 'keys_range', range_id),
+                            mmap_mode='r')[bb])
+        values.append(np.load(_tmp_path(tmp_folder, scale, 'values_range', range_id),
+                              mmap_mode='r')[bb])
+    keys = np.concatenate(keys)
+    values = np.concatenate(values, axis=0)
+    assert len(keys) == end - begin
+
+    uv_ids = np.concatenate([(keys // np.uint64(n_new_nodes))[:, None],
+                             (keys % np.uint64(n_new_nodes))[:, None]], axis=1)
+    costs = values[:, 0] / values[:, 1] if accumulation_method == 'mean' else values[:, 0]
 
-    return n_new_nodes, node_labeling, new_initial_node_labeling
+    with vu.file_reader(problem_path) as f:
+        g_out = f['s%i' % (scale + 1)]
+        g_out['graph/edges'][begin:end, :] = uv_ids
+        g_out['costs'][begin:end] = costs.astype('float32')
 
 
-def _get_new_edges(uv_ids, node_labeling, costs, accumulation_method, n_threads):
-    edge_mapping = nt.EdgeMapping(uv_ids, node_labeling, numberOfThreads=n_threads)
-    new_uv_ids = edge_mapping.newUvIds()
-    edge_labeling = edge_mapping.edgeMapping()
-    new_costs = edge_mapping.mapEdgeValues(costs, accumulation_method,
-                                           numberOfThreads=n_threads)
-    assert new_uv_ids.max() == node_labeling.max(), "%i, %i" % (new_uv_ids.max(),
-                                                                node_labeling.max())
-    assert len(new_uv_ids) == len(new_costs)
-    assert len(edge_labeling) == len(uv_ids)
+def _write_edge_labeling(tmp_folder, scale, splits, offsets, begin, end):
+    keys = np.array(np.load(_tmp_path(tmp_folder, scale, 'edge_keys'), mmap_mode='r')[begin:end])
 
-    return new_uv_ids, edge_labeling, new_costs
+    # find the new edge ids in the merged edges of the key ranges,
+    # merged edges are mapped to -1
+    edge_labeling = np.full(len(keys), -1, dtype='int64')
+    valid = keys != MERGED_EDGE
+    range_ids = np.searchsorted(np.array(splits, dtype='uint64'), keys, side='right')
+    for range_id in np.unique(range_ids[valid]):
+        in_range = np.logical_and(valid, range_ids == range_id)
+        range_keys = np.load(_tmp_path(tmp_folder, scale, 'keys_range', range_id),
+                             mmap_mode='r')
+        edge_labeling[in_range] = offsets[range_id] + np.searchsorted(range_keys, keys[in_range])
 
+    out = np.load(_tmp_path(tmp_folder, scale, 'edge_labeling'), mmap_mode='r+')
+    out[begin:end] = edge_labeling
+    out.flush()
 
-def _serialize_new_problem(problem_path,
-                           n_new_nodes, new_uv_ids,
-                           node_labeling, edge_labeling,
-                           new_costs, new_initial_node_labeling,
-                           shape, scale, initial_block_shape,
-                           n_threads, roi_begin, roi_end):
 
+def _serialize_sub_graphs(problem_path, scale, tmp_folder, shape, initial_block_shape,
+                          block_list, n_threads):
     next_scale = scale + 1
-    f_out = z5py.File(problem_path)
-    g_out = f_out.require_group('s%i' % next_scale)
-    g_out.require_group('sub_graphs')
-
     block_in_prefix = os.path.join(problem_path, 's%i' % scale, 'sub_graphs', 'block_')
     block_out_prefix = os.path.join(problem_path, 's%i' % next_scale, 'sub_graphs', 'block_')
 
@@ -235,53 +471,36 @@ def _serialize_new_problem(problem_path,
     new_factor = 2**(scale + 1)
     new_block_shape = [new_factor * bs for bs in initial_block_shape]
 
-    # NOTE we do not need to serialize the sub-edges in the current implementation
-    # of the blockwise multicut workflow, because we always load the full graph
-    # in 'solve_subproblems'
+    node_labeling = np.load(_tmp_path(tmp_folder, scale, 'node_labeling'), mmap_mode='r')
+    edge_labeling = np.load(_tmp_path(tmp_folder, scale, 'edge_labeling'), mmap_mode='r')
+
+    # NOTE we do not need to serialize the sub-edges, because we serialize
+    # the sub-problems of the blocks for 'solve_subproblems' below
 
     # serialize the new sub-graphs
-    block_ids = vu.blocks_in_volume(shape, new_block_shape, roi_begin, roi_end)
     ndist.serializeMergedGraph(graphBlockPrefix=block_in_prefix,
                                shape=shape,
                                blockShape=block_shape,
                                newBlockShape=new_block_shape,
-                               newBlockIds=block_ids,
+                               newBlockIds=block_list,
                                nodeLabeling=node_labeling,
                                edgeLabeling=edge_labeling,
                                graphOutPrefix=block_out_prefix,
                                numberOfThreads=n_threads,
                                serializeEdges=False)
 
-    # serialize the multicut problem for the next scale level
-
-    graph_key = 's%i/graph' % scale
+    # serialize the sub-problems of the new blocks from the sub-problems of this scale,
+    # if they were not serialized, we need to extract them from the new graph
     with vu.file_reader(problem_path, 'r') as f:
-        ignore_label = f[graph_key].attrs['ignoreLabel']
-
-    n_new_edges = len(new_uv_ids)
-    graph_out = g_out.require_group('graph')
-    graph_out.attrs['ignoreLabel'] = ignore_label
-    graph_out.attrs['numberOfNodes'] = n_new_nodes
-    graph_out.attrs['numberOfEdges'] = n_new_edges
-
-    def _serialize(out_group, name, data, dtype='uint64'):
-        ser_chunks = (min(data.shape[0], 262144), 2) if data.ndim == 2 else\
-            (min(data.shape[0], 262144),)
-        ds_ser = out_group.require_dataset(name, dtype=dtype, shape=data.shape,
-                                           chunks=ser_chunks, compression='gzip')
-        ds_ser.n_threads = n_threads
-        ds_ser[:] = data
-
-    # NOTE we don not need to serialize the nodes cause they are
-    # consecutive anyway
-    # _serialize('nodes', np.arange(n_new_nodes).astype('uint64'))
-
-    # serialize the new graph, the node labeling and the new costs
-    _serialize(graph_out, 'edges', new_uv_ids)
-    _serialize(g_out, 'node_labeling', new_initial_node_labeling)
-    _serialize(g_out, 'costs', new_costs, dtype='float32')
-
-    return n_new_edges
+        have_sub_problems = 's%i/sub_problems' % scale in f
+    if have_sub_problems:
+        gu.serialize_merged_sub_problems(problem_path, scale, block_shape, block_list,
+                                         node_labeling, edge_labeling, n_threads)
+    else:
+        fu.log("sub-problems of scale %i were not serialized, extracting them from the graph"
+               % scale)
+        gu.serialize_sub_problems(problem_path, next_scale, new_block_shape,
+                                  block_list, n_threads)
 
 
 def reduce_problem(job_id, config_path):
@@ -292,82 +511,76 @@ def reduce_problem(job_id, config_path):
     # get the config
     with open(config_path) as f:
         config = json.load(f)
+    step = config['step']
+    assert step in ('cut_edges', 'merge_nodes', 'node_labeling', 'map_edges',
+                    'merge_edges', 'write_edges', 'edge_labeling', 'serialize'), step
     problem_path = config['problem_path']
     initial_block_shape = config['block_shape']
     scale = config['scale']
     block_list = config['block_list']
+    tmp_folder = config['tmp_folder']
     accumulation_method = config.get('accumulation_method', 'sum')
     n_threads = config['threads_per_job']
-    roi_begin = config.get('roi_begin', None)
-    roi_end = config.get('roi_end', None)
+    chunk_size = config['chunk_size']
 
-    # get the number of nodes and uv-ids at this scale level
-    # as well as the initial node labeling
-    fu.log("read problem from %s" % problem_path)
-    graph_key = 's%i/graph' % scale
     with vu.file_reader(problem_path, 'r') as f:
         shape = f.attrs['shape']
 
-        # load graph nodes and edges
-        group = f[graph_key]
+    if step == 'cut_edges':
+        block_shape = [bsh * 2**scale for bsh in initial_block_shape]
+        blocking = nt.blocking([0, 0, 0], shape, block_shape)
+        cut_edge_ids = gu.load_cut_edges(problem_path, scale, blocking,
+                                         block_list, n_threads)
+        np.save(_tmp_path(tmp_folder, scale, 'cut_edges_job', job_id), cut_edge_ids)
+        [fu.log_block_success(block_id) for block_id in block_list]
+
+    elif step == 'merge_nodes':
+        begin, end = _edge_range(block_list, config['n_edges'], chunk_size)
+        equivalences = _merge_nodes(problem_path, scale, tmp_folder,
+                                    config['n_cut_jobs'], begin, end)
+        np.save(_tmp_path(tmp_folder, scale, 'merge_job', job_id), equivalences)
+        [fu.log_block_success(block_id) for block_id in block_list]
+
+    elif step == 'node_labeling':
+        fu.log("merge nodes")
+        node_labeling = _find_node_labeling(problem_path, scale, tmp_folder,
+                                            config['n_merge_jobs'], n_threads)
+        np.save(_tmp_path(tmp_folder, scale, 'node_labeling'), node_labeling)
+        _write_initial_node_labeling(problem_path, scale, node_labeling, n_threads)
+        [fu.log_block_success(block_id) for block_id in block_list]
+
+    elif step == 'map_edges':
+        fu.log("get new edge ids")
+        begin, end = _edge_range(block_list, config['n_edges'], chunk_size)
+        keys, values = _map_edges(problem_path, scale, tmp_folder, config['n_new_nodes'],
+                                  accumulation_method, begin, end)
+        np.save(_tmp_path(tmp_folder, scale, 'keys_job', job_id), keys)
+        np.save(_tmp_path(tmp_folder, scale, 'values_job', job_id), values)
+        [fu.log_block_success(block_id) for block_id in block_list]
+
+    elif step == 'merge_edges':
+        for range_id in block_list:
+            _merge_edge_range(tmp_folder, scale, config['n_map_jobs'], config['splits'],
+                              range_id, accumulation_method)
+
+    elif step == 'write_edges':
+        fu.log("serialize new problem to %s/s%i" % (problem_path, scale + 1))
+        begin, end = _edge_range(block_list, config['n_new_edges'], config['new_chunk_size'])
+        _write_edges(problem_path, scale, tmp_folder, config['offsets'],
+                     config['n_new_nodes'], accumulation_method, begin, end)
+        [fu.log_block_success(block_id) for block_id in block_list]
+
+    elif step == 'edge_labeling':
+        begin, end = _edge_range(block_list, config['n_edges'], chunk_size)
+        _write_edge_labeling(tmp_folder, scale, config['splits'], config['offsets'],
+                             begin, end)
+        [fu.log_block_success(block_id) for block_id in block_list]
 
-        # nodes
-        # we only need to load the nodes for scale 0
-        # otherwise, we already know that they are consecutive
-        if scale == 0:
-            ds = group['nodes']
-            ds.n_threads = n_threads
-            nodes = ds[:]
-            n_nodes = len(nodes)
-        else:
-            n_nodes = group.attrs['numberOfNodes']
-            nodes = np.arange(n_nodes, dtype='uint64')
-
-        # edges
-        ds = group['edges']
-        ds.n_threads = n_threads
-        uv_ids = ds[:]
-        n_edges = len(uv_ids)
-
-        # read initial node labeling
-        if scale == 0:
-            initial_node_labeling = None
-        else:
-            ds = f['s%i/node_labeling' % scale]
-            ds.n_threads = n_threads
-            initial_node_labeling = ds[:]
+    else:
+        _serialize_sub_graphs(problem_path, scale, tmp_folder, shape, initial_block_shape,
+                              block_list, n_threads)
+        [fu.log_block_success(block_id) for block_id in block_list]
 
-    costs_key = 's%i/costs' % scale
-    with vu.file_reader(problem_path) as f:
-        ds = f[costs_key]
-        ds.n_threads = n_threads
-        costs = ds[:]
-    assert len(costs) == n_edges, "%i, %i" (len(costs), n_edges)
-
-    block_shape = [bsh * 2**scale for bsh in initial_block_shape]
-    blocking = nt.blocking([0, 0, 0], shape, block_shape)
-
-    # get the new node assignment
-    fu.log("merge nodes")
-    n_new_nodes, node_labeling, new_initial_node_labeling = _merge_nodes(problem_path, scale, blocking,
-                                                                         block_list, nodes, uv_ids,
-                                                                         initial_node_labeling, n_threads)
-    # get the new edge assignment
-    fu.log("get new edge ids")
-    new_uv_ids, edge_labeling, new_costs = _get_new_edges(uv_ids, node_labeling,
-                                                          costs, accumulation_method, n_threads)
-
-    # serialize the input graph and costs for the next scale level
-    fu.log("serialize new problem to %s/s%i" % (problem_path, scale + 1))
-    n_new_edges = _serialize_new_problem(problem_path,
-                                         n_new_nodes, new_uv_ids,
-                                         node_labeling, edge_labeling,
-                                         new_costs, new_initial_node_labeling,
-                                         shape, scale, initial_block_shape,
-                                         n_threads, roi_begin, roi_end)
-
-    fu.log("Reduced graph from %i to %i nodes; %i to %i edges." % (n_nodes, n_new_nodes,
-                                                                   n_edges, n_new_edges))
     fu.log_job_success(job_id)
 
 
@@ -3,14 +3,18 @@
 import os
 import sys
 import json
+from functools import partial
 
 import numpy as np
 import luigi
 import nifty
+import nifty.tools as nt
+import nifty.ufd as nufd
 
 import cluster_tools.utils.volume_utils as vu
 import cluster_tools.utils.function_utils as fu
 import cluster_tools.utils.segmentation_utils as su
+import cluster_tools.utils.graph_utils as gu
 from cluster_tools.cluster_tasks import SlurmTask, LocalTask, LSFTask
 
 #
@@ -31,6 +35,8 @@ class SolveGlobalBase(luigi.Task):
     assignment_path = luigi.Parameter()
     assignment_key = luigi.Parameter()
     scale = luigi.IntParameter()
+    # start from the sub-problem solutions at this scale, see `MulticutWorkflow`
+    warm_start = luigi.BoolParameter(default=False)
     #
     dependency = luigi.TaskParameter()
 
@@ -41,7 +47,10 @@ class SolveGlobalBase(luigi.Task):
     def default_task_config():
         # we use this to get also get the common default config
         config = LocalTask.default_task_config()
+        # 'agglomerator_kwargs' are passed to the agglomerator, e.g. the settings for 'fusion-moves';
+        # the agglomerator uses 'threads_per_job' threads
         config.update({'agglomerator': 'kernighan-lin',
+                       'agglomerator_kwargs': {},
                        'time_limit_solver': None})
         return config
 
@@ -56,7 +65,12 @@ class SolveGlobalBase(luigi.Task):
         # update the config with input and graph paths and keys
         # as well as block shape
         config.update({'assignment_path': self.assignment_path, 'assignment_key': self.assignment_key,
-                       'scale': self.scale, 'problem_path': self.problem_path})
+                       'scale': self.scale, 'problem_path': self.problem_path,
+                       'block_shape': block_shape, 'warm_start': self.warm_start})
+        if roi_begin is not None:
+            assert roi_end is not None
+            config.update({'roi_begin': roi_begin,
+                           'roi_end': roi_end})
 
         # prime and run the job
         prefix = 's%i' % self.scale
@@ -96,6 +110,32 @@ class SolveGlobalLSF(SolveGlobalBase, LSFTask):
 #
 
 
+def _warmstart_labels(problem_path, scale, initial_block_shape, roi_begin, roi_end,
+                      n_nodes, uv_ids, n_threads):
+    # the sub-problems at this scale are solved if the workflow runs with warm start,
+    # see `MulticutWorkflow`
+    with vu.file_reader(problem_path, 'r') as f:
+        shape = f.attrs['shape']
+        have_results = 's%i/sub_results/cut_edge_ids' % scale in f
+    assert have_results, "Need the sub-problem results at scale %i for warm start" % scale
+
+    # merge the nodes of all edges that are not cut in the sub-problem solutions,
+    # like in 'reduce_problem'
+    block_shape = [bsh * 2**scale for bsh in initial_block_shape]
+    blocking = nt.blocking([0, 0, 0], shape, block_shape)
+    block_list = vu.blocks_in_volume(shape, block_shape, roi_begin, roi_end)
+    cut_edge_ids = gu.load_cut_edges(problem_path, scale, blocking, block_list, n_threads)
+    merge_edges = np.ones(len(uv_ids), dtype='bool')
+    merge_edges[cut_edge_ids] = False
+
+    ufd = nufd.ufd(n_nodes)
+    ufd.merge(uv_ids[merge_edges])
+    node_labels = ufd.elementLabeling()
+    fu.log("warm start from sub-problem solutions with %i / %i nodes" % (len(np.unique(node_labels)),
+                                                                         n_nodes))
+    return node_labels
+
+
 def solve_global(job_id, config_path):
 
     fu.log("start processing job %i" % job_id)
@@ -114,8 +154,10 @@ def solve_global(job_id, config_path):
     n_threads = config['threads_per_job']
     time_limit = config.get('time_limit_solver', None)
 
+    agglomerator_kwargs = config.get('agglomerator_kwargs', {})
+
     fu.log("using agglomerator %s" % agglomerator_key)
-    agglomerator = su.key_to_agglomerator(agglomerator_key)
+    agglomerator = su.key_to_agglomerator(agglomerator_key, **agglomerator_kwargs)
 
     # TODO this should come from input variable
     with vu.file_reader(problem_path) as f:
@@ -136,10 +178,22 @@ def solve_global(job_id, config_path):
         ds = group['costs']
         ds.n_threads = n_threads
         costs = ds[:]
-        assert len(costs) == n_edges, "%i, %i" (len(costs), n_edges)
+        assert len(costs) == n_edges, "%i, %i" % (len(costs), n_edges)
 
     graph = nifty.graph.undirectedGraph(n_nodes)
     graph.insertEdges(uv_ids)
+
+    # start from the solutions of the sub-problems, if the agglomerator supports it
+    if config.get('warm_start', False):
+        if agglomerator_key in su.WARMSTART_AGGLOMERATORS:
+            node_labels = _warmstart_labels(problem_path, scale, config['block_shape'],
+                                            config.get('roi_begin', None),
+                                            config.get('roi_end', None),
+                                            n_nodes, uv_ids, n_threads)
+            agglomerator = partial(agglomerator, node_labels=node_labels)
+        else:
+            fu.log("agglomerator %s does not support warm start" % agglomerator_key)
+
     fu.log("start agglomeration")
     node_labeling = agglomerator(graph, costs,
                                  n_threads=n_threads,
@@ -16,6 +16,7 @@ import nifty.distributed as ndist
 import cluster_tools.utils.volume_utils as vu
 import cluster_tools.utils.function_utils as fu
 import cluster_tools.utils.segmentation_utils as su
+import cluster_tools.utils.graph_utils as gu
 from cluster_tools.cluster_tasks import SlurmTask, LocalTask, LSFTask
 
 
@@ -125,11 +126,7 @@ class SolveSubproblemsLSF(SolveSubproblemsBase, LSFTask):
 #
 
 
-def _solve_block_problem(block_id, graph, uv_ids, block_prefix,
-                         costs, agglomerator, ignore_label,
-                         blocking, out, time_limit):
-    fu.log("Start processing block %i" % block_id)
-
+def _load_block_problem(block_id, graph, uv_ids, block_prefix, ignore_label):
     # load the nodes in this sub-block and map them
     # to our current node-labeling
     block_path = block_prefix + str(block_id)
@@ -137,25 +134,40 @@ def _solve_block_problem(block_id, graph, uv_ids, block_prefix,
     nodes = ndist.loadNodes(block_path)
     # if we have an ignore label, remove zero from the nodes
     # (nodes are sorted, so it will always be at pos 0)
-    if ignore_label and nodes[0] == 0:
-        nodes = nodes[1:]
-        removed_ignore_label = True
-        if len(nodes) == 0:
-            fu.log_block_success(block_id)
-            return
-    else:
-        removed_ignore_label = False
+    sub_nodes = nodes[1:] if ignore_label and nodes[0] == 0 else nodes
+    if len(sub_nodes) == 0:
+        return nodes, None, None, None
 
     # we allow for invalid nodes here,
     # which can occur for un-connected graphs resulting from bad masks ...
-    inner_edges, outer_edges = graph.extractSubgraphFromNodes(nodes, allowInvalidNodes=True)
+    inner_edges, outer_edges = graph.extractSubgraphFromNodes(sub_nodes, allowInvalidNodes=True)
+    # map the uv-ids to the position of the (sorted) nodes for more efficient processing
+    sub_uvs = np.searchsorted(sub_nodes, uv_ids[inner_edges])
+    return nodes, inner_edges, outer_edges, sub_uvs
+
+
+def _solve_block_problem(block_id, load_problem, load_costs, ignore_label,
+                         agglomerator, blocking, out, time_limit):
+    fu.log("Start processing block %i" % block_id)
+
+    # load the nodes of this block, the inner and outer edges
+    # and the uv-ids of the inner edges in local node ids
+    nodes, inner_edges, outer_edges, sub_uvs = load_problem(block_id)
+    # if we have an ignore label, remove zero from the nodes
+    # (nodes are sorted, so it will always be at pos 0)
+    removed_ignore_label = bool(ignore_label and len(nodes) > 0 and nodes[0] == 0)
+    if removed_ignore_label:
+        nodes = nodes[1:]
+    if len(nodes) == 0:
+        fu.log_block_success(block_id)
+        return
 
     # if we only have no inner edges, return
     # the outer edges as cut edges
     if len(inner_edges) == 0:
         if len(nodes) > 1:
             assert removed_ignore_label,\
-			    "Can only have trivial sub-graphs for more than one node if we removed ignore label"
+                "Can only have trivial sub-graphs for more than one node if we removed ignore label"
         cut_edge_ids = outer_edges
         sub_result = None
         fu.log("Block %i: has no inner edges" % block_id)
@@ -164,17 +176,11 @@ def _solve_block_problem(block_id, graph, uv_ids, block_prefix,
         fu.log("Block %i: Solving sub-block with %i nodes and %i edges" % (block_id,
                                                                            len(nodes),
                                                                            len(inner_edges)))
-        sub_uvs = uv_ids[inner_edges]
-        # relabel the sub-nodes and associated uv-ids for more efficient processing
-        nodes_relabeled, max_id, mapping = vigra.analysis.relabelConsecutive(nodes,
-                                                                             start_label=0,
-                                                                             keep_zeros=False)
-        sub_uvs = nt.takeDict(mapping, sub_uvs)
-        n_local_nodes = max_id + 1
+        n_local_nodes = len(nodes)
         sub_graph = nifty.graph.undirectedGraph(n_local_nodes)
         sub_graph.insertEdges(sub_uvs)
 
-        sub_costs = costs[inner_edges]
+        sub_costs = load_costs(inner_edges)
         assert len(sub_costs) == sub_graph.numberOfEdges
 
         # solve multicut and relabel the result
@@ -234,19 +240,7 @@ def solve_subproblems(job_id, config_path):
     problem = z5py.N5File(problem_path)
     shape = problem.attrs['shape']
 
-    # load the costs
-    costs_key = 's%i/costs' % scale
-    fu.log("reading costs from path in problem: %s" % costs_key)
-    ds = problem[costs_key]
-    ds.n_threads = n_threads
-    costs = ds[:]
-
-    # load the graph
     graph_key = 's%i/graph' % scale
-    fu.log("reading graph from path in problem: %s" % graph_key)
-    graph = ndist.Graph(os.path.join(problem_path, graph_key),
-                        numberOfThreads=n_threads)
-    uv_ids = graph.uvIds()
     # check if the problem has an ignore-label
     ignore_label = problem[graph_key].attrs['ignoreLabel']
     fu.log("ignore label is %s" % ('true' if ignore_label else 'false'))
@@ -256,18 +250,49 @@ def solve_subproblems(job_id, config_path):
 
     # the output group
     out = problem['s%i/sub_results' % scale]
-
-    # TODO this should be a n5 varlen dataset as well and
-    # then this is just another dataset in problem path
-    block_prefix = os.path.join(problem_path, 's%i' % scale,
-                                'sub_graphs', 'block_')
     blocking = nt.blocking([0, 0, 0], shape, list(block_shape))
 
+    costs_key = 's%i/costs' % scale
+    ds_costs = problem[costs_key]
+    ds_costs.n_threads = n_threads
+
+    sub_problem_key = 's%i/sub_problems' % scale
+    if sub_problem_key in problem:
+        # we only need to load the sub-problems and costs of our blocks
+        fu.log("reading sub-problems from path in problem: %s" % sub_problem_key)
+        sub_problems = problem[sub_problem_key]
+
+        def load_problem(block_id):
+            return gu.load_sub_problem(sub_problems, blocking, block_id)
+
+        def load_costs(edge_ids):
+            return gu.read_edge_values(ds_costs, edge_ids)
+
+    else:
+        # the sub-problems were not serialized, so we need to load the whole graph and costs
+        fu.log("reading costs from path in problem: %s" % costs_key)
+        costs = ds_costs[:]
+
+        fu.log("reading graph from path in problem: %s" % graph_key)
+        graph = ndist.Graph(os.path.join(problem_path, graph_key),
+                            numberOfThreads=n_threads)
+        uv_ids = graph.uvIds()
+
+        # TODO this should be a n5 varlen dataset as well and
+        # then this is just another dataset in problem path
+        block_prefix = os.path.join(problem_path, 's%i' % scale,
+                                    'sub_graphs', 'block_')
+
+        def load_problem(block_id):
+            return _load_block_problem(block_id, graph, uv_ids, block_prefix, ignore_label)
+
+        def load_costs(edge_ids):
+            return costs[edge_ids]
+
     with futures.ThreadPoolExecutor(n_threads) as tp:
         tasks = [tp.submit(_solve_block_problem,
-                           block_id, graph, uv_ids, block_prefix,
-                           costs, agglomerator, ignore_label,
-                           blocking, out, time_limit)
+                           block_id, load_problem, load_costs, ignore_label,
+                           agglomerator, blocking, out, time_limit)
                  for block_id in block_list]
         [t.result() for t in tasks]
 
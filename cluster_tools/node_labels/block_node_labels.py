@@ -24,6 +24,7 @@ class BlockNodeLabelsBase(luigi.Task):
 
     task_name = 'block_node_labels'
     src_file = os.path.abspath(__file__)
+    allow_block_queue = True
 
     ws_path = luigi.Parameter()
     ws_key = luigi.Parameter()
@@ -145,7 +146,6 @@ def block_node_labels(job_id, config_path):
     output_key = config['output_key']
 
     block_shape = config['block_shape']
-    block_list = config['block_list']
 
     with vu.file_reader(ws_path, 'r') as f:
         shape = f[ws_key].shape
@@ -161,8 +161,8 @@ def block_node_labels(job_id, config_path):
     # label shape is smaller than ws shape
     # -> interpolated
     if all(lsh < sh for lsh, sh in zip(lab_shape, shape)):
-        labels = InterpolatedVolume(ds_labels[:], shape)
-        f_lab.close()
+        # the blocks don't overlap, so caching the upsampled tiles does not help
+        labels = InterpolatedVolume(ds_labels, shape, cache_size=0)
     else:
         assert lab_shape == shape
         labels = ds_labels
@@ -172,7 +172,8 @@ def block_node_labels(job_id, config_path):
         out_path = os.path.join(output_path, output_key)
         [_labels_for_block(block_id, blocking,
                            ds_ws, out_path, labels)
-         for block_id in block_list]
+         for block_id in fu.blocks_to_process(job_id, config)]
+    f_lab.close()
     fu.log_job_success(job_id)
 
 
@@ -51,7 +51,9 @@ class BackgroundSizeFilterBase(luigi.Task):
         shape = vu.get_shape(self.input_path, self.input_key)
 
         if self.n_retries == 0:
-            block_list = vu.blocks_in_volume(shape, block_shape, roi_begin, roi_end)
+            # blocks without labels are not changed, so we skip them
+            block_list = vu.blocks_in_volume(shape, block_shape, roi_begin, roi_end,
+                                             occupancy=(self.input_path, self.input_key))
         else:
             block_list = self.block_list
             self.clean_up_for_retry(block_list)
@@ -106,27 +108,31 @@ class BackgroundSizeFilterLSF(BackgroundSizeFilterBase, LSFTask):
 #
 
 
-def apply_block(block_id, blocking, ds_in, ds_out, discard_ids):
-    fu.log("start processing block %i" % block_id)
-    block = blocking.getBlock(block_id)
-    bb = tuple(slice(b, e) for b, e in zip(block.begin, block.end))
-    labels = ds_in[bb]
-
+def apply_block(labels, discard_ids):
     # check if everything is ignore label
     if np.sum(labels) == 0:
-        fu.log_block_success(block_id)
-        return
+        return None
 
     discard_mask = np.in1d(labels, discard_ids).reshape(labels.shape)
     # check if the discard-mask is empty
     if np.sum(discard_mask) == 0:
-        ds_out[bb] = labels
-        fu.log_block_success(block_id)
-        return
+        return labels
 
     labels[discard_mask] = 0
-    ds_out[bb] = labels
-    fu.log_block_success(block_id)
+    return labels
+
+
+def _apply_blocks(blocking, ds_in, ds_out, block_list, discard_ids, config):
+
+    def _bb(block_id):
+        block = blocking.getBlock(block_id)
+        return tuple(slice(b, e) for b, e in zip(block.begin, block.end))
+
+    fu.pipeline_blocks(block_list,
+                       lambda block_id, stats: stats.read(ds_in, _bb(block_id)),
+                       lambda block_id, labels: apply_block(labels, discard_ids),
+                       lambda block_id, labels, stats: stats.write(ds_out, _bb(block_id), labels),
+                       config)
 
 
 def background_size_filter(job_id, config_path):
@@ -160,20 +166,17 @@ def background_size_filter(job_id, config_path):
     if in_place:
         with vu.file_reader(input_path) as f:
             ds = f[input_key]
-            [apply_block(block_id, blocking, ds, ds, discard_ids)
-             for block_id in block_list]
+            _apply_blocks(blocking, ds, ds, block_list, discard_ids, config)
     elif same_file:
         with vu.file_reader(input_path) as f:
             ds_in = f[input_key]
             ds_out = f[output_key]
-            [apply_block(block_id, blocking, ds_in, ds_out, discard_ids)
-             for block_id in block_list]
+            _apply_blocks(blocking, ds_in, ds_out, block_list, discard_ids, config)
     else:
         with vu.file_reader(input_path, 'r') as f_in, vu.file_reader(output_path) as f_out:
             ds_in = f_in[input_key]
             ds_out = f_out[output_key]
-            [apply_block(block_id, blocking, ds_in, ds_out, discard_ids)
-             for block_id in block_list]
+            _apply_blocks(blocking, ds_in, ds_out, block_list, discard_ids, config)
 
     fu.log_job_success(job_id)
 
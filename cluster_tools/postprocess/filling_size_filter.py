@@ -53,7 +53,9 @@ class FillingSizeFilterBase(luigi.Task):
         shape = vu.get_shape(self.input_path, self.input_key)
 
         if self.n_retries == 0:
-            block_list = vu.blocks_in_volume(shape, block_shape, roi_begin, roi_end)
+            # blocks without labels are not changed, so we skip them
+            block_list = vu.blocks_in_volume(shape, block_shape, roi_begin, roi_end,
+                                             occupancy=(self.input_path, self.input_key))
         else:
             block_list = self.block_list
             self.clean_up_for_retry(block_list)
@@ -109,31 +111,47 @@ class FillingSizeFilterLSF(FillingSizeFilterBase, LSFTask):
 #
 
 
-def apply_block(block_id, blocking, ds_hmap, ds_in, ds_out, discard_ids):
-    fu.log("start processing block %i" % block_id)
-    block = blocking.getBlock(block_id)
-    bb = tuple(slice(b, e) for b, e in zip(block.begin, block.end))
-    labels = ds_in[bb]
+def _read_block(bb, ds_hmap, ds_in, stats):
+    labels = stats.read(ds_in, bb)
 
     # check if everything is ignore label
     if np.sum(labels) == 0:
-        fu.log_block_success(block_id)
-        return
+        return None
+
+    # load the hmap to fill the discard ids
+    hmap_bb = (slice(0, 1),) + bb if ds_hmap.ndim == 4 else bb
+    hmap = stats.read(ds_hmap, hmap_bb).squeeze()
+    return labels, hmap
+
+
+def apply_block(data, discard_ids):
+    # check if everything is ignore label
+    if data is None:
+        return None
+    labels, hmap = data
 
     discard_mask = np.in1d(labels, discard_ids).reshape(labels.shape)
     # check if the discard-mask is empty
     if np.sum(discard_mask) == 0:
-        ds_out[bb] = labels
-        fu.log_block_success(block_id)
-        return
+        return labels
 
-    # load the hmap and fill discard ids via watershed
-    hmap_bb = (slice(0, 1),) + bb if ds_hmap.ndim == 4 else hmap_bb
-    hmap = ds_hmap[hmap_bb].squeeze()
+    # fill discard ids via watershed
     labels[discard_mask] = 0
     vigra.analysis.watershedsNew(hmap, seeds=labels, out=labels)
-    ds_out[bb] = labels
-    fu.log_block_success(block_id)
+    return labels
+
+
+def _apply_blocks(blocking, ds_hmap, ds_in, ds_out, block_list, discard_ids, config):
+
+    def _bb(block_id):
+        block = blocking.getBlock(block_id)
+        return tuple(slice(b, e) for b, e in zip(block.begin, block.end))
+
+    fu.pipeline_blocks(block_list,
+                       lambda block_id, stats: _read_block(_bb(block_id), ds_hmap, ds_in, stats),
+                       lambda block_id, data: apply_block(data, discard_ids),
+                       lambda block_id, labels, stats: stats.write(ds_out, _bb(block_id), labels),
+                       config)
 
 
 def filling_size_filter(job_id, config_path):
@@ -170,22 +188,19 @@ def filling_size_filter(job_id, config_path):
         with vu.file_reader(input_path) as f, vu.file_reader(hmap_path, 'r') as f_h:
             ds = f[input_key]
             ds_hmap = f_h[hmap_key]
-            [apply_block(block_id, blocking, ds_hmap, ds, ds, discard_ids)
-             for block_id in block_list]
+            _apply_blocks(blocking, ds_hmap, ds, ds, block_list, discard_ids, config)
     elif same_file:
         with vu.file_reader(input_path) as f, vu.file_reader(hmap_path, 'r') as f_h:
             ds_in = f[input_key]
             ds_out = f[output_key]
             ds_hmap = f_h[hmap_key]
-            [apply_block(block_id, blocking, ds_hmap, ds_in, ds_out, discard_ids)
-             for block_id in block_list]
+            _apply_blocks(blocking, ds_hmap, ds_in, ds_out, block_list, discard_ids, config)
     else:
         with vu.file_reader(input_path, 'r') as f_in, vu.file_reader(output_path) as f_out, vu.file_reader(hmap_path, 'r') as f_h:
             ds_in = f_in[input_key]
             ds_out = f_out[output_key]
             ds_hmap = f_h[hmap_key]
-            [apply_block(block_id, blocking, ds_hmap, ds_in, ds_out, discard_ids)
-             for block_id in block_list]
+            _apply_blocks(blocking, ds_hmap, ds_in, ds_out, block_list, discard_ids, config)
 
     fu.log_job_success(job_id)
 
@@ -3,12 +3,9 @@
 import os
 import sys
 import json
-import pickle
-from concurrent import futures
 
 import luigi
 import numpy as np
-import vigra
 import nifty.tools as nt
 
 import cluster_tools.utils.volume_utils as vu
@@ -30,13 +27,73 @@ class FindLabelingBase(luigi.Task):
 
     input_path = luigi.Parameter()
     input_key = luigi.Parameter()
-    assignment_path = luigi.Parameter() # where to save the assignments
+    # where to save the assignments
+    assignment_path = luigi.Parameter()
+    assignment_key = luigi.Parameter()
     # task that is required before running this task
     dependency = luigi.TaskParameter()
 
     def requires(self):
         return self.dependency
 
+    @staticmethod
+    def default_task_config():
+        # we use this to get also get the common default config
+        config = LocalTask.default_task_config()
+        config.update({'samples_per_job': 1000, 'chunk_size': 524288})
+        return config
+
+    def _merge_ranges(self, config, n_input_jobs):
+        # split the label ids into ranges with about the same number of labels
+        splits = _find_splits(self.tmp_folder, n_input_jobs, self.max_jobs,
+                              config.get('samples_per_job', 1000))
+        range_list = list(range(len(splits) + 1))
+        self._write_log("merge uniques for %i label ranges" % len(range_list))
+
+        config.update({'step': 'merge', 'splits': splits})
+        n_jobs = min(len(range_list), self.max_jobs)
+        self.prepare_jobs(n_jobs, range_list, config, 'merge',
+                          consecutive_blocks=True)
+        self.submit_jobs(n_jobs, 'merge')
+        self.wait_for_jobs('merge')
+        self.check_jobs(n_jobs, 'merge')
+        return range_list
+
+    def _write_assignments(self, config, range_list):
+        # the offsets of the label ranges in the assignment table
+        counts = [len(np.load(_merged_path(self.tmp_folder, range_id), mmap_mode='r'))
+                  for range_id in range_list]
+        offsets = np.cumsum([0] + counts).tolist()
+        n_labels = offsets[-1]
+        assert n_labels > 0, "No labels found"
+        # we keep zero, if it is in the labels
+        first_label = next(np.load(_merged_path(self.tmp_folder, range_id), mmap_mode='r')[0]
+                           for range_id, count in zip(range_list, counts) if count > 0)
+        start_label = 0 if first_label == 0 else 1
+        self._write_log("found %i labels" % n_labels)
+
+        chunk_size = min(config.pop('chunk_size', 524288), n_labels)
+        with vu.file_reader(self.assignment_path) as f:
+            f.require_dataset(self.assignment_key, dtype='uint64', shape=(n_labels, 2),
+                              chunks=(chunk_size, 2), compression='gzip')
+
+        config.update({'step': 'write', 'offsets': offsets, 'start_label': start_label,
+                       'n_labels': n_labels, 'chunk_size': chunk_size})
+        # we write the table in parallel for chunk-aligned rows
+        chunk_list = vu.blocks_in_volume([n_labels], [chunk_size])
+        n_jobs = min(len(chunk_list), self.max_jobs)
+        self.prepare_jobs(n_jobs, chunk_list, config, 'write',
+                          consecutive_blocks=True)
+        self.submit_jobs(n_jobs, 'write')
+        self.wait_for_jobs('write')
+        self.check_jobs(n_jobs, 'write')
+
+        # store the first key of each chunk, so that the table can be read lazily
+        first_keys = [_read_key(self.tmp_folder, offsets, row)
+                      for row in range(0, n_labels, chunk_size)]
+        with vu.file_reader(self.assignment_path) as f:
+            f[self.assignment_key].attrs['chunkFirstKeys'] = first_keys
+
     def run_impl(self):
         shebang, block_shape, roi_begin, roi_end = self.global_config_values()
         self.init(shebang)
@@ -44,22 +101,22 @@ class FindLabelingBase(luigi.Task):
         # get shape and make block config
         shape = vu.get_shape(self.input_path, self.input_key)
 
+        # the number of find_uniques jobs
         block_list = vu.blocks_in_volume(shape, block_shape, roi_begin, roi_end)
-        n_jobs = min(len(block_list), self.max_jobs)
+        n_input_jobs = min(len(block_list), self.max_jobs)
 
         config = self.get_task_config()
         config.update({'input_path': self.input_path, 'input_key': self.input_key,
                        'assignment_path': self.assignment_path,
-                       'tmp_folder': self.tmp_folder, 'n_jobs': n_jobs})
+                       'assignment_key': self.assignment_key,
+                       'tmp_folder': self.tmp_folder, 'n_jobs': n_input_jobs})
 
-        # we only have a single job to find the labeling
-        self.prepare_jobs(1, None, config)
-        self.submit_jobs(1)
-
-        # wait till jobs finish and check for job success
-        self.wait_for_jobs()
-        # log the save-path again
-        self.check_jobs(1)
+        # we find the labeling in two steps, that both run in parallel:
+        # 1.) merge the sorted uniques of all jobs for disjoint ranges of label ids
+        # 2.) write the assignment table, using the number of labels per range as offsets
+        # so no job needs to hold all the labels
+        range_list = self._merge_ranges(config, n_input_jobs)
+        self._write_assignments(config, range_list)
 
 
 class FindLabelingLocal(FindLabelingBase, LocalTask):
@@ -83,6 +140,81 @@ class FindLabelingLSF(FindLabelingBase, LSFTask):
     pass
 
 
+#
+# Implementation
+#
+
+
+def _uniques_path(tmp_folder, job_id):
+    return os.path.join(tmp_folder, 'find_uniques_job_%i.npy' % job_id)
+
+
+def _merged_path(tmp_folder, range_id):
+    return os.path.join(tmp_folder, 'find_labeling_range_%i.npy' % range_id)
+
+
+def _read_key(tmp_folder, offsets, row):
+    # read the label in a row of the assignment table from the merged ranges
+    range_id = int(np.searchsorted(offsets, row, side='right')) - 1
+    merged = np.load(_merged_path(tmp_folder, range_id), mmap_mode='r')
+    return int(merged[row - offsets[range_id]])
+
+
+def _find_splits(tmp_folder, n_input_jobs, n_ranges, samples_per_job):
+    """ Find the split points of label ranges with about the same number of labels,
+    by sampling the sorted uniques of the find_uniques jobs.
+    """
+    samples = []
+    for job_id in range(n_input_jobs):
+        uniques = np.load(_uniques_path(tmp_folder, job_id), mmap_mode='r')
+        if len(uniques) == 0:
+            continue
+        index = np.linspace(0, len(uniques) - 1,
+                            min(len(uniques), samples_per_job)).astype('int64')
+        samples.append(np.array(uniques[index]))
+    if len(samples) == 0:
+        return []
+    samples = np.unique(np.concatenate(samples))
+    index = np.linspace(0, len(samples), n_ranges + 1)[1:-1].astype('int64')
+    return [int(split) for split in np.unique(samples[index])]
+
+
+def _merge_range(tmp_folder, n_input_jobs, splits, range_id):
+    fu.log("start processing block %i" % range_id)
+    lower = np.uint64(splits[range_id - 1]) if range_id > 0 else None
+    upper = np.uint64(splits[range_id]) if range_id < len(splits) else None
+
+    # the uniques of the jobs are sorted, so we can load only the labels in our range
+    parts = []
+    for job_id in range(n_input_jobs):
+        uniques = np.load(_uniques_path(tmp_folder, job_id), mmap_mode='r')
+        begin = 0 if lower is None else np.searchsorted(uniques, lower)
+        end = len(uniques) if upper is None else np.searchsorted(uniques, upper)
+        parts.append(np.array(uniques[begin:end], dtype='uint64'))
+
+    # k-way merge of the sorted parts: the stable sort (timsort)
+    # merges the sorted runs instead of sorting from scratch
+    merged = np.sort(np.concatenate(parts), kind='stable')
+    if len(merged) > 0:
+        merged = merged[np.concatenate([[True], merged[1:] != merged[:-1]])]
+    np.save(_merged_path(tmp_folder, range_id), merged)
+    fu.log_block_success(range_id)
+
+
+def _write_rows(ds, tmp_folder, offsets, start_label, begin, end):
+    # load the labels of all ranges that overlap with the rows [begin, end)
+    keys = []
+    for range_id, (range_begin, range_end) in enumerate(zip(offsets[:-1], offsets[1:])):
+        if range_end <= begin or range_begin >= end:
+            continue
+        merged = np.load(_merged_path(tmp_folder, range_id), mmap_mode='r')
+        keys.append(np.array(merged[max(begin - range_begin, 0):end - range_begin]))
+    keys = np.concatenate(keys)
+    assert len(keys) == end - begin
+    values = np.arange(begin + start_label, end + start_label, dtype='uint64')
+    ds[begin:end] = np.concatenate([keys[:, None], values[:, None]], axis=1)
+
+
 def find_labeling(job_id, config_path):
 
     fu.log("start processing job %i" % job_id)
@@ -90,32 +222,38 @@ def find_labeling(job_id, config_path):
 
     with open(config_path, 'r') as f:
         config = json.load(f)
-    n_jobs = config['n_jobs']
+    step = config['step']
+    assert step in ('merge', 'write'), step
     tmp_folder = config['tmp_folder']
-    input_path = config['input_path']
-    input_key = config['input_key']
-    n_threads = config['threads_per_job']
-    assignment_path = config['assignment_path']
-
-    def _read_input(job_id):
-        return np.load(os.path.join(tmp_folder, 'find_uniques_job_%i.npy' % job_id))
-
-    # TODO this could be parallelized
-    fu.log("read uniques")
-    with futures.ThreadPoolExecutor(n_threads) as tp:
-        tasks = [tp.submit(_read_input, job_id) for job_id in range(n_jobs)]
-        uniques = np.concatenate([t.result() for t in tasks])
-    fu.log("compute uniques")
-    # uniques = nt.unique(uniques)
-    uniques = np.unique(uniques)
-    fu.log("relabel")
-    _, max_id, mapping = vigra.analysis.relabelConsecutive(uniques,
-                                                           keep_zeros=True,
-                                                           start_label=1)
-
-    fu.log("saving results to %s" % assignment_path)
-    with open(assignment_path, 'wb') as f:
-        pickle.dump(mapping, f)
+    block_list = config['block_list']
+
+    if step == 'merge':
+        n_input_jobs = config['n_jobs']
+        splits = config['splits']
+        for range_id in block_list:
+            _merge_range(tmp_folder, n_input_jobs, splits, range_id)
+
+    else:
+        assignment_path = config['assignment_path']
+        assignment_key = config['assignment_key']
+        n_threads = config['threads_per_job']
+
+        # assert that the chunk list is consecutive
+        diff_list = np.diff(block_list)
+        assert (diff_list == 1).all()
+
+        blocking = nt.blocking([0], [config['n_labels']], [config['chunk_size']])
+        begin = blocking.getBlock(block_list[0]).begin[0]
+        end = blocking.getBlock(block_list[-1]).end[0]
+
+        fu.log("saving results to %s:%s" % (assignment_path, assignment_key))
+        with vu.file_reader(assignment_path) as f:
+            ds = f[assignment_key]
+            ds.n_threads = n_threads
+            _write_rows(ds, tmp_folder, config['offsets'], config['start_label'], begin, end)
+        for block_id in block_list:
+            fu.log_block_success(block_id)
+
     # log success
     fu.log_job_success(job_id)
 
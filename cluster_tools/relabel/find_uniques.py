@@ -20,6 +20,7 @@ class FindUniquesBase(luigi.Task):
 
     task_name = 'find_uniques'
     src_file = os.path.abspath(__file__)
+    allow_block_queue = True
 
     input_path = luigi.Parameter()
     input_key = luigi.Parameter()
@@ -86,11 +87,11 @@ class FindUniquesLSF(FindUniquesBase, LSFTask):
 #
 
 
-def uniques_in_block(block_id, blocking, ds, return_counts):
+def uniques_in_block(block_id, blocking, ds, return_counts, stats):
     fu.log("start processing block %i" % block_id)
     block = blocking.getBlock(block_id)
     bb = vu.block_to_bb(block)
-    labels = ds[bb]
+    labels = stats.read(ds, bb)
 
     if return_counts:
         uniques, counts = np.unique(labels, return_counts=True)
@@ -111,7 +112,6 @@ def find_uniques(job_id, config_path):
         config = json.load(f)
     input_path = config['input_path']
     input_key = config['input_key']
-    block_list = config['block_list']
     block_shape = config['block_shape']
     tmp_folder = config['tmp_folder']
     return_counts = config['return_counts']
@@ -125,10 +125,20 @@ def find_uniques(job_id, config_path):
                                blockShape=list(block_shape))
 
         # find uniques for all blocks
-        uniques = [uniques_in_block(block_id, blocking, ds, return_counts)
-                   for block_id in block_list]
-
-    if return_counts:
+        uniques = []
+        for block_id in fu.blocks_to_process(job_id, config):
+            with fu.instrument_block(config, block_id) as stats:
+                uniques.append(uniques_in_block(block_id, blocking, ds, return_counts, stats))
+
+    # a job can end up without blocks if the others
+    # have pulled all blocks from the block queue
+    if len(uniques) == 0:
+        unique_values = np.zeros(0, dtype='uint64')
+        if return_counts:
+            count_path = os.path.join(tmp_folder, 'counts_job_%i.npy' % job_id)
+            np.save(count_path, np.zeros(0, dtype='uint64'))
+
+    elif return_counts:
         unique_values = nt.unique(np.concatenate([un[0] for un in uniques]))
         counts = np.zeros(int(unique_values[-1] + 1), dtype='uint64')
         for uniques_block, counts_block in uniques:
@@ -137,7 +147,7 @@ def find_uniques(job_id, config_path):
         assert len(counts) == len(unique_values)
 
         count_path = os.path.join(tmp_folder, 'counts_job_%i.npy' % job_id)
-        np.save(count_path, count_values)
+        np.save(count_path, counts)
 
     else:
         unique_values = nt.unique(np.concatenate(uniques))
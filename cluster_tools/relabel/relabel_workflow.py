@@ -26,7 +26,8 @@ class RelabelWorkflow(WorkflowBase):
         # because it is only used internally for this task
         # but it could also be exposed if this is useful
         # at some point
-        assignment_path = os.path.join(self.tmp_folder, 'relabeling.pkl')
+        assignment_path = os.path.join(self.tmp_folder, 'relabeling.n5')
+        assignment_key = 'assignments'
         labeling_task = getattr(labeling_tasks,
                                 self._get_task_name('FindLabeling'))
         t2 = labeling_task(tmp_folder=self.tmp_folder,
@@ -35,6 +36,7 @@ class RelabelWorkflow(WorkflowBase):
                            input_path=self.input_path,
                            input_key=self.input_key,
                            assignment_path=assignment_path,
+                           assignment_key=assignment_key,
                            dependency=t1)
 
         write_task = getattr(write_tasks,
@@ -47,6 +49,7 @@ class RelabelWorkflow(WorkflowBase):
                         output_path=self.input_path,
                         output_key=self.input_key,
                         assignment_path=assignment_path,
+                        assignment_key=assignment_key,
                         identifier='relabel',
                         dependency=t2)
         return t3
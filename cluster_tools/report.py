@@ -0,0 +1,64 @@
+#! /usr/bin/python
+
+import os
+import json
+import argparse
+
+from .utils.parse_utils import parse_instrumentation_folder, summarize_instrumentation
+
+
+def _format_bytes(n_bytes):
+    if n_bytes is None:
+        return '-'
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n_bytes < 1024:
+            return '%.1f %s' % (n_bytes, unit)
+        n_bytes /= 1024.
+    return '%.1f TB' % n_bytes
+
+
+def report(tmp_folder):
+    """ Summarize the block instrumentation of all tasks run in `tmp_folder`.
+
+    Returns a dict mapping the job name (task name and job prefix) to its summary,
+    see `parse_utils.summarize_instrumentation`.
+    """
+    folder = os.path.join(tmp_folder, 'instrumentation')
+    assert os.path.exists(folder), "No instrumentation found in %s" % tmp_folder
+    return {job_name: summarize_instrumentation(records)
+            for job_name, records in parse_instrumentation_folder(folder).items()}
+
+
+def print_report(summaries):
+    header = ('task', 'blocks', 'mean [s]', 'max [s]', 'read [s]', 'compute [s]',
+              'write [s]', 'io', 'read/s', 'write/s', 'peak rss', 'bound')
+    rows = [header]
+    for job_name, summary in sorted(summaries.items()):
+        if summary['n_blocks'] == 0:
+            continue
+        rows.append((job_name, str(summary['n_blocks']),
+                     '%.2f' % summary['mean_block_time'], '%.2f' % summary['max_block_time'],
+                     '%.1f' % summary['read_time'], '%.1f' % summary['compute_time'],
+                     '%.1f' % summary['write_time'], '%.0f%%' % (100 * summary['io_fraction']),
+                     _format_bytes(summary['read_throughput']),
+                     _format_bytes(summary['write_throughput']),
+                     _format_bytes(summary['peak_rss']), summary['bound']))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    for row in rows:
+        print('  '.join(col.ljust(width) for col, width in zip(row, widths)).rstrip())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize per-block timings and I/O of the tasks run in a tmp folder")
+    parser.add_argument('tmp_folder', type=str)
+    parser.add_argument('--json', action='store_true', help="print the summaries as json")
+    args = parser.parse_args()
+    summaries = report(args.tmp_folder)
+    if args.json:
+        print(json.dumps(summaries, indent=2, sort_keys=True))
+    else:
+        print_report(summaries)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,10 @@
+import os
 import json
+import time
+import resource
+import threading
+from concurrent import futures
+from contextlib import contextmanager
 from datetime import datetime
 from subprocess import check_output
 
@@ -17,6 +23,187 @@ def log_job_success(job_id):
     print("%s: processed job %i" % (str(datetime.now()), job_id))
 
 
+def _claim_block(queue_folder, block_id):
+    # rename is atomic, so only one job can claim a block
+    try:
+        os.rename(os.path.join(queue_folder, 'queue', str(block_id)),
+                  os.path.join(queue_folder, 'claimed', str(block_id)))
+        return True
+    except OSError:
+        return False
+
+
+def _blocks_from_queue(queue_folder, block_list, job_id):
+    # first process the blocks assigned to this job
+    for block_id in block_list:
+        if _claim_block(queue_folder, block_id):
+            yield block_id
+
+    # then steal the blocks that other jobs have not claimed yet
+    while True:
+        remaining = sorted(int(block_id) for block_id in os.listdir(os.path.join(queue_folder, 'queue')))
+        if not remaining:
+            break
+        # start at a different position for each job to reduce collisions
+        start = job_id % len(remaining)
+        n_claimed = 0
+        for block_id in remaining[start:] + remaining[:start]:
+            if _claim_block(queue_folder, block_id):
+                log("stole block %i from the queue" % block_id)
+                n_claimed += 1
+                yield block_id
+        # all remaining blocks were claimed by other jobs in the meantime
+        if n_claimed == 0:
+            break
+
+
+def blocks_to_process(job_id, config):
+    """ Iterate over the blocks this job should process.
+
+    If the task was run with a block queue, the job claims the blocks of its
+    block list from the queue first and then pulls blocks from the queue
+    that other jobs have not claimed yet. Otherwise, this is just the block list.
+    """
+    block_list = config['block_list']
+    queue_folder = config.get('block_queue', None)
+    if queue_folder is None:
+        return iter(block_list)
+    return _blocks_from_queue(queue_folder, block_list, job_id)
+
+
+def map_blocks(func, block_ids, n_threads):
+    """ Apply `func` to all block ids with a thread pool.
+
+    At most `n_threads` blocks are in flight at a time, which bounds the memory
+    and makes sure that blocks are pulled lazily from a block queue, see `blocks_to_process`.
+    """
+    if n_threads <= 1:
+        for block_id in block_ids:
+            func(block_id)
+        return
+
+    with futures.ThreadPoolExecutor(n_threads) as tp:
+        running = set()
+        for block_id in block_ids:
+            if len(running) >= n_threads:
+                done, running = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+                [t.result() for t in done]
+            running.add(tp.submit(func, block_id))
+        [t.result() for t in futures.as_completed(running)]
+
+
+class BlockStats(object):
+    """ Timings and I/O volume of a single block.
+
+    Route the dataset reads and writes of a block through `read` and `write`
+    to record them; everything else counts as compute time.
+    The I/O uses direct chunk access for chunk-aligned blocks and does not write back
+    chunks that are unchanged since they were read, see `volume_utils.read_block`.
+    """
+    def __init__(self, block_id):
+        self.block_id = block_id
+        self.read_time = 0.
+        self.write_time = 0.
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._digests = {}
+
+    def read(self, ds, bb):
+        # import here, because volume_utils pulls in vigra, which we don't need to parse logs
+        from .volume_utils import read_block
+        t0 = time.perf_counter()
+        data = read_block(ds, bb, self._digests)
+        self.read_time += time.perf_counter() - t0
+        self.bytes_read += data.nbytes
+        return data
+
+    def write(self, ds, bb, data):
+        from .volume_utils import write_block
+        t0 = time.perf_counter()
+        write_block(ds, bb, data, self._digests)
+        self.write_time += time.perf_counter() - t0
+        self.bytes_written += data.nbytes
+
+
+# blocks of the same job may run in parallel threads
+_instrumentation_lock = threading.Lock()
+
+
+@contextmanager
+def instrument_block(config, block_id):
+    """ Record the timings, I/O volume and peak memory of a block.
+
+    The record is appended as json line to `instrumentation_path` from the job config
+    if the block finishes without exception, see `parse_utils.parse_instrumentation_task`.
+    """
+    stats = BlockStats(block_id)
+    start = time.time()
+    t0 = time.perf_counter()
+    yield stats
+    total_time = time.perf_counter() - t0
+    _record_block(config, stats, start, total_time,
+                  max(total_time - stats.read_time - stats.write_time, 0.))
+
+
+def _record_block(config, stats, start, total_time, compute_time):
+    path = config.get('instrumentation_path', None)
+    if path is None:
+        return
+    # ru_maxrss is given in kilobytes on linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    record = {'block_id': stats.block_id, 'start': start,
+              'total_time': total_time, 'read_time': stats.read_time,
+              'write_time': stats.write_time, 'compute_time': compute_time,
+              'bytes_read': stats.bytes_read, 'bytes_written': stats.bytes_written,
+              'peak_rss': peak_rss}
+    with _instrumentation_lock, open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def pipeline_blocks(block_ids, read, compute, write, config, n_threads=1, prefetch=1):
+    """ Process blocks in a read / compute / write pipeline.
+
+    `read(block_id, stats)` loads the data of a block, `compute(block_id, data)` returns
+    the result, or None if there is nothing to write, and `write(block_id, result, stats)`
+    writes it. Reading the next blocks and writing the previous blocks runs in background
+    threads while the current blocks are computed with `n_threads` threads.
+    At most `n_threads + prefetch` blocks are in flight at a time.
+    The blocks are instrumented and their success is logged, see `instrument_block`.
+    """
+    def _read(block_id):
+        log("start processing block %i" % block_id)
+        stats = BlockStats(block_id)
+        start, t0 = time.time(), time.perf_counter()
+        return stats, start, t0, read(block_id, stats)
+
+    def _compute(block_id, read_task):
+        stats, start, t0, data = read_task.result()
+        t1 = time.perf_counter()
+        result = compute(block_id, data)
+        return stats, start, t0, time.perf_counter() - t1, result
+
+    def _write(block_id, compute_task):
+        stats, start, t0, compute_time, result = compute_task.result()
+        if result is not None:
+            write(block_id, result, stats)
+        _record_block(config, stats, start, time.perf_counter() - t0, compute_time)
+        log_block_success(block_id)
+
+    max_in_flight = n_threads + prefetch
+    with futures.ThreadPoolExecutor(1) as read_pool,\
+            futures.ThreadPoolExecutor(n_threads) as compute_pool,\
+            futures.ThreadPoolExecutor(1) as write_pool:
+        running = set()
+        for block_id in block_ids:
+            if len(running) >= max_in_flight:
+                done, running = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+                [t.result() for t in done]
+            read_task = read_pool.submit(_read, block_id)
+            compute_task = compute_pool.submit(_compute, block_id, read_task)
+            running.add(write_pool.submit(_write, block_id, compute_task))
+        [t.result() for t in futures.as_completed(running)]
+
+
 # woot, there is no native tail in python ???
 def tail(path, n_lines):
     line_str = '-%i' % n_lines
@@ -0,0 +1,201 @@
+import os
+from shutil import rmtree
+from concurrent import futures
+
+import numpy as np
+import z5py
+import nifty.tools as nt
+import nifty.distributed as ndist
+
+
+# the varlen datasets of a serialized sub-problem
+SUB_PROBLEM_KEYS = ('nodes', 'inner_edges', 'outer_edges', 'uv_ids')
+
+
+def _chunk_id(blocking, block_id):
+    block = blocking.getBlock(block_id)
+    return tuple(beg // sh for beg, sh in zip(block.begin, blocking.blockShape))
+
+
+def remove_sub_problems(problem_path, scale):
+    """ Remove the sub-problems at the given scale, e.g. because the graph has changed.
+    """
+    rmtree(os.path.join(problem_path, 's%i' % scale, 'sub_problems'), ignore_errors=True)
+
+
+def require_sub_problems(problem_path, scale, block_shape):
+    """ Create the varlen datasets for the sub-problems of the blocks, see `serialize_sub_problems`.
+
+    Call this once before serializing the sub-problems from several jobs.
+    Sub-problems of a previous run are removed, because blocks without edges don't write
+    their chunks and would otherwise load the stale chunk.
+    """
+    remove_sub_problems(problem_path, scale)
+    with z5py.File(problem_path) as f:
+        shape = f.attrs['shape']
+        ignore_label = f['s%i/graph' % scale].attrs['ignoreLabel']
+        group = f.require_group('s%i/sub_problems' % scale)
+        group.attrs['ignoreLabel'] = ignore_label
+        for key in SUB_PROBLEM_KEYS:
+            group.require_dataset(key, shape=tuple(shape), chunks=tuple(block_shape),
+                                  compression='raw', dtype='uint64')
+
+
+def _write_sub_problem(datasets, chunk_id, sub_problem):
+    for key, data in zip(SUB_PROBLEM_KEYS, sub_problem):
+        # reading a chunk that does not exist gives None, which we treat as empty
+        if len(data) > 0:
+            datasets[key].write_chunk(chunk_id, np.asarray(data, dtype='uint64').ravel(), True)
+
+
+def serialize_sub_problems(problem_path, scale, block_shape, block_list, n_threads=1):
+    """ Serialize the sub-problems of the blocks for the blockwise multicut.
+
+    For each block, the nodes, the ids of the inner and outer edges and the uv-ids of the
+    inner edges (mapped to the position of their nodes in the block) are written to the chunk
+    of the block in the varlen datasets of the group 's<scale>/sub_problems'.
+    This needs the graph at 's<scale>/graph' and the node lists of the sub-graphs
+    at 's<scale>/sub_graphs/block_<id>' and the datasets created by `require_sub_problems`.
+    """
+    graph_key = 's%i/graph' % scale
+    f = z5py.File(problem_path)
+    shape = f.attrs['shape']
+    group = f['s%i/sub_problems' % scale]
+    ignore_label = group.attrs['ignoreLabel']
+
+    graph = ndist.Graph(os.path.join(problem_path, graph_key), numberOfThreads=n_threads)
+    uv_ids = graph.uvIds()
+
+    blocking = nt.blocking([0, 0, 0], list(shape), list(block_shape))
+    datasets = {key: group[key] for key in SUB_PROBLEM_KEYS}
+    block_prefix = os.path.join(problem_path, 's%i' % scale, 'sub_graphs', 'block_')
+
+    def _serialize(block_id):
+        nodes = ndist.loadNodes(block_prefix + str(block_id))
+        # edges to the ignore label are outer edges, so they are always cut
+        # (nodes are sorted, so it will always be at pos 0)
+        sub_nodes = nodes[1:] if ignore_label and len(nodes) > 0 and nodes[0] == 0 else nodes
+        if len(sub_nodes) > 0:
+            # we allow for invalid nodes here,
+            # which can occur for un-connected graphs resulting from bad masks ...
+            inner_edges, outer_edges = graph.extractSubgraphFromNodes(sub_nodes,
+                                                                      allowInvalidNodes=True)
+        else:
+            inner_edges = outer_edges = np.zeros(0, dtype='uint64')
+        sub_uvs = np.searchsorted(sub_nodes, uv_ids[inner_edges])
+
+        _write_sub_problem(datasets, _chunk_id(blocking, block_id),
+                           (nodes, inner_edges, outer_edges, sub_uvs))
+
+    with futures.ThreadPoolExecutor(n_threads) as tp:
+        tasks = [tp.submit(_serialize, block_id) for block_id in block_list]
+        [t.result() for t in tasks]
+
+
+def serialize_merged_sub_problems(problem_path, scale, block_shape, block_list,
+                                  node_labeling, edge_labeling, n_threads=1):
+    """ Serialize the sub-problems of the blocks at scale + 1 from the sub-problems at scale.
+
+    The nodes and edges of a new block are the new ids of the nodes and (not merged) edges
+    of the sub-problems of the blocks it contains; only the uv-ids of these edges are read
+    from the new graph, so no job needs to load the whole graph.
+    This is exact because the outer edges of a block are always cut, so the nodes
+    merged into a new node are all contained in each block that contains one of them.
+    `block_shape` is the block shape at scale, the new blocks have twice this shape.
+    This needs the sub-problems at scale and the new graph at 's<scale + 1>/graph'
+    and the datasets created by `require_sub_problems`.
+    """
+    f = z5py.File(problem_path)
+    shape = f.attrs['shape']
+    group_in = f['s%i/sub_problems' % scale]
+    group_out = f['s%i/sub_problems' % (scale + 1)]
+    ignore_label = group_out.attrs['ignoreLabel']
+    ds_edges = f['s%i/graph/edges' % (scale + 1)]
+
+    blocking = nt.blocking([0, 0, 0], list(shape), list(block_shape))
+    new_blocking = nt.blocking([0, 0, 0], list(shape), [2 * bs for bs in block_shape])
+    datasets = {key: group_out[key] for key in SUB_PROBLEM_KEYS}
+
+    def _serialize(block_id):
+        block = new_blocking.getBlock(block_id)
+        child_ids = blocking.getBlockIdsInBoundingBox(roiBegin=block.begin, roiEnd=block.end,
+                                                      blockHalo=[0, 0, 0])
+        nodes, edge_ids = [np.zeros(0, dtype='uint64')], [np.zeros(0, dtype='uint64')]
+        for child_id in child_ids:
+            child_nodes, inner_edges, outer_edges, _ = load_sub_problem(group_in, blocking,
+                                                                        child_id)
+            nodes.append(child_nodes)
+            edge_ids.extend([inner_edges, outer_edges])
+
+        nodes = np.unique(node_labeling[np.concatenate(nodes)]).astype('uint64')
+        edge_ids = edge_labeling[np.unique(np.concatenate(edge_ids))]
+        # merged edges are mapped to -1
+        edge_ids = np.unique(edge_ids[edge_ids != -1]).astype('uint64')
+
+        # edges to the ignore label are outer edges, so they are always cut
+        sub_nodes = nodes[1:] if ignore_label and len(nodes) > 0 and nodes[0] == 0 else nodes
+        uv_ids = read_edge_values(ds_edges, edge_ids).reshape((-1, 2))
+        in_block = np.isin(uv_ids, sub_nodes)
+        inner = in_block.all(axis=1)
+        outer = np.logical_and(in_block.any(axis=1), np.logical_not(inner))
+        sub_uvs = np.searchsorted(sub_nodes, uv_ids[inner])
+
+        _write_sub_problem(datasets, _chunk_id(new_blocking, block_id),
+                           (nodes, edge_ids[inner], edge_ids[outer], sub_uvs))
+
+    with futures.ThreadPoolExecutor(n_threads) as tp:
+        tasks = [tp.submit(_serialize, block_id) for block_id in block_list]
+        [t.result() for t in tasks]
+
+
+def load_sub_problem(group, blocking, block_id):
+    """ Load the sub-problem of a block, see `serialize_sub_problems`.
+
+    Returns the nodes, the inner and outer edge ids and the local uv-ids of the inner edges.
+    """
+    chunk_id = _chunk_id(blocking, block_id)
+
+    def _load(key):
+        data = group[key].read_chunk(chunk_id)
+        return np.zeros(0, dtype='uint64') if data is None else data
+
+    nodes, inner_edges, outer_edges, sub_uvs = [_load(key) for key in SUB_PROBLEM_KEYS]
+    return nodes, inner_edges, outer_edges, sub_uvs.reshape((-1, 2))
+
+
+def load_cut_edges(problem_path, scale, blocking, block_list, n_threads=1):
+    """ Load the cut edges of the sub-problem solutions of the blocks at the given scale.
+    """
+    ds = z5py.File(problem_path)['s%i/sub_results/cut_edge_ids' % scale]
+
+    with futures.ThreadPoolExecutor(n_threads) as tp:
+        tasks = [tp.submit(ds.read_chunk, _chunk_id(blocking, block_id))
+                 for block_id in block_list]
+        cut_edge_ids = [t.result() for t in tasks]
+    cut_edge_ids = [ids for ids in cut_edge_ids if ids is not None]
+
+    if len(cut_edge_ids) == 0:
+        return np.zeros(0, dtype='uint64')
+    return np.unique(np.concatenate(cut_edge_ids))
+
+
+def read_edge_values(ds, edge_ids):
+    """ Read the values of the given edges from a dataset, e.g. the costs or uv-ids.
+
+    Only the chunks that contain the edge ids are loaded. The edge ids of a block
+    can span most of the dataset above scale 0, but they touch few chunks.
+    """
+    values = np.zeros((len(edge_ids),) + tuple(ds.shape[1:]), dtype=ds.dtype)
+    if len(edge_ids) == 0:
+        return values
+    chunk_len = ds.chunks[0]
+    order = np.argsort(edge_ids, kind='stable')
+    sorted_ids = edge_ids[order].astype('int64')
+    chunk_ids = sorted_ids // chunk_len
+    # the runs of edges in the same chunk
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(chunk_ids)) + 1, [len(chunk_ids)]])
+    for beg, end in zip(bounds[:-1], bounds[1:]):
+        chunk_begin = int(chunk_ids[beg]) * chunk_len
+        chunk = ds[chunk_begin:chunk_begin + chunk_len]
+        values[order[beg:end]] = chunk[sorted_ids[beg:end] - chunk_begin]
+    return values
@@ -1,4 +1,5 @@
 import os
+import json
 import datetime
 from subprocess import CalledProcessError
 
@@ -56,18 +57,137 @@ def parse_runtime_task(log_prefix, max_jobs, return_summary=True):
         path = log_prefix + '%i.log' % job_id
         if not os.path.exists(path):
             break
-        runtimes.append(runtime_from_log(path))
+        runtimes.append(parse_runtime(path))
     if return_summary:
         return (np.mean(runtimes), np.std(runtimes), len(runtimes))
     else:
         return runtimes
 
 
+def _parse_log_time(line):
+    """ Parse the datetime prefix of a log line (str(datetime) followed by ':')
+    """
+    time_str = ' '.join(line.split()[:2]).rstrip(':')
+    # str(datetime) omits the microseconds if they are zero
+    fmt = '%Y-%m-%d %H:%M:%S.%f' if '.' in time_str else '%Y-%m-%d %H:%M:%S'
+    return datetime.datetime.strptime(time_str, fmt)
+
+
+def parse_block_runtimes(log_file):
+    """ Parse the run-times of individual blocks from a log-file.
+
+    The run-time of a block is measured from its 'start processing block' message
+    to its 'processed block' message, or from the previous log message if the block
+    does not log its start.
+    """
+    starts = {}
+    runtimes = {}
+    previous = None
+    with open(log_file, 'r') as f:
+        for line in f:
+            try:
+                time = _parse_log_time(line)
+            except ValueError:
+                continue
+            msg = ' '.join(line.split()[2:])
+            if msg.startswith('start processing block'):
+                starts[int(msg.split()[-1])] = time
+            elif msg.startswith('processed block'):
+                block_id = int(msg.split()[-1])
+                start = starts.pop(block_id, previous)
+                if start is not None:
+                    runtimes[block_id] = (time - start).total_seconds()
+            previous = time
+    return runtimes
+
+
+def parse_block_runtimes_task(log_prefix, max_jobs):
+    """ Parse the run-times of all blocks processed by the jobs of a task.
+
+    The result can be used as block costs to balance the jobs of the next run,
+    see `BaseClusterTask._load_block_costs`.
+    """
+    runtimes = {}
+    for job_id in range(max_jobs):
+        path = log_prefix + '%i.log' % job_id
+        if not os.path.exists(path):
+            continue
+        runtimes.update(parse_block_runtimes(path))
+    return runtimes
+
+
 # TODO
 def parse_runtime_segmentation_workflow():
     pass
 
 
+#######################
+# Parse instrumentation
+#######################
+
+
+def parse_instrumentation(path):
+    """ Parse the block records written by `function_utils.instrument_block`
+    """
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def parse_instrumentation_task(instrumentation_prefix, max_jobs):
+    """ Parse the block records of all jobs of a task
+    """
+    records = []
+    for job_id in range(max_jobs):
+        path = instrumentation_prefix + '%i.jsonl' % job_id
+        if not os.path.exists(path):
+            continue
+        records.extend(parse_instrumentation(path))
+    return records
+
+
+def parse_instrumentation_folder(folder):
+    """ Parse the block records of all tasks in an instrumentation folder.
+
+    Returns a dict mapping the job name (task name and job prefix) to its records.
+    """
+    records = {}
+    for name in sorted(os.listdir(folder)):
+        if not name.endswith('.jsonl'):
+            continue
+        # the files are named '<job_name>_<job_id>.jsonl'
+        job_name = name[:-len('.jsonl')].rsplit('_', 1)[0]
+        records.setdefault(job_name, []).extend(parse_instrumentation(os.path.join(folder, name)))
+    return records
+
+
+def summarize_instrumentation(records):
+    """ Summarize the block records of a task.
+
+    The task is classified as io-bound if it spends more time
+    reading and writing than computing.
+    """
+    if not records:
+        return {'n_blocks': 0}
+    total_times = np.array([rec['total_time'] for rec in records])
+    read_time = sum(rec['read_time'] for rec in records)
+    write_time = sum(rec['write_time'] for rec in records)
+    compute_time = sum(rec['compute_time'] for rec in records)
+    bytes_read = sum(rec['bytes_read'] for rec in records)
+    bytes_written = sum(rec['bytes_written'] for rec in records)
+    return {'n_blocks': len(records),
+            'total_time': float(total_times.sum()),
+            'mean_block_time': float(total_times.mean()),
+            'max_block_time': float(total_times.max()),
+            'read_time': read_time, 'write_time': write_time,
+            'compute_time': compute_time,
+            'io_fraction': (read_time + write_time) / max(float(total_times.sum()), 1e-9),
+            'bytes_read': bytes_read, 'bytes_written': bytes_written,
+            'read_throughput': bytes_read / read_time if read_time > 0 else None,
+            'write_throughput': bytes_written / write_time if write_time > 0 else None,
+            'peak_rss': max(rec['peak_rss'] for rec in records),
+            'bound': 'io' if read_time + write_time > compute_time else 'cpu'}
+
+
 ######################
 # Parse processed jobs
 ######################
@@ -137,6 +257,6 @@ def parse_blocks_task(log_prefix, max_jobs, complete_job_list=[]):
         # log might not exist, even if this is not the last job
         if not os.path.exists(path):
             continue
-        blocks.extend(parse_blocks(log_file))
+        blocks.extend(parse_blocks(path))
 
     return blocks
@@ -9,16 +9,26 @@ import nifty.graph.opt.multicut as nmc
 from vigra.analysis import relabelConsecutive
 
 
+# agglomerators that can start from an initial node labeling, passed as `node_labels`
+WARMSTART_AGGLOMERATORS = ('kernighan-lin', 'fusion-moves', 'fusion-moves-greedy')
+
+
+def _optimize(objective, solver, time_limit=None, node_labels=None):
+    kwargs = {} if node_labels is None else {'nodeLabels': node_labels}
+    if time_limit is not None:
+        kwargs['visitor'] = objective.verboseVisitor(visitNth=1000000,
+                                                     timeLimitTotal=time_limit)
+    return solver.optimize(**kwargs)
+
+
 # TODO logging
-def multicut_kernighan_lin(graph, costs, warmstart=True, time_limit=None, n_threads=1):
+def multicut_kernighan_lin(graph, costs, warmstart=True, time_limit=None, n_threads=1,
+                           node_labels=None):
     objective = nmc.multicutObjective(graph, costs)
+    # we don't need the greedy warm start if we start from the given node labels
+    warmstart = warmstart and node_labels is None
     solver = objective.kernighanLinFactory(warmStartGreedy=warmstart).create(objective)
-    if time_limit is None:
-        return solver.optimize()
-    else:
-        visitor = objective.verboseVisitor(visitNth=1000000,
-                                           timeLimitTotal=time_limit)
-        return solver.optimize(visitor=visitor)
+    return _optimize(objective, solver, time_limit, node_labels)
 
 
 def multicut_gaec(graph, costs, time_limit=None, n_threads=1):
@@ -116,25 +126,51 @@ def multicut_decomposition(graph, costs, time_limit=None, n_threads=1,
     return node_labels
 
 
-# TODO
 def multicut_fusion_moves(graph, costs, time_limit=None, n_threads=1,
-                          solver='kernighan-lin'):
-    assert solver in ('kernighan-lin', 'greedy-additive')
+                          solver='kernighan-lin', proposals='watershed',
+                          n_iterations=1000, n_stop=25, sigma=2., seed_fraction=.05,
+                          node_labels=None):
+    """ Multicut with fusion moves.
+
+    In each iteration, every thread generates a proposal from the noised costs
+    and fuses it with the current solution by solving the multicut of the contracted graph
+    with `solver`. We stop after `n_iterations` or if we don't improve for `n_stop` iterations.
+    The proposals are generated with seeded watersheds (with `seed_fraction` of the nodes as seeds)
+    or with greedy-additive agglomeration; `sigma` is the scale of the noise.
+    If `node_labels` are given, the proposals are fused with this labeling first.
+    """
+    assert solver in ('kernighan-lin', 'greedy-additive'), solver
+    assert proposals in ('watershed', 'greedy-additive'), proposals
     objective = nmc.multicutObjective(graph, costs)
-    if time_limit is None:
-        return solver.optimize()
+
+    if solver == 'kernighan-lin':
+        sub_solver = objective.kernighanLinFactory(warmStartGreedy=True)
     else:
-        visitor = objective.verboseVisitor(visitNth=1000000,
-                                           timeLimitTotal=time_limit)
-        return solver.optimize(visitor=visitor)
+        sub_solver = objective.greedyAdditiveFactory()
+    fusion_move = objective.fusionMoveSettings(mcFactory=sub_solver)
+
+    if proposals == 'watershed':
+        proposal_gen = objective.watershedProposals(sigma=sigma, seedFraction=seed_fraction)
+    else:
+        proposal_gen = objective.greedyAdditiveProposals(sigma=sigma)
+
+    solver = objective.fusionMoveBasedFactory(fusionMove=fusion_move,
+                                              proposalGen=proposal_gen,
+                                              numberOfIterations=n_iterations,
+                                              stopIfNoImprovement=n_stop,
+                                              numberOfThreads=n_threads).create(objective)
+    return _optimize(objective, solver, time_limit, node_labels)
 
 
-def key_to_agglomerator(key):
+def key_to_agglomerator(key, **kwargs):
     agglo_dict = {'kernighan-lin': multicut_kernighan_lin,
                   'greedy-additive': multicut_gaec,
                   'decomposition': multicut_decomposition,
                   'decomposition-gaec': partial(multicut_decomposition,
                                                 solver='greedy-additive'),
-                  'fusion-moves': multicut_fusion_moves}
+                  'fusion-moves': multicut_fusion_moves,
+                  'fusion-moves-greedy': partial(multicut_fusion_moves,
+                                                 proposals='greedy-additive')}
     assert key in agglo_dict, key
-    return agglo_dict[key]
+    # additional keyword arguments for the agglomerator, e.g. the number of iterations for fusion moves
+    return partial(agglo_dict[key], **kwargs) if kwargs else agglo_dict[key]
@@ -1,3 +1,5 @@
+import heapq
+import numpy as np
 import luigi
 
 
@@ -13,3 +15,60 @@ class DummyTask(luigi.Task):
     """
     def output(self):
         return DummyTarget()
+
+
+def partition_blocks_by_cost(block_list, block_costs, n_jobs,
+                             consecutive=False, min_cost_fraction=0.01):
+    """ Partition blocks into jobs such that the total cost per job is balanced.
+
+    Arguments:
+        block_list [list] - ids of the blocks to distribute
+        block_costs [dict] - cost estimate for the blocks; blocks without cost
+            get the mean cost of the blocks that have one
+        n_jobs [int] - number of jobs
+        consecutive [bool] - keep the blocks of each job as consecutive run of block_list
+        min_cost_fraction [float] - every block costs at least this fraction of the
+            most expensive block, to account for the I/O of empty blocks
+    Returns:
+        list of block lists, one per job
+    """
+    known_costs = [block_costs[block_id] for block_id in block_list if block_id in block_costs]
+    default_cost = float(np.mean(known_costs)) if known_costs else 1.
+    costs = np.array([block_costs.get(block_id, default_cost) for block_id in block_list],
+                     dtype='float64')
+    if len(costs) == 0:
+        return [[] for _ in range(n_jobs)]
+    # without any cost information (e.g. all blocks are empty), distribute uniformly
+    if costs.max() <= 0:
+        costs = np.ones_like(costs)
+    costs = np.maximum(costs, min_cost_fraction * costs.max())
+
+    if consecutive:
+        # cut the block list into runs of (approximately) equal cost,
+        # by cutting where the cumulative cost crosses multiples of the mean job cost
+        cum_costs = np.cumsum(costs)
+        targets = cum_costs[-1] * np.arange(1, n_jobs) / n_jobs
+        cuts = np.searchsorted(cum_costs, targets, side='left') + 1
+        n_blocks = len(block_list)
+        bounds = [0]
+        for job_id, cut in enumerate(cuts.tolist()):
+            # make sure that every job gets at least one block
+            if n_blocks >= n_jobs:
+                cut = min(max(cut, bounds[-1] + 1), n_blocks - (n_jobs - 1 - job_id))
+            bounds.append(min(cut, n_blocks))
+        bounds.append(n_blocks)
+        return [list(block_list[beg:end]) for beg, end in zip(bounds[:-1], bounds[1:])]
+
+    # longest processing time first: assign the most expensive remaining block
+    # to the job that currently has the smallest total cost;
+    # ties are broken by the number of blocks per job
+    job_heap = [(0., 0, job_id) for job_id in range(n_jobs)]
+    partition = [[] for _ in range(n_jobs)]
+    for block_index in np.argsort(-costs, kind='stable'):
+        job_cost, n_job_blocks, job_id = heapq.heappop(job_heap)
+        partition[job_id].append(block_list[block_index])
+        heapq.heappush(job_heap, (job_cost + costs[block_index], n_job_blocks + 1, job_id))
+    # process blocks in their original order within a job
+    # (this keeps neighboring blocks together for better caching)
+    positions = {block_id: pos for pos, block_id in enumerate(block_list)}
+    return [sorted(blocks, key=positions.get) for blocks in partition]
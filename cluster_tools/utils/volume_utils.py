@@ -1,5 +1,10 @@
 import os
 import json
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import product
 from functools import partial
 from math import floor, ceil
 
@@ -36,7 +41,13 @@ def get_shape(path, key):
 
 def blocks_in_volume(shape, block_shape,
                      roi_begin=None, roi_end=None,
-                     block_list_path=None):
+                     block_list_path=None, occupancy=None,
+                     occupancy_halo=None):
+    """ Get the ids of the blocks in the volume.
+
+    If `occupancy` is given as (path, key) of a n5 / zarr dataset, blocks that only overlap
+    with chunks of this dataset that do not exist are dropped, see `occupied_blocks`.
+    """
     assert len(shape) == len(block_shape), '%i; %i' % (len(shape), len(block_shape))
     assert (roi_begin is None) == (roi_end is None)
     have_roi = roi_begin is not None
@@ -50,7 +61,10 @@ def blocks_in_volume(shape, block_shape,
     # we don't have a roi and don't have a block_list_path
     # -> return all block_ids
     if not have_roi and not block_list_path:
-        return list(range(blocking_.numberOfBlocks))
+        block_list = list(range(blocking_.numberOfBlocks))
+        if occupancy is not None:
+            block_list = occupied_blocks(block_list, blocking_, *occupancy, halo=occupancy_halo)
+        return block_list
 
     # if we have a roi load the blocks in roi
     if have_roi:
@@ -70,13 +84,162 @@ def blocks_in_volume(shape, block_shape,
         else:
             block_list = list_from_path
 
+    if occupancy is not None:
+        block_list = occupied_blocks(block_list, blocking_, *occupancy, halo=occupancy_halo)
     return block_list
 
 
+def _block_in_dataset(block, shape, ds_shape, halo):
+    # map the block to the dataset by the ratio of the shapes, with a margin of one
+    # scaled voxel if the shapes are not divisible, to account for rounding of the shape
+    bb = []
+    for b, e, sh, dsh, ha in zip(block.begin, block.end, shape, ds_shape, halo):
+        ratio = dsh / float(sh)
+        margin = ha if dsh % sh == 0 else int(ceil(ratio)) + ha
+        bb.append(slice(max(int(floor(b * ratio)) - margin, 0),
+                        min(int(ceil(e * ratio)) + margin, dsh)))
+    return bb
+
+
+def occupied_blocks(block_list, blocking_, path, key, halo=None):
+    """ Filter the blocks that overlap with at least one existing chunk of a n5 / zarr dataset.
+
+    Chunks that do not exist are empty, so this finds the empty blocks without reading data.
+    The blocks are mapped to the dataset by the ratio of the shapes, so the dataset can be
+    at a different scale than the blocking, e.g. the input of a downscaling step.
+    `halo` is given in dataset coordinates. Datasets that don't support chunk queries (hdf5)
+    or have a different number of dimensions keep all blocks.
+    """
+    with file_reader(path, 'r') as f:
+        ds = f[key]
+        shape = blocking_.roiEnd
+        if not hasattr(ds, 'chunk_exists') or ds.ndim != len(shape):
+            return block_list
+        halo = [0] * ds.ndim if halo is None else halo
+        chunks = ds.chunks
+
+        def _occupied(block_id):
+            bb = _block_in_dataset(blocking_.getBlock(block_id), shape, ds.shape, halo)
+            chunk_ranges = [range(b.start // ch, (b.stop + ch - 1) // ch)
+                            for b, ch in zip(bb, chunks)]
+            return any(ds.chunk_exists(chunk_id) for chunk_id in product(*chunk_ranges))
+
+        return [block_id for block_id in block_list if _occupied(block_id)]
+
+
 def block_to_bb(block):
     return tuple(slice(beg, end) for beg, end in zip(block.begin, block.end))
 
 
+def _chunk_ranges(ds, bb):
+    """ Get the chunk ranges covered by the bounding box, if it is aligned with complete chunks
+    of a dataset that supports direct chunk access (n5 / zarr), otherwise None.
+    """
+    if not hasattr(ds, 'read_chunk') or not isinstance(bb, tuple) or len(bb) != ds.ndim:
+        return None
+    ranges = []
+    for b, sh, ch in zip(bb, ds.shape, ds.chunks):
+        if not isinstance(b, slice) or b.step not in (None, 1):
+            return None
+        start, stop, _ = b.indices(sh)
+        # boundary chunks may be stored cropped, so we only use complete chunks
+        if start % ch != 0 or stop % ch != 0 or stop <= start:
+            return None
+        ranges.append(range(start // ch, stop // ch))
+    return ranges
+
+
+def _chunk_bb(chunk_id, chunk_ranges, chunks):
+    # bounding box of a chunk in the block
+    return tuple(slice((cid - rr.start) * ch, (cid - rr.start + 1) * ch)
+                 for cid, rr, ch in zip(chunk_id, chunk_ranges, chunks))
+
+
+def _digest(data):
+    return hashlib.blake2b(np.ascontiguousarray(data)).digest()
+
+
+def read_block(ds, bb, digests=None):
+    """ Read the bounding box from a dataset.
+
+    If the bounding box is aligned with the chunks of a n5 / zarr dataset, the chunks are read
+    directly and chunks that do not exist are not read, but filled with zeros.
+    If `digests` is given, the digests of the chunks read directly are stored in it,
+    see `write_block`.
+    """
+    chunk_ranges = _chunk_ranges(ds, bb)
+    if chunk_ranges is None:
+        return ds[bb]
+
+    chunks = ds.chunks
+    chunk_ids = list(product(*chunk_ranges))
+    out = None
+    if len(chunk_ids) > 1:
+        out = np.zeros(tuple(len(rr) * ch for rr, ch in zip(chunk_ranges, chunks)),
+                       dtype=ds.dtype)
+    for chunk_id in chunk_ids:
+        chunk = ds.read_chunk(chunk_id)
+        if chunk is None:
+            continue
+        if digests is not None:
+            digests[(id(ds), chunk_id)] = _digest(chunk)
+        if out is None:
+            return chunk
+        out[_chunk_bb(chunk_id, chunk_ranges, chunks)] = chunk
+    return np.zeros(chunks, dtype=ds.dtype) if out is None else out
+
+
+def write_block(ds, bb, data, digests=None):
+    """ Write data to the bounding box of a dataset.
+
+    If the bounding box is aligned with the chunks of a n5 / zarr dataset, the chunks are
+    written directly. Chunks that are still equal to the data read with the same `digests`
+    are not written, nor are empty chunks that do not exist yet.
+    """
+    chunk_ranges = _chunk_ranges(ds, bb)
+    chunks = ds.chunks if chunk_ranges is not None else None
+    if chunk_ranges is None or data.shape != tuple(len(rr) * ch
+                                                    for rr, ch in zip(chunk_ranges, chunks)):
+        ds[bb] = data
+        return
+
+    data = data.astype(ds.dtype, copy=False)
+    for chunk_id in product(*chunk_ranges):
+        chunk = np.ascontiguousarray(data[_chunk_bb(chunk_id, chunk_ranges, chunks)])
+        key = (id(ds), chunk_id)
+        if digests is not None and key in digests and digests[key] == _digest(chunk):
+            continue
+        if not chunk.any() and not ds.chunk_exists(chunk_id):
+            continue
+        ds.write_chunk(chunk_id, chunk)
+
+
+def block_costs_from_volume(path, key, shape, block_shape, block_list=None):
+    """ Estimate the cost of blocks by the number of non-zero voxels
+    in a (possibly downsampled) volume, e.g. a mask or a segmentation at a lower scale.
+
+    Returns dict mapping block ids to the fraction of non-zero voxels in the block,
+    which can be used as block costs for balancing jobs.
+    """
+    with file_reader(path, 'r') as f:
+        ds = f[key]
+        # we only expect small (i.e. downsampled) volumes here
+        volume = ds[:] != 0
+    scale = [vsh / float(sh) for vsh, sh in zip(volume.shape, shape)]
+
+    blocking_ = blocking([0] * len(shape), list(shape), list(block_shape))
+    if block_list is None:
+        block_list = range(blocking_.numberOfBlocks)
+
+    costs = {}
+    for block_id in block_list:
+        block = blocking_.getBlock(block_id)
+        bb = tuple(slice(int(floor(beg * sc)), max(int(ceil(end * sc)), int(floor(beg * sc)) + 1))
+                   for beg, end, sc in zip(block.begin, block.end, scale))
+        costs[block_id] = float(volume[bb].mean())
+    return costs
+
+
 def apply_filter(input_, filter_name, sigma, apply_in_2d=False):
     # apply 3d filter with anisotropic sigma - only supported in vigra
     if isinstance(sigma, (tuple, list)):
@@ -111,12 +274,38 @@ def watershed(input_, seeds, size_filter=0, exclude=None):
 
 
 def apply_size_filter(segmentation, input_, size_filter, exclude=None):
-    ids, sizes = np.unique(segmentation, return_counts=True)
-    filter_ids = ids[sizes < size_filter]
-    if exclude is not None:
-        filter_ids = filter_ids[np.logical_not(np.in1d(filter_ids, exclude))]
-    filter_mask = np.in1d(segmentation, filter_ids).reshape(segmentation.shape)
-    segmentation[filter_mask] = 0
+    """ Remove the segments smaller than `size_filter` and fill them with a watershed.
+
+    The sizes are counted with bincount and the voxels to discard are found with a
+    look-up table, if the label ids are dense, e.g. consecutive after a watershed.
+    Otherwise, the labels are mapped to consecutive ids by np.unique first.
+    """
+    flat = segmentation.ravel()
+    if flat.dtype == np.dtype('uint64'):
+        flat = flat.view('int64')
+    max_id = int(flat.max()) if flat.size > 0 else 0
+
+    if max_id < 2 * flat.size:
+        sizes = np.bincount(flat, minlength=max_id + 1)
+        discard = sizes < size_filter
+        if exclude is not None:
+            exclude = np.asarray(exclude, dtype='int64')
+            discard[exclude[exclude <= max_id]] = False
+        discard_mask = discard[flat]
+        has_background = sizes[0] > 0
+    else:
+        ids, inverse, sizes = np.unique(flat, return_inverse=True, return_counts=True)
+        discard = sizes < size_filter
+        if exclude is not None:
+            discard[np.isin(ids, exclude)] = False
+        discard_mask = discard[inverse.ravel()]
+        has_background = ids[0] == 0
+
+    # nothing to fill
+    if not has_background and not discard_mask.any():
+        return segmentation, max_id
+
+    segmentation[discard_mask.reshape(segmentation.shape)] = 0
     _, max_id = vigra.analysis.watershedsNew(input_, seeds=segmentation, out=segmentation)
     return segmentation, max_id
 
@@ -151,17 +340,35 @@ def make_checkerboard_block_lists(blocking, roi_begin=None, roi_end=None):
 
 
 class InterpolatedVolume(object):
-    def __init__(self, volume, output_shape, spline_order=0):
-        assert isinstance(volume, np.ndarray)
+    """ Interpolate a volume to a larger shape on the fly.
+
+    Nearest neighbor interpolation (spline order 0) uses index arithmetic, output voxel x
+    is mapped to voxel floor(x * volume_shape / output_shape) of the volume.
+    This is exact for label volumes and masks and does not convert to float.
+    The upsampled tiles of `tile_shape` voxels of the volume are kept in a LRU cache of
+    `cache_size` tiles, so that overlapping requests of neighboring blocks are not recomputed.
+    Higher spline orders are resized with vigra.
+    The volume can also be a dataset, then only the parts needed for a request are loaded.
+    """
+    spline_orders = {'nearest': 0, 'linear': 1, 'spline': 3}
+
+    def __init__(self, volume, output_shape, spline_order=0, interpolation=None,
+                 cache_size=0, tile_shape=(16, 16, 16)):
+        assert hasattr(volume, 'shape') and hasattr(volume, '__getitem__')
         assert len(output_shape) == volume.ndim == 3, "Only 3d supported"
         assert all(osh > vsh for osh, vsh in zip(output_shape, volume.shape)),\
             "Can only interpolate to larger shapes, got %s %s" % (str(output_shape), str(volume.shape))
         self.volume = volume
-        self.shape = output_shape
+        self.shape = tuple(output_shape)
         self.dtype = volume.dtype
 
+        if interpolation is not None:
+            assert interpolation in self.spline_orders, interpolation
+            spline_order = self.spline_orders[interpolation]
+        self.spline_order = spline_order
+
         self.scale = [sh / float(fsh) for sh, fsh in zip(self.volume.shape, self.shape)]
-        if np.dtype(self.dtype) == np.bool:
+        if np.dtype(self.dtype) == np.dtype('bool'):
             self.min, self.max = 0, 1
         else:
             try:
@@ -173,11 +380,73 @@ class InterpolatedVolume(object):
 
         self.interpol_function = partial(vigra.sampling.resize, order=spline_order)
 
+        self.cache_size = cache_size
+        self.tile_shape = tuple(tile_shape)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
     def _interpolate(self, data, shape):
         data = self.interpol_function(data.astype('float32'), shape=shape)
         np.clip(data, self.min, self.max, out=data)
         return data.astype(self.dtype)
 
+    def _source_index(self, start, stop, axis):
+        # the voxels of the volume that the output voxels in [start, stop) are mapped to
+        return np.arange(start, stop) * self.volume.shape[axis] // self.shape[axis]
+
+    def _upsample_nearest(self, index):
+        sources = [self._source_index(ind.start, ind.stop, axis)
+                   for axis, ind in enumerate(index)]
+        data = np.asarray(self.volume[tuple(slice(int(src[0]), int(src[-1]) + 1)
+                                            for src in sources)])
+        # speed up for constant regions, e.g. empty blocks and masks
+        first = data.flat[0]
+        if (data == first).all():
+            return np.full(tuple(len(src) for src in sources), first, dtype=self.dtype)
+        # repeat the voxels of the volume by the number of output voxels mapped to them
+        for axis, src in enumerate(sources):
+            data = np.repeat(data, np.bincount(src - src[0]), axis=axis)
+        return data
+
+    def _output_begin(self, source_begin, axis):
+        # the first output voxel that is mapped to the voxel source_begin of the volume
+        return -(-source_begin * self.shape[axis] // self.volume.shape[axis])
+
+    def _tile_bb(self, tile_id):
+        return tuple(slice(self._output_begin(tid * ts, axis),
+                           min(self._output_begin((tid + 1) * ts, axis), self.shape[axis]))
+                     for axis, (tid, ts) in enumerate(zip(tile_id, self.tile_shape)))
+
+    def _get_tile(self, tile_id):
+        with self._lock:
+            if tile_id in self._cache:
+                self._cache.move_to_end(tile_id)
+                return self._cache[tile_id]
+        tile = self._upsample_nearest(self._tile_bb(tile_id))
+        with self._lock:
+            self._cache[tile_id] = tile
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return tile
+
+    def _upsample_nearest_cached(self, index):
+        # the tiles are aligned with the voxels of the volume, so assembling the
+        # request from tiles gives the same result as upsampling it directly
+        tile_ranges = [range(self._source_index(ind.start, ind.start + 1, axis)[0] // ts,
+                             self._source_index(ind.stop - 1, ind.stop, axis)[0] // ts + 1)
+                       for axis, (ind, ts) in enumerate(zip(index, self.tile_shape))]
+        out = np.empty(tuple(ind.stop - ind.start for ind in index), dtype=self.dtype)
+        for tile_id in product(*tile_ranges):
+            tile_bb = self._tile_bb(tile_id)
+            begin = [max(ind.start, tb.start) for ind, tb in zip(index, tile_bb)]
+            end = [min(ind.stop, tb.stop) for ind, tb in zip(index, tile_bb)]
+            out_bb = tuple(slice(b - ind.start, e - ind.start)
+                           for b, e, ind in zip(begin, end, index))
+            local_bb = tuple(slice(b - tb.start, e - tb.start)
+                             for b, e, tb in zip(begin, end, tile_bb))
+            out[out_bb] = self._get_tile(tile_id)[local_bb]
+        return out
+
     def _normalize_index(self, index):
         if isinstance(index, slice):
             index = (index,)
@@ -197,13 +466,21 @@ class InterpolatedVolume(object):
     def __getitem__(self, index):
         index = self._normalize_index(index)
         ret_shape = tuple(ind.stop - ind.start for ind in index)
+        if any(sh <= 0 for sh in ret_shape):
+            return np.zeros(tuple(max(sh, 0) for sh in ret_shape), dtype=self.dtype)
+
+        if self.spline_order == 0:
+            if self.cache_size > 0:
+                return self._upsample_nearest_cached(index)
+            return self._upsample_nearest(index)
+
         index_ = tuple(slice(int(floor(ind.start * sc)),
                              int(ceil(ind.stop * sc))) for ind, sc in zip(index, self.scale))
         # vigra can't deal with singleton dimension
         small_shape = tuple(idx.stop - idx.start for idx in index_)
         index_ = tuple(slice(idx.start, idx.stop) if sh > 1 else
                        slice(idx.start, idx.stop + 1) for idx, sh in zip(index_, small_shape))
-        data = self.volume[index_]
+        data = np.asarray(self.volume[index_])
 
         # speed ups for empty blocks and masks
         dsum = data.sum()
@@ -217,17 +494,18 @@ class InterpolatedVolume(object):
         raise NotImplementedError("Setitem not implemented")
 
 
-def load_mask(mask_path, mask_key, shape):
-    with file_reader(mask_path, 'r') as f_mask:
-        mshape = f_mask[mask_key].shape
+@contextmanager
+def load_mask(mask_path, mask_key, shape, cache_size=64):
+    """ Open a mask for a volume of the given shape; the mask file is closed on exit.
 
-    # check if th mask is at full - shape, otherwise interpolate
-    if tuple(mshape) == tuple(shape):
-        # TODO this only works for n5
-        mask = z5py.File(mask_path)[mask_key]
+    A mask at full shape is returned as dataset, a downsampled mask is interpolated
+    with nearest neighbors on the fly. It is not loaded into memory, instead the parts needed
+    for the requested blocks are read and the upsampled tiles are cached, see `InterpolatedVolume`.
+    """
+    with file_reader(mask_path, 'r') as f_mask:
+        mask = f_mask[mask_key]
 
-    else:
-        with file_reader(mask_path, 'r') as f_mask:
-            mask = f_mask[mask_key][:].astype('bool')
-        mask = InterpolatedVolume(mask, shape, spline_order=0)
-    return mask
+        # check if th mask is at full - shape, otherwise interpolate
+        if tuple(mask.shape) != tuple(shape):
+            mask = InterpolatedVolume(mask, shape, spline_order=0, cache_size=cache_size)
+        yield mask
@@ -4,6 +4,7 @@ import os
 import sys
 import json
 from math import ceil
+from concurrent import futures
 
 import luigi
 import numpy as np
@@ -25,6 +26,7 @@ class WatershedBase(luigi.Task):
 
     task_name = 'watershed'
     src_file = os.path.abspath(__file__)
+    allow_block_queue = True
 
     # input and output volumes
     input_path = luigi.Parameter()
@@ -42,8 +44,9 @@ class WatershedBase(luigi.Task):
                        'apply_dt_2d': True, 'pixel_pitch': None,
                        'apply_ws_2d': True, 'sigma_seeds': 2., 'size_filter': 25,
                        'sigma_weights': 2., 'halo': [0, 0, 0],
-                       'two_pass': False, 'channel_begin': 0, 'channel_end': None,
-                       'alpha': 0.8})
+                       'two_pass': False, 'consistent_seeds': False,
+                       'channel_begin': 0, 'channel_end': None,
+                       'alpha': 0.8, 'slice_threads': 1})
         return config
 
     def clean_up_for_retry(self, block_list):
@@ -90,6 +93,9 @@ class WatershedBase(luigi.Task):
 
         # check if we run a 2-pass watershed
         is_2pass = ws_config.pop('two_pass', False)
+        if ws_config.get('consistent_seeds', False):
+            assert not is_2pass, "Can't combine consistent seeds with two-pass watershed"
+            assert sum(ws_config.get('halo', [0, 0, 0])) > 0, "Need halo for consistent seeds"
 
         # run 2 passes of watersheds with checkerboard pattern
         # for the blocks
@@ -180,6 +186,121 @@ def _make_hmap(input_, distances, alpha, sigma_weights):
     return hmap
 
 
+def _smooth_2d(data, sigma):
+    # smooth all slices at once, with zero sigma along z
+    if sigma == 0:
+        return data
+    sigma = (0.,) + (tuple(sigma) if isinstance(sigma, (list, tuple)) else (sigma, sigma))
+    return vu.apply_filter(data, 'gaussianSmoothing', sigma)
+
+
+def _make_hmap_2d(input_, distances, alpha, sigma_weights):
+    # same as `_make_hmap` for each slice, but for the whole stack at once
+    distances = distances.astype('float32')
+    distances -= distances.min(axis=(1, 2), keepdims=True)
+    distances /= distances.max(axis=(1, 2), keepdims=True)
+    hmap = (1. - alpha) * input_ + alpha * (1. - distances)
+    return _smooth_2d(hmap, sigma_weights)
+
+
+def _map_slices(func, n_slices, n_threads):
+    if n_threads <= 1:
+        return [func(z) for z in range(n_slices)]
+    with futures.ThreadPoolExecutor(n_threads) as tp:
+        return list(tp.map(func, range(n_slices)))
+
+
+def _seeds_2d(dtz):
+    seeds = vigra.analysis.localMaxima(dtz, marker=np.nan,
+                                       allowAtBorder=True, allowPlateaus=True)
+    return vigra.analysis.labelImageWithBackground(np.isnan(seeds).view('uint8'))
+
+
+def _apply_watershed_2d(input_, dt, offset, config, mask=None):
+    sigma_seeds = config.get('sigma_seeds', 2.)
+    sigma_weights = config.get('sigma_weights', 2.)
+    size_filter = config.get('size_filter', 25)
+    alpha = config.get('alpha', 0.2)
+    n_threads = config.get('slice_threads', 1)
+
+    dt = _smooth_2d(dt, sigma_seeds)
+    hmap = _make_hmap_2d(input_, dt, alpha, sigma_weights)
+    ws = np.zeros(input_.shape, dtype='uint64')
+
+    # run the watershed for the slices independently
+    def _ws_slice(z):
+        wsz, max_id = vu.watershed(hmap[z], seeds=_seeds_2d(dt[z]), size_filter=size_filter)
+        if mask is not None:
+            wsz[mask[z]] = 0
+            inv_mask = np.logical_not(mask[z])
+            # NOTE we might have no pixels in the mask for this slice
+            max_id = int(wsz[inv_mask].max()) if inv_mask.sum() > 0 else 0
+        ws[z] = wsz
+        return max_id
+
+    max_ids = _map_slices(_ws_slice, ws.shape[0], n_threads)
+    # the offsets of the slices are the prefix sum over the max ids
+    offsets = (offset + np.cumsum([0] + max_ids[:-1])).astype('uint64')[:, None, None]
+    if mask is None:
+        ws += offsets
+    else:
+        ws += np.where(mask, np.uint64(0), offsets)
+    return ws
+
+
+def _apply_watershed_with_seeds_2d(input_, dt, offset, initial_seeds, config, mask=None):
+    sigma_seeds = config.get('sigma_seeds', 2.)
+    sigma_weights = config.get('sigma_weights', 2.)
+    size_filter = config.get('size_filter', 25)
+    alpha = config.get('alpha', 0.2)
+    n_threads = config.get('slice_threads', 1)
+
+    dt = _smooth_2d(dt, sigma_seeds)
+    # don't place maxima at initial seeds
+    dt[initial_seeds != 0] = 0
+    hmap = _make_hmap_2d(input_, dt, alpha, sigma_weights)
+    ws = np.zeros(input_.shape, dtype='uint64')
+
+    # run the watershed for the slices independently with local seed ids
+    def _ws_slice(z):
+        seeds = _seeds_2d(dt[z])
+        # remove seeds in mask
+        if mask is not None:
+            seeds[mask[z]] = 0
+        n_seeds = int(seeds.max())
+
+        # label the initial seeds after the new seeds, because vigra
+        # watersheds can only handle uint32 seeds, and we WILL overflow uint32
+        initial_seeds_z = initial_seeds[z]
+        initial_seed_mask = initial_seeds_z != 0
+        initial_ids, initial_labels = np.unique(initial_seeds_z[initial_seed_mask],
+                                                return_inverse=True)
+        seeds[initial_seed_mask] = initial_labels + n_seeds + 1
+        exclude = np.arange(n_seeds + 1, n_seeds + len(initial_ids) + 1)
+
+        wsz, _ = vu.watershed(hmap[z], seeds=seeds, size_filter=size_filter,
+                              exclude=exclude)
+        if mask is not None:
+            wsz[mask[z]] = 0
+        ws[z] = wsz
+        return n_seeds, initial_ids
+
+    results = _map_slices(_ws_slice, ws.shape[0], n_threads)
+    # the offsets of the slices are the prefix sum over the number of new seeds
+    offsets = offset + np.cumsum([0] + [res[0] for res in results[:-1]])
+
+    # map the new seeds to their offset ids and the initial seeds back to their ids
+    def _map_slice(z):
+        n_seeds, initial_ids = results[z]
+        mapping = np.concatenate([np.zeros(1, dtype='uint64'),
+                                  np.arange(1, n_seeds + 1, dtype='uint64') + np.uint64(offsets[z]),
+                                  initial_ids.astype('uint64')])
+        ws[z] = mapping[ws[z]]
+
+    _map_slices(_map_slice, ws.shape[0], n_threads)
+    return ws
+
+
 # apply watershed
 def _apply_watershed(input_, dt, offset, config, mask=None):
     apply_2d = config.get('apply_ws_2d', True)
@@ -190,28 +311,7 @@ def _apply_watershed(input_, dt, offset, config, mask=None):
 
     # apply the watersheds in 2d
     if apply_2d:
-        ws = np.zeros_like(input_, dtype='uint64')
-        for z in range(ws.shape[0]):
-            # compute seeds for this slice
-            dtz = vu.apply_filter(dt[z], 'gaussianSmoothing',
-                                  sigma_seeds) if sigma_seeds != 0 else dt[z]
-            seeds = vigra.analysis.localMaxima(dtz, marker=np.nan,
-                                               allowAtBorder=True, allowPlateaus=True)
-            seeds = vigra.analysis.labelImageWithBackground(np.isnan(seeds).view('uint8'))
-            # run watershed for this slice
-            hmap = _make_hmap(input_[z], dtz, alpha, sigma_weights)
-            wsz, max_id = vu.watershed(hmap, seeds=seeds, size_filter=size_filter)
-            # mask seeds if we have a mask
-            if mask is None:
-                wsz += offset
-            else:
-                wsz[mask[z]] = 0
-                inv_mask = np.logical_not(mask[z])
-                # NOTE we might have no pixels in the mask for this slice
-                max_id = int(wsz[inv_mask].max()) if inv_mask.sum() > 0 else 0
-                wsz[inv_mask] += offset
-            ws[z] = wsz
-            offset += max_id
+        ws = _apply_watershed_2d(input_, dt, offset, config, mask)
 
     # apply the watersheds in 3d
     else:
@@ -239,57 +339,8 @@ def _apply_watershed_with_seeds(input_, dt, offset,
 
     # apply the watersheds in 2d
     if apply_2d:
-        ws = np.zeros_like(input_, dtype='uint64')
-        for z in range(ws.shape[0]):
-
-            # smooth the distance transform if specified
-            dtz = vu.apply_filter(dt[z], 'gaussianSmoothing',
-                                  sigma_seeds) if sigma_seeds != 0 else dt[z]
-
-            # get the initial seeds for this slice
-            # and a mask for the inital seeds
-            initial_seeds_z = initial_seeds[z]
-            initial_seed_mask = initial_seeds_z != 0
-            # don't place maxima at initial seeds
-            dtz[initial_seed_mask] = 0
-
-            seeds = vigra.analysis.localMaxima(dtz, marker=np.nan,
-                                               allowAtBorder=True, allowPlateaus=True)
-            seeds = vigra.analysis.labelImageWithBackground(np.isnan(seeds).view('uint8'))
-            # remove seeds in mask
-            if mask is not None:
-                seeds[mask[z]] = 0
-
-            # add offset to seeds
-            seeds[seeds != 0] += offset
-            # add initial seeds
-            seeds[initial_seed_mask] = initial_seeds_z[initial_seed_mask]
-
-            # we need to remap the seeds consecutively, because vigra
-            # watersheds can only handle uint32 seeds, and we WILL overflow uint32
-            seeds, _, old_to_new = vigra.analysis.relabelConsecutive(seeds,
-                                                                     start_label=1,
-                                                                     keep_zeros=True)
-            new_to_old = {new: old for old, new in old_to_new.items()}
-
-            # run watershed
-            hmap = _make_hmap(input_[z], dtz, alpha, sigma_weights)
-            wsz, max_id = vu.watershed(hmap, seeds=seeds, size_filter=size_filter,
-                                       exclude=initial_seeds_z)
-            # mask the result if we have a mask
-            if mask is not None:
-                wsz[mask[z]] = 0
-                inv_mask = np.logical_not(mask[z])
-                # NOTE we might not have any pixels in mask for 2d slice
-                max_id = int(wsz[inv_mask].max()) if inv_mask.sum() > 0 else 0
-
-            # increase the offset
-            offset += max_id
-            # map back to original ids
-            wsz = nt.takeDict(new_to_old, wsz)
-            ws[z] = wsz
-        #
-        return ws
+        return _apply_watershed_with_seeds_2d(input_, dt, offset, initial_seeds,
+                                              config, mask)
 
     # apply the watersheds in 3d
     else:
@@ -303,6 +354,7 @@ def _apply_watershed_with_seeds(input_, dt, offset,
         # remove seeds in mask
         if mask is not None:
             seeds[mask] = 0
+        seeds = seeds.astype('uint64')
         seeds[seeds != 0] += offset
 
         # add the initial seeds
@@ -311,22 +363,145 @@ def _apply_watershed_with_seeds(input_, dt, offset,
 
         # we need to remap the seeds consecutively, because vigra
         # watersheds can only handle uint32 seeds, and we WILL overflow uint32
-        seeds, _, old_to_new = vigra.analysis.relabelConsecutive(seeds,
-                                                                 start_label=1,
-                                                                 keep_zeros=True)
-        new_to_old = {new: old for old, new in old_to_new.items()}
-
-        # run watershed
+        seeds, max_id, old_to_new = vigra.analysis.relabelConsecutive(seeds,
+                                                                      start_label=1,
+                                                                      keep_zeros=True)
+        seeds = seeds.astype('uint32')
+        new_to_old = np.zeros(int(max_id) + 1, dtype='uint64')
+        new_to_old[list(old_to_new.values())] = list(old_to_new.keys())
+
+        # run watershed, the initial seeds are excluded from the size filter
+        # by their consecutive ids
         initial_seed_ids = np.unique(initial_seeds[initial_seed_mask])
+        exclude = np.array([old_to_new[seed_id] for seed_id in initial_seed_ids], dtype='int64')
         hmap = _make_hmap(input_, dt, alpha, sigma_weights)
         ws, max_id = vu.watershed(hmap, seeds=seeds, size_filter=size_filter,
-                                  exclude=initial_seed_ids)
-        ws = nt.takeDict(new_to_old, ws)
+                                  exclude=exclude)
+        ws = new_to_old[ws]
         if mask is not None:
             ws[mask] = 0
         return ws
 
 
+def _owned_seed_ids(seeds, input_bb, inner_bb, shape, axes):
+    """ Relabel the seeds of a block with halo consecutively and map them to global ids.
+
+    The representative of a seed is its first voxel in raster order and its global id
+    is the linear index of this voxel in the volume (plus one). A seed is owned by the block
+    whose inner block contains the representative; neighbors use the owner's id if they
+    find the seed in their halo. Seeds that are cut by the border of the block with halo
+    (along `axes`) may have their representative outside of it; they are only kept
+    if this block owns them, otherwise they are removed.
+    """
+    seed_ids, first_index, labels = np.unique(seeds.ravel(), return_index=True,
+                                              return_inverse=True)
+    labels = labels.reshape(seeds.shape)
+    # raster order in the block is the same as raster order in the volume
+    coords = np.unravel_index(first_index, seeds.shape)
+    owned = np.ones(len(seed_ids), dtype='bool')
+    for coord, bb in zip(coords, inner_bb):
+        owned &= (coord >= bb.start) & (coord < bb.stop)
+
+    # find the seeds that are cut by the faces of the block with halo,
+    # unless the face is part of the volume border
+    cut = np.zeros(len(seed_ids), dtype='bool')
+    for axis in axes:
+        bb = input_bb[axis]
+        if bb.start > 0:
+            cut[np.take(labels, 0, axis=axis)] = True
+        if bb.stop < shape[axis]:
+            cut[np.take(labels, -1, axis=axis)] = True
+
+    keep = owned | np.logical_not(cut)
+    if seed_ids[0] == 0:
+        keep[0] = False
+    global_ids = np.ravel_multi_index(tuple(coord + bb.start
+                                            for coord, bb in zip(coords, input_bb)),
+                                      shape).astype('uint64') + 1
+    global_ids = np.concatenate([np.zeros(1, dtype='uint64'), global_ids[keep]])
+    new_labels = np.zeros(len(seed_ids), dtype='uint32')
+    new_labels[keep] = np.arange(1, len(global_ids), dtype='uint32')
+    return new_labels[labels], global_ids
+
+
+def _filter_inner_segments(ws, hmap, inner_bb, size_filter):
+    # only apply the size filter to segments that are contained in the inner block:
+    # the size of segments that extend into the halo depends on the block
+    # and their ids are also used by the neighbors
+    halo_mask = np.ones(ws.shape, dtype='bool')
+    halo_mask[inner_bb] = False
+    exclude = np.nonzero(np.bincount(ws[halo_mask]))[0]
+    ws, _ = vu.apply_size_filter(ws, hmap, size_filter, exclude=exclude)
+    return ws
+
+
+def _apply_watershed_consistent(input_, dt, input_bb, inner_bb, shape, config, mask=None):
+    """ Apply watershed with seeds that are consistent between neighboring blocks.
+
+    The seeds are computed on the block with halo and get global ids by the ownership
+    rule of `_owned_seed_ids`, so fragments that cross the block faces get the same id
+    in both blocks. The size filter is only applied to fragments inside of the inner block.
+    For consistent fragments the halo must cover the seeds and the smoothing of the distance
+    transform close to the block faces.
+    """
+    apply_2d = config.get('apply_ws_2d', True)
+    sigma_seeds = config.get('sigma_seeds', 2.)
+    sigma_weights = config.get('sigma_weights', 2.)
+    size_filter = config.get('size_filter', 25)
+    alpha = config.get('alpha', 0.2)
+    n_threads = config.get('slice_threads', 1)
+
+    if len(input_bb) == 4:
+        input_bb = input_bb[1:]
+
+    if apply_2d:
+        dt = _smooth_2d(dt, sigma_seeds)
+        seeds = np.zeros(dt.shape, dtype='uint64')
+
+        def _seed_slice(z):
+            seeds[z] = _seeds_2d(dt[z])
+            return int(seeds[z].max())
+
+        max_ids = _map_slices(_seed_slice, dt.shape[0], n_threads)
+        # make the seeds of the slices unique
+        offsets = np.cumsum([0] + max_ids[:-1]).astype('uint64')[:, None, None]
+        seeds += np.where(seeds != 0, offsets, np.uint64(0))
+        hmap = _make_hmap_2d(input_, dt, alpha, sigma_weights)
+    else:
+        if sigma_seeds != 0:
+            dt = vu.apply_filter(dt, 'gaussianSmoothing', sigma_seeds)
+        seeds = vigra.analysis.localMaxima3D(dt, marker=np.nan,
+                                             allowAtBorder=True, allowPlateaus=True)
+        seeds = vigra.analysis.labelVolumeWithBackground(np.isnan(seeds).view('uint8'))
+        hmap = _make_hmap(input_, dt, alpha, sigma_weights)
+
+    # remove seeds in mask
+    if mask is not None:
+        seeds[mask] = 0
+    # the 2d seeds are not cut by the faces along z
+    axes = (1, 2) if apply_2d else (0, 1, 2)
+    seeds, global_ids = _owned_seed_ids(seeds, input_bb, inner_bb, shape, axes)
+
+    if apply_2d:
+        ws = np.zeros(input_.shape, dtype='uint32')
+
+        def _ws_slice(z):
+            ws[z], _ = vigra.analysis.watershedsNew(hmap[z], seeds=seeds[z])
+            if size_filter > 0:
+                ws[z] = _filter_inner_segments(ws[z], hmap[z], inner_bb[1:], size_filter)
+
+        _map_slices(_ws_slice, ws.shape[0], n_threads)
+    else:
+        ws, _ = vigra.analysis.watershedsNew(hmap, seeds=seeds)
+        if size_filter > 0:
+            ws = _filter_inner_segments(ws, hmap, inner_bb, size_filter)
+
+    ws = global_ids[ws]
+    if mask is not None:
+        ws[mask] = 0
+    return ws
+
+
 def _get_bbs(blocking, block_id, config):
     # read the input config
     halo = list(config.get('halo', [0, 0, 0]))
@@ -342,71 +517,71 @@ def _get_bbs(blocking, block_id, config):
     return input_bb, inner_bb, output_bb
 
 
-def _read_data(ds_in, input_bb, config):
+def _read_data(ds_in, input_bb, config, stats):
     # read the input data
     if ds_in.ndim == 4:
         channel_begin = config.get('channel_begin', 0)
         channel_end = config.get('channel_end', None)
         input_bb = (slice(channel_begin, channel_end),) + input_bb
-        input_ = vu.normalize(ds_in[input_bb])
+        input_ = vu.normalize(stats.read(ds_in, input_bb))
         agglomerate = config.get('agglomerate_channels', 'mean')
         assert agglomerate in ('mean', 'max', 'min')
         input_ = getattr(np, agglomerate)(input_, axis=0)
     else:
-        input_ = vu.normalize(ds_in[input_bb])
+        input_ = vu.normalize(stats.read(ds_in, input_bb))
     return input_
 
 
-def _ws_block(blocking, block_id, ds_in, ds_out, config, pass_):
-    fu.log("start processing block %i" % block_id)
+def _read_initial_seeds(ds_out, input_bb, blocking, block_id, stats):
+    """ Read the seeds from the first pass of the two-pass watershed.
+
+    Blocks of the same pass are diagonal neighbors, their outputs may already be
+    written (by another thread or job), so we ignore them to keep the result
+    independent of the processing order.
+    """
+    initial_seeds = stats.read(ds_out, input_bb)
+    block_shape = blocking.blockShape
+    # the checkerboard passes alternate with the parity of the block coordinates
+    block_pos = [beg // bs for beg, bs in zip(blocking.getBlock(block_id).begin, block_shape)]
+    parities = np.meshgrid(*[(np.arange(b.start, b.stop) // bs) % 2
+                             for b, bs in zip(input_bb, block_shape)], indexing='ij')
+    same_pass = (sum(parities) % 2) == (sum(block_pos) % 2)
+    initial_seeds[same_pass] = 0
+    return initial_seeds
+
+
+def _read_ws_block(blocking, block_id, ds_in, ds_out, mask, config, pass_, stats):
     input_bb, inner_bb, output_bb = _get_bbs(blocking, block_id,
                                              config)
-    input_ = _read_data(ds_in, input_bb, config)
-
-    # apply distance transform
-    dt = _apply_dt(input_, config)
-
-    # get offset to make new seeds unique between blocks
-    # (we need to relabel later to make processing efficient !)
-    offset = block_id * np.prod(blocking.blockShape)
+    # get the mask and check if we have any pixels
+    in_mask = None
+    if mask is not None:
+        in_mask = stats.read(mask, input_bb).astype('bool')
+        if np.sum(in_mask[inner_bb]) == 0:
+            return None
 
-    # check which pass we are in and apply the according watershed
-    if pass_ in (1, None):
-        # single-pass watershed or first pass of two-pass watershed:
-        # -> apply normal ws and write the results to the inner volume
-        ws = _apply_watershed(input_, dt, offset, config)
-        ds_out[output_bb] = ws[inner_bb]
-    else:
-        # second pass of two pass watershed -> apply ws with initial seeds
-        # write the results to the inner volume
-        if len(input_bb) == 4:
-            input_bb = input_bb[1:]
-        initial_seeds = ds_out[input_bb]
-        ws = _apply_watershed_with_seeds(input_, dt,
-                                         offset, initial_seeds, config)
-        ds_out[output_bb] = ws[inner_bb]
+    # read the input
+    input_ = _read_data(ds_in, input_bb, config, stats)
 
-    # log block success
-    fu.log_block_success(block_id)
+    # in the second pass of the two pass watershed, read the seeds of the first pass
+    initial_seeds = None
+    if pass_ == 2 and not config.get('consistent_seeds', False):
+        seeds_bb = input_bb[1:] if len(input_bb) == 4 else input_bb
+        initial_seeds = _read_initial_seeds(ds_out, seeds_bb, blocking, block_id, stats)
+    return input_bb, inner_bb, output_bb, input_, in_mask, initial_seeds
 
 
-def _ws_block_masked(blocking, block_id,
-                     ds_in, ds_out, mask, config, pass_):
-    fu.log("start processing block %i" % block_id)
-    input_bb, inner_bb, output_bb = _get_bbs(blocking, block_id,
-                                             config)
-    # get the mask and check if we have any pixels
-    in_mask = mask[input_bb].astype('bool')
-    out_mask = in_mask[inner_bb]
-    if np.sum(out_mask) == 0:
-        fu.log_block_success(block_id)
-        return
-    # read the input
-    input_ = _read_data(ds_in, input_bb, config)
+def _ws_block(blocking, block_id, data, config, pass_):
+    # the block is empty or entirely masked
+    if data is None:
+        return None
+    input_bb, inner_bb, output_bb, input_, in_mask, initial_seeds = data
 
     # mask the input
-    inv_mask = np.logical_not(in_mask)
-    input_[inv_mask] = 1
+    inv_mask = None
+    if in_mask is not None:
+        inv_mask = np.logical_not(in_mask)
+        input_[inv_mask] = 1
 
     # apply distance transform
     dt = _apply_dt(input_, config)
@@ -416,23 +591,20 @@ def _ws_block_masked(blocking, block_id,
     offset = block_id * np.prod(blocking.blockShape)
 
     # check which pass we are in and apply the according watershed
-    if pass_ in (1, None):
+    if config.get('consistent_seeds', False):
+        # single-pass watershed with seeds that are consistent between blocks
+        ws = _apply_watershed_consistent(input_, dt, input_bb, inner_bb, blocking.roiEnd,
+                                         config, inv_mask)
+    elif pass_ in (1, None):
         # single-pass watershed or first pass of two-pass watershed:
         # -> apply normal ws and write the results to the inner volume
         ws = _apply_watershed(input_, dt, offset, config, inv_mask)
-        ds_out[output_bb] = ws[inner_bb]
     else:
         # second pass of two pass watershed -> apply ws with initial seeds
         # write the results to the inner volume
-        if len(input_bb) == 4:
-            input_bb = input_bb[1:]
-        initial_seeds = ds_out[input_bb]
         ws = _apply_watershed_with_seeds(input_, dt, offset, initial_seeds,
                                          config, inv_mask)
-        ds_out[output_bb] = ws[inner_bb]
-
-    # log block success
-    fu.log_block_success(block_id)
+    return output_bb, ws[inner_bb]
 
 
 def watershed(job_id, config_path):
@@ -454,7 +626,6 @@ def watershed(job_id, config_path):
         shape = shape[1:]
 
     block_shape = list(config['block_shape'])
-    block_list = config['block_list']
 
     # read the output config
     output_path = config['output_path']
@@ -468,6 +639,7 @@ def watershed(job_id, config_path):
 
     # get the blocking
     blocking = nt.blocking([0, 0, 0], shape, block_shape)
+    n_threads = config.get('threads_per_job', 1)
 
     # submit blocks
     with vu.file_reader(input_path, 'r') as f_in, vu.file_reader(output_path) as f_out:
@@ -476,18 +648,28 @@ def watershed(job_id, config_path):
         ds_out = f_out[output_key]
         assert ds_out.ndim == 3
 
-        # note that the mask is usually small enough to keep it
-        # in memory (and we interpolate to get to the full volume)
-        # if this does not hold need to change this code!
+        def _write(block_id, result, stats):
+            output_bb, ws = result
+            stats.write(ds_out, output_bb, ws)
+
+        def _process_blocks(mask):
+            # the blocks of a job are independent, because the blocks of
+            # the two-pass watershed only read the seeds of the other pass
+            fu.pipeline_blocks(fu.blocks_to_process(job_id, config),
+                               lambda block_id, stats: _read_ws_block(blocking, block_id,
+                                                                      ds_in, ds_out, mask,
+                                                                      config, pass_, stats),
+                               lambda block_id, data: _ws_block(blocking, block_id, data,
+                                                                config, pass_),
+                               _write, config, n_threads)
+
+        # the mask is not loaded into memory, but read (and interpolated)
+        # for the blocks, see `vu.load_mask`
         if with_mask:
-            mask = vu.load_mask(mask_path, mask_key, shape)
-            for block_id in block_list:
-                _ws_block_masked(blocking, block_id,
-                                 ds_in, ds_out, mask, config, pass_)
-
+            with vu.load_mask(mask_path, mask_key, shape) as mask:
+                _process_blocks(mask)
         else:
-            for block_id in block_list:
-                _ws_block(blocking, block_id, ds_in, ds_out, config, pass_)
+            _process_blocks(None)
     # log success
     fu.log_job_success(job_id)
 
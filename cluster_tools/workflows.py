@@ -92,7 +92,8 @@ class MulticutSegmentationWorkflow(WorkflowBase):
                             input_key=self.ws_key,
                             graph_path=self.problem_path,
                             output_key=graph_key,
-                            n_scales=1)
+                            n_scales=1,
+                            serialize_sub_problems=True)
         if self.sanity_checks:
             graph_block_prefix = os.path.join(self.problem_path,
                                               's0', 'sub_graphs', 'block_')
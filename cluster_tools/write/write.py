@@ -4,6 +4,8 @@ import os
 import sys
 import json
 import pickle
+import threading
+from collections import OrderedDict
 from concurrent import futures
 
 import luigi
@@ -33,8 +35,8 @@ class WriteBase(luigi.Task):
     output_key = luigi.Parameter()
     # path to the node assignments
     # the key is optional, because the assignment can either be a
-    # dense assignment table stored as n5 dataset
-    # or a sparse table stored as pickled python map
+    # dense assignment vector or a sparse assignment table (n_labels x 2)
+    # stored as n5 dataset or a sparse table stored as pickled python map
     assignment_path = luigi.Parameter()
     assignment_key = luigi.Parameter(default=None)
     # the task we depend on
@@ -44,6 +46,14 @@ class WriteBase(luigi.Task):
     identifier = luigi.Parameter()
     offset_path = luigi.Parameter(default='')
 
+    @staticmethod
+    def default_task_config():
+        # we use this to get also get the common default config
+        config = LocalTask.default_task_config()
+        config.update({'assignment_cache_size': 64,
+                       'max_dense_assignments': int(1e8)})
+        return config
+
     def requires(self):
         return self.dependency
 
@@ -66,7 +76,12 @@ class WriteBase(luigi.Task):
             f.require_dataset(self.output_key, shape=shape, chunks=chunks,
                               compression='gzip', dtype='uint64')
 
-        n_threads = self.get_task_config().get('threads_per_core', 1)
+        task_config = self.get_task_config()
+        n_threads = task_config.get('threads_per_core', 1)
+        # number of assignment chunks cached per job
+        cache_size = task_config.get('assignment_cache_size', 64)
+        # dense assignment vectors up to this length are loaded into memory
+        max_dense = task_config.get('max_dense_assignments', int(1e8))
 
         # check if input and output datasets are identical
         in_place = (self.input_path == self.output_path) and (self.input_key == self.output_key)
@@ -79,7 +94,8 @@ class WriteBase(luigi.Task):
         # as well as block shape
         config = {'input_path': self.input_path, 'input_key': self.input_key,
                   'block_shape': block_shape, 'n_threads': n_threads,
-                  'assignment_path': self.assignment_path, 'assignment_key': self.assignment_key}
+                  'assignment_path': self.assignment_path, 'assignment_key': self.assignment_key,
+                  'assignment_cache_size': cache_size, 'max_dense_assignments': max_dense}
         if self.offset_path != '':
             config.update({'offset_path': self.offset_path})
         # we only add output path and key if we do not write in place
@@ -88,7 +104,10 @@ class WriteBase(luigi.Task):
 
         # get block list and jobs
         if self.n_retries == 0:
-            block_list = vu.blocks_in_volume(shape, block_shape, roi_begin, roi_end)
+            # empty blocks are not written, unless we have offsets
+            occupancy = (self.input_path, self.input_key) if self.offset_path == '' else None
+            block_list = vu.blocks_in_volume(shape, block_shape, roi_begin, roi_end,
+                                             occupancy=occupancy)
         else:
             block_list = self.block_list
             self.clean_up_for_retry(block_list, self.identifier)
@@ -133,24 +152,27 @@ class WriteLSF(WriteBase, LSFTask):
 
 
 def _write_block_with_offsets(ds_in, ds_out, blocking, block_id,
-                              node_labels, offsets):
+                              node_labels, offsets, config):
     fu.log("start processing block %i" % block_id)
-    off = offsets[block_id]
-    block = blocking.getBlock(block_id)
-    bb = vu.block_to_bb(block)
-    seg = ds_in[bb]
-    seg[seg != 0] += off
-    # choose the appropriate function for array or dictionary
-    if isinstance(node_labels, np.ndarray):
-        seg = nt.take(node_labels, seg)
-    else:
-        seg = nt.takeDict(node_labels, seg)
-    ds_out[bb] = seg
-    fu.log_block_success(block_id)
+    with fu.instrument_block(config, block_id) as stats:
+        off = offsets[block_id]
+        block = blocking.getBlock(block_id)
+        bb = vu.block_to_bb(block)
+        seg = stats.read(ds_in, bb)
+        new_seg = _apply_assignments_with_offset(node_labels, seg, off)
+        # the assignments don't change this block
+        if new_seg is None:
+            # if we write in-place, we are done
+            if ds_in is ds_out:
+                fu.log_block_success(block_id)
+                return
+            new_seg = seg
+        stats.write(ds_out, bb, new_seg)
+        fu.log_block_success(block_id)
 
 
 def _write_with_offsets(ds_in, ds_out, blocking, block_list,
-                        n_threads, node_labels, offset_path):
+                        n_threads, node_labels, offset_path, config):
 
     fu.log("loading offsets from %s" % offset_path)
     with open(offset_path) as f:
@@ -160,71 +182,235 @@ def _write_with_offsets(ds_in, ds_out, blocking, block_list,
 
     with futures.ThreadPoolExecutor(n_threads) as tp:
         tasks = [tp.submit(_write_block_with_offsets, ds_in, ds_out,
-                           blocking, block_id, node_labels, offsets)
+                           blocking, block_id, node_labels, offsets, config)
                  for block_id in block_list if block_id not in empty_blocks]
         [t.result() for t in tasks]
 
 
-def _write_block(ds_in, ds_out, blocking, block_id, node_labels):
+def _write_block(ds_in, ds_out, blocking, block_id, node_labels, config):
     fu.log("start processing block %i" % block_id)
-    block = blocking.getBlock(block_id)
-    bb = vu.block_to_bb(block)
-    seg = ds_in[bb]
-    # check if this block is empty and don't write if it is
-    if np.sum(seg != 0) == 0:
+    with fu.instrument_block(config, block_id) as stats:
+        block = blocking.getBlock(block_id)
+        bb = vu.block_to_bb(block)
+        seg = stats.read(ds_in, bb)
+        # check if this block is empty and don't write if it is
+        if np.sum(seg != 0) == 0:
+            fu.log_block_success(block_id)
+            return
+
+        seg = _apply_assignments(node_labels, seg)
+        stats.write(ds_out, bb, seg)
         fu.log_block_success(block_id)
-        return
-
-    # choose the appropriate function for array or dictionary
-    if isinstance(node_labels, np.ndarray):
-        # this should actually amount to the same as
-        # seg = node_labels[seg]
-        seg = nt.take(node_labels, seg)
-    else:
-        # this copys the dict and hence is extremely RAM hungry
-        # so we make the dict as small as possible
-        this_labels = nt.unique(seg)
-        this_assignment = {label: node_labels[label] for label in this_labels}
-        seg = nt.takeDict(this_assignment, seg)
-
-    ds_out[bb] = seg
-    fu.log_block_success(block_id)
 
 
 def _write(ds_in, ds_out, blocking, block_list,
-           n_threads, node_labels):
+           n_threads, node_labels, config):
     with futures.ThreadPoolExecutor(n_threads) as tp:
         tasks = [tp.submit(_write_block, ds_in, ds_out,
-                           blocking, block_id, node_labels)
+                           blocking, block_id, node_labels, config)
                  for block_id in block_list]
         [t.result() for t in tasks]
 
 
-def _load_assignments(path, key, n_threads):
+def _lookup(keys, values, labels):
+    # look up the values for labels in sorted keys
+    if len(keys) == 0:
+        assert len(labels) == 0, "Labels are missing in the assignments"
+        return values[:0]
+    index = np.searchsorted(keys, labels)
+    index[index == len(keys)] = 0
+    assert (keys[index] == labels).all(), "Labels are missing in the assignments"
+    return values[index]
+
+
+class LazyAssignments(object):
+    """ Read the assignments of the labels in a block from a chunked n5 / zarr dataset.
+
+    The dataset is either a dense assignment vector or a sparse assignment table
+    (n_labels x 2) sorted by its keys. Only the chunks that contain the labels of a block
+    are read, and the last `cache_size` chunks are kept in a cache that is shared
+    by all threads of a job.
+    """
+    def __init__(self, path, key, cache_size=64):
+        self.path = path
+        self.key = key
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+        with vu.file_reader(path, 'r') as f:
+            ds = f[key]
+            assert ds.ndim in (1, 2)
+            self.shape = ds.shape
+            self.chunk_len = ds.chunks[0]
+            self.sparse = ds.ndim == 2
+            # the first key of each chunk of a sparse table, written by `FindLabeling`
+            first_keys = ds.attrs.get('chunkFirstKeys', None) if self.sparse else None
+        self.n_chunks = int(np.ceil(self.shape[0] / self.chunk_len))
+
+        if self.sparse:
+            self.first_keys = self._scan_first_keys() if first_keys is None else\
+                np.array(first_keys, dtype='uint64')
+
+    def _scan_first_keys(self):
+        # read the keys chunk by chunk to find the first keys and check that they are sorted
+        first_keys = np.zeros(self.n_chunks, dtype='uint64')
+        last_key = None
+        with vu.file_reader(self.path, 'r') as f:
+            ds = f[self.key]
+            for chunk_id in range(self.n_chunks):
+                keys = ds[chunk_id * self.chunk_len:(chunk_id + 1) * self.chunk_len, 0]
+                sorted_ = (keys[1:] >= keys[:-1]).all() and (last_key is None or keys[0] >= last_key)
+                if not sorted_:
+                    raise ValueError("Assignment table %s:%s is not sorted" % (self.path, self.key))
+                first_keys[chunk_id] = keys[0]
+                last_key = keys[-1]
+        return first_keys
+
+    def _read_chunk(self, chunk_id):
+        with self._lock:
+            if chunk_id in self._cache:
+                self._cache.move_to_end(chunk_id)
+                return self._cache[chunk_id]
+        with vu.file_reader(self.path, 'r') as f:
+            chunk = f[self.key][chunk_id * self.chunk_len:(chunk_id + 1) * self.chunk_len]
+        with self._lock:
+            self._cache[chunk_id] = chunk
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return chunk
+
+    def __getitem__(self, labels):
+        """ Get the assignments for sorted labels.
+        """
+        # int64 and uint64 are promoted to float64, so we need to convert signed labels
+        labels = labels.astype('uint64', copy=False)
+        if self.sparse:
+            assert labels[0] >= self.first_keys[0], "Labels are missing in the assignments"
+            chunk_ids = np.searchsorted(self.first_keys, labels, side='right') - 1
+        else:
+            assert labels[-1] < self.shape[0], "Labels are missing in the assignments"
+            chunk_ids = labels // np.uint64(self.chunk_len)
+
+        values = np.zeros(len(labels), dtype='uint64')
+        for chunk_id in np.unique(chunk_ids):
+            chunk = self._read_chunk(int(chunk_id))
+            this_labels = chunk_ids == chunk_id
+            if self.sparse:
+                values[this_labels] = _lookup(chunk[:, 0], chunk[:, 1], labels[this_labels])
+            else:
+                values[this_labels] = chunk[labels[this_labels] - np.uint64(chunk_id * self.chunk_len)]
+        return values
+
+    def max_id(self):
+        # stream over the chunks, bypassing the cache
+        max_id = 0
+        with vu.file_reader(self.path, 'r') as f:
+            ds = f[self.key]
+            for chunk_id in range(self.n_chunks):
+                chunk = ds[chunk_id * self.chunk_len:(chunk_id + 1) * self.chunk_len]
+                max_id = max(max_id, int((chunk[:, 1] if self.sparse else chunk).max()))
+        return max_id
+
+
+def _apply_assignments(node_labels, seg):
+    # dense assignments: this should actually amount to the same as
+    # seg = node_labels[seg]
+    if isinstance(node_labels, np.ndarray):
+        return nt.take(node_labels, seg)
+
+    # sparse or lazy assignments: look up the ids of this block
+    this_labels, inverse = np.unique(seg, return_inverse=True)
+    if isinstance(node_labels, LazyAssignments):
+        this_values = node_labels[this_labels]
+    else:
+        keys, values = node_labels
+        this_values = _lookup(keys, values, this_labels)
+    return this_values[inverse].reshape(seg.shape)
+
+
+def _apply_assignments_with_offset(node_labels, seg, offset):
+    """ Map the ids of a block, offset for non-zero ids, through the assignments.
+
+    Returns None if the mapping does not change the block.
+    """
+    # dense assignments: cut out the look-up table for the (offset) ids of this block,
+    # so offset and look-up are a single pass without temporaries of the block size
+    if isinstance(node_labels, np.ndarray):
+        max_id = int(seg.max())
+        assert offset + max_id < len(node_labels), "Labels are missing in the assignments"
+        lut = node_labels[offset:offset + max_id + 1].copy()
+        lut[0] = node_labels[0]
+        if (lut == np.arange(max_id + 1, dtype=lut.dtype)).all():
+            return None
+        return nt.take(lut, seg)
+
+    # sparse or lazy assignments: offset and look up the unique ids of this block
+    this_labels, inverse = np.unique(seg, return_inverse=True)
+    shifted = this_labels.astype('uint64')
+    shifted[shifted != 0] += np.uint64(offset)
+    if isinstance(node_labels, LazyAssignments):
+        this_values = node_labels[shifted]
+    else:
+        keys, values = node_labels
+        this_values = _lookup(keys, values, shifted)
+    if (this_values == this_labels).all():
+        return None
+    return this_values[inverse].reshape(seg.shape)
+
+
+def _load_assignments(path, key, n_threads, cache_size=64, max_dense=int(1e8)):
+    """ Load the node assignments.
+
+    Assignment tables and dense assignment vectors with more than `max_dense` entries
+    in n5 / zarr are read lazily, see `LazyAssignments`. Otherwise, dense assignment
+    vectors are returned as array, sparse assignments (pickled dict or assignment table)
+    as sorted keys and values.
+    """
     # if we have no key, this is a pickle file
     if key is None:
         assert os.path.split(path)[1].split('.')[-1] == 'pkl'
         with open(path, 'rb') as f:
             node_labels = pickle.load(f)
         assert isinstance(node_labels, dict)
+        keys = np.fromiter(node_labels.keys(), dtype='uint64', count=len(node_labels))
+        values = np.fromiter(node_labels.values(), dtype='uint64', count=len(node_labels))
     else:
+        lazy = False
+        if path.split('.')[-1].lower() in ('n5', 'zr', 'zarr'):
+            with vu.file_reader(path, 'r') as f:
+                ds = f[key]
+                lazy = ds.ndim == 2 or ds.shape[0] > max_dense
+        if lazy:
+            try:
+                return LazyAssignments(path, key, cache_size)
+            except ValueError:
+                fu.log("assignment table is not sorted, loading it into memory")
         with vu.file_reader(path, 'r') as f:
             ds = f[key]
             assert ds.ndim in (1, 2)
             ds.n_threads = n_threads
             node_labels = ds[:]
-            # if we have 2d node_labels, these correspond to an assignment table
-            # and we turn them into a dict for efficient downstream processing
-            if node_labels.ndim == 2:
-                node_labels = dict(zip(node_labels[:, 0], node_labels[:, 1]))
-    return node_labels
+        if node_labels.ndim == 1:
+            return node_labels
+        # if we have 2d node_labels, these correspond to an assignment table
+        keys = np.ascontiguousarray(node_labels[:, 0])
+        values = np.ascontiguousarray(node_labels[:, 1])
+
+    # sort the keys for the look-up, tables written by `FindLabeling` are sorted already
+    if not (keys[1:] >= keys[:-1]).all():
+        order = np.argsort(keys)
+        keys, values = keys[order], values[order]
+    return keys, values
 
 
 def _write_maxlabel(output_path, output_key, node_labels):
     if isinstance(node_labels, np.ndarray):
         max_id = int(node_labels.max())
-    elif isinstance(node_labels, dict):
-        max_id = int(np.max(list(node_labels.values())))
+    elif isinstance(node_labels, tuple):
+        max_id = int(node_labels[1].max())
+    elif isinstance(node_labels, LazyAssignments):
+        max_id = node_labels.max_id()
     else:
         raise AttributeError("Invalide type %s" % type(node_labels))
     with vu.file_reader(output_path) as f:
@@ -257,7 +443,9 @@ def write(job_id, config_path):
     assignment_path = config['assignment_path']
     assignment_key = config.get('assignment_key', None)
     fu.log("loading node labels from %s" % assignment_path)
-    node_labels = _load_assignments(assignment_path, assignment_key, n_threads)
+    node_labels = _load_assignments(assignment_path, assignment_key, n_threads,
+                                    config.get('assignment_cache_size', 64),
+                                    config.get('max_dense_assignments', int(1e8)))
 
     offset_path = config.get('offset_path', None)
 
@@ -271,10 +459,10 @@ def write(job_id, config_path):
             blocking = nt.blocking([0, 0, 0], list(shape), list(block_shape))
 
             if offset_path is None:
-                _write(ds_in, ds_out, blocking, block_list, n_threads, node_labels)
+                _write(ds_in, ds_out, blocking, block_list, n_threads, node_labels, config)
             else:
                 _write_with_offsets(ds_in, ds_out, blocking, block_list,
-                                    n_threads, node_labels, offset_path)
+                                    n_threads, node_labels, offset_path, config)
         # write the max-label
         # for job 0
         if job_id == 0:
@@ -293,10 +481,10 @@ def write(job_id, config_path):
                 blocking = nt.blocking([0, 0, 0], list(shape), list(block_shape))
 
                 if offset_path is None:
-                    _write(ds_in, ds_out, blocking, block_list, n_threads, node_labels)
+                    _write(ds_in, ds_out, blocking, block_list, n_threads, node_labels, config)
                 else:
                     _write_with_offsets(ds_in, ds_out, blocking, block_list,
-                                        n_threads, node_labels, offset_path)
+                                        n_threads, node_labels, offset_path, config)
         else:
             with vu.file_reader(input_path, 'r') as f_in, vu.file_reader(output_path) as f_out:
                 ds_in = f_in[input_key]
@@ -306,10 +494,10 @@ def write(job_id, config_path):
                 blocking = nt.blocking([0, 0, 0], list(shape), list(block_shape))
 
                 if offset_path is None:
-                    _write(ds_in, ds_out, blocking, block_list, n_threads, node_labels)
+                    _write(ds_in, ds_out, blocking, block_list, n_threads, node_labels, config)
                 else:
                     _write_with_offsets(ds_in, ds_out, blocking, block_list,
-                                        n_threads, node_labels, offset_path)
+                                        n_threads, node_labels, offset_path, config)
         # write the max-label
         # for job 0
         if job_id == 0:
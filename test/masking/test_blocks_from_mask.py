@@ -0,0 +1,102 @@
+import os
+import sys
+import json
+import unittest
+import numpy as np
+from shutil import rmtree
+
+import luigi
+import z5py
+
+try:
+    from cluster_tools.masking import BlocksFromMaskWorkflow
+    from cluster_tools.masking.blocks_from_mask import BlocksFromMaskLocal
+except ImportError:
+    sys.path.append('../..')
+    from cluster_tools.masking import BlocksFromMaskWorkflow
+    from cluster_tools.masking.blocks_from_mask import BlocksFromMaskLocal
+
+
+class TestBlocksFromMask(unittest.TestCase):
+    mask_path = './tmp/mask.n5'
+    mask_key = 'mask'
+    tmp_folder = './tmp'
+    output_path = './tmp/block_list.json'
+    config_folder = './tmp/configs'
+    target = 'local'
+    shape = (40, 400, 400)
+    block_shape = (10, 100, 100)
+
+    @staticmethod
+    def _mkdir(dir_):
+        try:
+            os.mkdir(dir_)
+        except OSError:
+            pass
+
+    def setUp(self):
+        self._mkdir(self.tmp_folder)
+        self._mkdir(self.config_folder)
+        global_config = BlocksFromMaskLocal.default_global_config()
+        global_config['shebang'] = '#! /g/kreshuk/pape/Work/software/conda/miniconda3/envs/cluster_env/bin/python'
+        global_config['block_shape'] = list(self.block_shape)
+        with open(os.path.join(self.config_folder, 'global.config'), 'w') as f:
+            json.dump(global_config, f)
+
+    def tearDown(self):
+        try:
+            rmtree(self.tmp_folder)
+        except OSError:
+            pass
+
+    def _make_mask(self, mask_shape):
+        mask = np.zeros(mask_shape, dtype='uint8')
+        mask[:mask_shape[0] // 2, :mask_shape[1] // 3, :] = 1
+        with z5py.File(self.mask_path) as f:
+            f.create_dataset(self.mask_key, data=mask,
+                             chunks=tuple(max(sh // 4, 1) for sh in mask_shape))
+        return mask
+
+    def _check_result(self, mask):
+        with open(self.output_path) as f:
+            block_list = json.load(f)
+        self.assertGreater(len(block_list), 0)
+
+        # all blocks intersecting with the (upsampled) mask must be in the block list
+        scale = [sh // msh for sh, msh in zip(self.shape, mask.shape)]
+        full_mask = mask
+        for axis, sc in enumerate(scale):
+            full_mask = np.repeat(full_mask, sc, axis=axis)
+        blocks_per_axis = [sh // bs for sh, bs in zip(self.shape, self.block_shape)]
+        expected = []
+        for block_id in range(int(np.prod(blocks_per_axis))):
+            pos = np.unravel_index(block_id, blocks_per_axis)
+            bb = tuple(slice(p * bs, (p + 1) * bs) for p, bs in zip(pos, self.block_shape))
+            if full_mask[bb].any():
+                expected.append(block_id)
+        self.assertTrue(np.in1d(expected, block_list).all())
+        # and we don't get too many blocks
+        self.assertLess(len(block_list), np.prod(blocks_per_axis))
+
+    def _run(self):
+        task = BlocksFromMaskWorkflow(tmp_folder=self.tmp_folder,
+                                      config_dir=self.config_folder,
+                                      target=self.target, max_jobs=4,
+                                      mask_path=self.mask_path, mask_key=self.mask_key,
+                                      shape=self.shape, output_path=self.output_path)
+        ret = luigi.build([task], local_scheduler=True)
+        self.assertTrue(ret)
+
+    def test_blocks_from_mask(self):
+        mask = self._make_mask(self.shape)
+        self._run()
+        self._check_result(mask)
+
+    def test_blocks_from_downsampled_mask(self):
+        mask = self._make_mask((10, 100, 100))
+        self._run()
+        self._check_result(mask)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import os
+import sys
+import json
+import unittest
+from functools import partial
+from shutil import rmtree
+from unittest import mock
+
+import luigi
+import z5py
+
+try:
+    from cluster_tools.multicut.multicut_workflow import MulticutHierarchy
+except ImportError:
+    sys.path.append('../..')
+    from cluster_tools.multicut.multicut_workflow import MulticutHierarchy
+
+
+class ReduceProblemMock(luigi.Task):
+    """ Writes the graph size of the next scale, reduced by the given fraction of nodes.
+    """
+    tmp_folder = luigi.Parameter()
+    problem_path = luigi.Parameter()
+    scale = luigi.IntParameter()
+    reduction = luigi.FloatParameter()
+    dependency = luigi.TaskParameter()
+
+    def requires(self):
+        return self.dependency
+
+    def run(self):
+        with z5py.File(self.problem_path) as f:
+            attrs = f['s%i/graph' % self.scale].attrs
+            n_nodes, n_edges = attrs['numberOfNodes'], attrs['numberOfEdges']
+            attrs = f.require_group('s%i/graph' % (self.scale + 1)).attrs
+            attrs['numberOfNodes'] = int(n_nodes * (1. - self.reduction))
+            attrs['numberOfEdges'] = int(n_edges * (1. - self.reduction))
+        with self.output().open('w') as f:
+            f.write('reduced scale %i' % self.scale)
+
+    def output(self):
+        return luigi.LocalTarget(os.path.join(self.tmp_folder,
+                                              'reduce_problem_s%i.log' % self.scale))
+
+
+def _hierarchical_tasks(reductions, wf, dependency, n_scales, first_scale=0):
+    dep = dependency
+    for scale in range(first_scale, n_scales):
+        dep = ReduceProblemMock(tmp_folder=wf.tmp_folder, problem_path=wf.problem_path,
+                                scale=scale, reduction=reductions[scale], dependency=dep)
+    return dep
+
+
+class TestMulticutHierarchy(unittest.TestCase):
+    tmp_folder = './tmp'
+    problem_path = './tmp/problem.n5'
+    config_folder = './tmp/configs'
+    target = 'local'
+
+    @staticmethod
+    def _mkdir(dir_):
+        try:
+            os.mkdir(dir_)
+        except OSError:
+            pass
+
+    def setUp(self):
+        self._mkdir(self.tmp_folder)
+        self._mkdir(self.config_folder)
+        with z5py.File(self.problem_path) as f:
+            attrs = f.require_group('s0/graph').attrs
+            attrs['numberOfNodes'] = 1000
+            attrs['numberOfEdges'] = 5000
+
+    def tearDown(self):
+        try:
+            rmtree(self.tmp_folder)
+        except OSError:
+            pass
+
+    def _run_hierarchy(self, reductions, **kwargs):
+        task = MulticutHierarchy(tmp_folder=self.tmp_folder, config_dir=self.config_folder,
+                                 max_jobs=1, target=self.target,
+                                 problem_path=self.problem_path, **kwargs)
+        with mock.patch('cluster_tools.multicut.multicut_workflow._hierarchical_tasks',
+                        partial(_hierarchical_tasks, reductions)):
+            ret = luigi.build([task], local_scheduler=True)
+        self.assertTrue(ret)
+        with task.output().open('r') as f:
+            return json.load(f)
+
+    def test_budget(self):
+        # 1000 -> 500 -> 250 -> 125 nodes
+        res = self._run_hierarchy([.5] * 6, max_scales=6, max_nodes=200)
+        self.assertEqual(res['n_scales'], 3)
+        self.assertEqual(res['numberOfNodes'], 125)
+
+    def test_edge_budget(self):
+        # 5000 -> 2500 -> 1250 edges
+        res = self._run_hierarchy([.5] * 6, max_scales=6, max_edges=2000)
+        self.assertEqual(res['n_scales'], 2)
+        self.assertEqual(res['numberOfEdges'], 1250)
+
+    def test_min_reduction(self):
+        # the third level reduces the problem by less than min_reduction
+        res = self._run_hierarchy([.5, .5, .05, .5, .5, .5], max_scales=6, min_reduction=.1)
+        self.assertEqual(res['n_scales'], 3)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_folder,
+                                                     'reduce_problem_s3.log')))
+
+    def test_max_scales(self):
+        res = self._run_hierarchy([.5] * 6, max_scales=2, max_nodes=10)
+        self.assertEqual(res['n_scales'], 2)
+
+    def test_fits_budget(self):
+        # we need at least one level, even if the initial problem is small enough
+        res = self._run_hierarchy([.5] * 6, max_scales=6, max_nodes=2000)
+        self.assertEqual(res['n_scales'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
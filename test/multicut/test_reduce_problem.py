@@ -0,0 +1,199 @@
+import os
+import sys
+import unittest
+import numpy as np
+from shutil import rmtree
+
+import z5py
+import nifty.tools as nt
+import nifty.ufd as nufd
+
+try:
+    import cluster_tools.multicut.reduce_problem as rp
+except ImportError:
+    sys.path.append('../..')
+    import cluster_tools.multicut.reduce_problem as rp
+
+
+class TestReduceProblem(unittest.TestCase):
+    tmp_folder = './tmp'
+    problem_path = './tmp/problem.n5'
+    n_jobs = 3
+    chunk_size = 25
+
+    @staticmethod
+    def _mkdir(dir_):
+        try:
+            os.mkdir(dir_)
+        except OSError:
+            pass
+
+    def setUp(self):
+        self._mkdir(self.tmp_folder)
+
+    def tearDown(self):
+        try:
+            rmtree(self.tmp_folder)
+        except OSError:
+            pass
+
+    @staticmethod
+    def toy_problem(nodes, n_edges, seed):
+        np.random.seed(seed)
+        uv_ids = set()
+        while len(uv_ids) < n_edges:
+            u, v = sorted(np.random.choice(nodes, 2, replace=False))
+            uv_ids.add((int(u), int(v)))
+        uv_ids = np.array(sorted(uv_ids), dtype='uint64')
+        costs = np.random.rand(len(uv_ids)).astype('float32')
+        cut_edges = np.random.rand(len(uv_ids)) < .6
+        return uv_ids, costs, cut_edges
+
+    def _write_problem(self, nodes, uv_ids, costs):
+        with z5py.File(self.problem_path) as f:
+            g = f.require_group('s0/graph')
+            g.attrs['numberOfNodes'] = len(nodes)
+            g.attrs['numberOfEdges'] = len(uv_ids)
+            ds = g.require_dataset('nodes', shape=nodes.shape, chunks=(100,), dtype='uint64')
+            ds[:] = nodes
+            ds = g.require_dataset('edges', shape=uv_ids.shape, chunks=(self.chunk_size, 2),
+                                   dtype='uint64')
+            ds[:] = uv_ids
+            ds = f.require_dataset('s0/costs', shape=costs.shape, chunks=(self.chunk_size,),
+                                   dtype='float32')
+            ds[:] = costs
+
+    def _edge_ranges(self, n_edges, chunk_size):
+        chunk_ids = np.arange((n_edges + chunk_size - 1) // chunk_size)
+        return [rp._edge_range(list(chunk_list), n_edges, chunk_size)
+                for chunk_list in np.array_split(chunk_ids, self.n_jobs)]
+
+    # run the steps of the reduce_problem jobs one after another
+    def _reduce_problem(self, uv_ids, cut_edges, method):
+        scale, tmp = 0, self.tmp_folder
+        n_edges = len(uv_ids)
+        cut_edge_ids = np.where(cut_edges)[0].astype('uint64')
+        for job_id in range(self.n_jobs):
+            np.save(rp._tmp_path(tmp, scale, 'cut_edges_job', job_id),
+                    cut_edge_ids[job_id::self.n_jobs])
+        edge_ranges = self._edge_ranges(n_edges, self.chunk_size)
+
+        for job_id, (begin, end) in enumerate(edge_ranges):
+            np.save(rp._tmp_path(tmp, scale, 'merge_job', job_id),
+                    rp._merge_nodes(self.problem_path, scale, tmp, self.n_jobs, begin, end))
+        node_labeling = rp._find_node_labeling(self.problem_path, scale, tmp, self.n_jobs, 1)
+        np.save(rp._tmp_path(tmp, scale, 'node_labeling'), node_labeling)
+        n_new_nodes = int(node_labeling.max()) + 1
+
+        np.lib.format.open_memmap(rp._tmp_path(tmp, scale, 'edge_keys'), mode='w+',
+                                  dtype='uint64', shape=(n_edges,))
+        for job_id, (begin, end) in enumerate(edge_ranges):
+            keys, values = rp._map_edges(self.problem_path, scale, tmp, n_new_nodes,
+                                         method, begin, end)
+            np.save(rp._tmp_path(tmp, scale, 'keys_job', job_id), keys)
+            np.save(rp._tmp_path(tmp, scale, 'values_job', job_id), values)
+
+        splits = rp._find_splits([rp._tmp_path(tmp, scale, 'keys_job', job_id)
+                                  for job_id in range(self.n_jobs)], 4, 20)
+        for range_id in range(len(splits) + 1):
+            rp._merge_edge_range(tmp, scale, self.n_jobs, splits, range_id, method)
+        offsets = np.cumsum([0] + [len(np.load(rp._tmp_path(tmp, scale, 'keys_range', range_id)))
+                                   for range_id in range(len(splits) + 1)]).tolist()
+        n_new_edges = offsets[-1]
+
+        with z5py.File(self.problem_path) as f:
+            f.require_dataset('s1/graph/edges', shape=(n_new_edges, 2), chunks=(10, 2),
+                              dtype='uint64')
+            f.require_dataset('s1/costs', shape=(n_new_edges,), chunks=(10,), dtype='float32')
+        for begin, end in self._edge_ranges(n_new_edges, 10):
+            rp._write_edges(self.problem_path, scale, tmp, offsets, n_new_nodes, method,
+                            begin, end)
+
+        np.lib.format.open_memmap(rp._tmp_path(tmp, scale, 'edge_labeling'), mode='w+',
+                                  dtype='int64', shape=(n_edges,))
+        for begin, end in edge_ranges:
+            rp._write_edge_labeling(tmp, scale, splits, offsets, begin, end)
+
+        with z5py.File(self.problem_path) as f:
+            new_uv_ids = f['s1/graph/edges'][:]
+            new_costs = f['s1/costs'][:]
+        edge_labeling = np.load(rp._tmp_path(tmp, scale, 'edge_labeling'))
+        return node_labeling, new_uv_ids, new_costs, edge_labeling
+
+    # the reduction with ufd and nifty edge mapping for the whole graph
+    @staticmethod
+    def _reduce_reference(nodes, uv_ids, costs, cut_edges, method):
+        ufd = nufd.boost_ufd(nodes)
+        ufd.merge(uv_ids[np.logical_not(cut_edges)])
+        _, node_labeling = np.unique(ufd.find(nodes), return_inverse=True)
+        node_labeling = nt.inflateLabeling(nodes, node_labeling.astype('uint64'),
+                                           int(nodes.max()))
+        mapping = nt.EdgeMapping(uv_ids, node_labeling, numberOfThreads=1)
+        new_uv_ids = mapping.newUvIds()
+        new_costs = mapping.mapEdgeValues(costs, method, numberOfThreads=1)
+        return node_labeling, new_uv_ids, new_costs, mapping.edgeMapping()
+
+    def _check_reduction(self, nodes, uv_ids, costs, cut_edges, ignore_label):
+        self._write_problem(nodes, uv_ids, costs)
+        for method in ('sum', 'mean', 'min', 'max'):
+            labeling, new_uv_ids, new_costs, edge_labeling = self._reduce_problem(uv_ids,
+                                                                                 cut_edges,
+                                                                                 method)
+            (labeling_exp, new_uv_ids_exp,
+             new_costs_exp, edge_labeling_exp) = self._reduce_reference(nodes, uv_ids, costs,
+                                                                        cut_edges, method)
+
+            # the labelings must be the same partition of the nodes
+            self.assertEqual(len(labeling), len(labeling_exp))
+            labels, labels_exp = labeling[nodes], labeling_exp[nodes]
+            n_new_nodes = len(np.unique(labels))
+            self.assertEqual(n_new_nodes, len(np.unique(labels_exp)))
+            self.assertEqual(len(set(zip(labels.tolist(), labels_exp.tolist()))), n_new_nodes)
+            self.assertTrue(np.array_equal(np.unique(labels), np.arange(n_new_nodes)))
+            if ignore_label:
+                self.assertEqual(labels[0], 0)
+
+            # map the expected edges to our node labels
+            to_labels = np.zeros(n_new_nodes, dtype='uint64')
+            to_labels[labels_exp] = labels
+            new_uv_ids_exp = np.sort(to_labels[new_uv_ids_exp], axis=1)
+            order = np.lexsort((new_uv_ids_exp[:, 1], new_uv_ids_exp[:, 0]))
+            self.assertTrue(np.array_equal(new_uv_ids, new_uv_ids_exp[order]))
+            self.assertTrue(np.allclose(new_costs, new_costs_exp[order], rtol=1e-5))
+
+            to_edges = np.zeros(len(order), dtype='int64')
+            to_edges[order] = np.arange(len(order))
+            merged = labeling[uv_ids[:, 0]] == labeling[uv_ids[:, 1]]
+            self.assertTrue((edge_labeling[merged] == -1).all())
+            valid = np.logical_not(merged)
+            self.assertTrue(np.array_equal(edge_labeling[valid],
+                                           to_edges[edge_labeling_exp[valid]]))
+
+    def test_ignore_label(self):
+        nodes = np.arange(200, dtype='uint64')
+        uv_ids, costs, cut_edges = self.toy_problem(nodes, 600, seed=0)
+        # edges to the ignore label are always cut
+        cut_edges[uv_ids[:, 0] == 0] = True
+        self._check_reduction(nodes, uv_ids, costs, cut_edges, ignore_label=True)
+
+    def test_non_consecutive_nodes(self):
+        np.random.seed(1)
+        nodes = np.unique(np.random.choice(np.arange(1, 500), 200,
+                                           replace=False)).astype('uint64')
+        uv_ids, costs, cut_edges = self.toy_problem(nodes, 600, seed=1)
+        self._check_reduction(nodes, uv_ids, costs, cut_edges, ignore_label=False)
+
+    def test_accumulate(self):
+        keys = np.array([5, 1, 5, 3, 1, 5], dtype='uint64')
+        values = np.ones((len(keys), 2), dtype='float64')
+        values[:, 0] = [1., 2., 3., 4., 5., 6.]
+        for method, expected in (('sum', [7., 4., 10.]), ('min', [2., 4., 1.]),
+                                 ('max', [5., 4., 6.])):
+            new_keys, new_values = rp._accumulate(keys, values, method)
+            self.assertTrue(np.array_equal(new_keys, [1, 3, 5]))
+            self.assertTrue(np.array_equal(new_values[:, 0], expected))
+            self.assertTrue(np.array_equal(new_values[:, 1], [2, 1, 3]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import os
+import sys
+import json
+import stat
+import unittest
+import numpy as np
+from shutil import rmtree
+
+import luigi
+import z5py
+
+from failing_task import FailingTaskSlurm
+
+
+# fake sbatch: run the tasks of an array job in the background
+# and mark each task as done when it exits
+SBATCH = """#!/bin/bash
+counter=$FAKE_SLURM_DIR/counter
+array_id=$(( $(cat $counter 2>/dev/null || echo 1000) + 1 ))
+echo $array_id > $counter
+out=/dev/null
+while [ $# -gt 0 ]; do
+    case $1 in
+        -o) out=$2; shift 2;;
+        -J) shift 2;;
+        --array=*) array=${1#--array=}; shift;;
+        --export=*) export ${1#--export=ALL,}; shift;;
+        --*) shift;;
+        *) break;;
+    esac
+done
+array=${array%\\%*}
+last=${array#*-}
+echo $last > $FAKE_SLURM_DIR/$array_id.last
+for index in $(seq 0 $last); do
+    (SLURM_ARRAY_TASK_ID=$index bash $1 > $out 2>&1; touch $FAKE_SLURM_DIR/${array_id}_$index.done) &
+done
+echo $array_id
+"""
+
+# fake squeue: list the requested array tasks that are not done yet
+SQUEUE = """#!/bin/bash
+while [ $# -gt 0 ]; do
+    case $1 in
+        -j) array_ids=$2; shift 2;;
+        -o) shift 2;;
+        *) shift;;
+    esac
+done
+for array_id in ${array_ids//,/ }; do
+    for index in $(seq 0 $(cat $FAKE_SLURM_DIR/$array_id.last)); do
+        if [ ! -f $FAKE_SLURM_DIR/${array_id}_$index.done ]; then
+            echo ${array_id}_$index
+        fi
+    done
+done
+"""
+
+
+class TestJobTracking(unittest.TestCase):
+    output_path = './tmp/out.n5'
+    output_key = 'data'
+    tmp_folder = './tmp'
+    config_folder = './tmp/configs'
+    shim_folder = './tmp/bin'
+    slurm_folder = './tmp/slurm'
+    shape = (100, 1024, 1024)
+
+    @staticmethod
+    def _mkdir(dir_):
+        try:
+            os.mkdir(dir_)
+        except OSError:
+            pass
+
+    def _write_shim(self, name, content):
+        path = os.path.join(self.shim_folder, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+    def setUp(self):
+        for folder in (self.tmp_folder, self.config_folder,
+                       self.shim_folder, self.slurm_folder):
+            self._mkdir(folder)
+        self._write_shim('sbatch', SBATCH)
+        self._write_shim('squeue', SQUEUE)
+        self.old_path = os.environ['PATH']
+        os.environ['PATH'] = os.path.abspath(self.shim_folder) + os.pathsep + self.old_path
+        os.environ['FAKE_SLURM_DIR'] = os.path.abspath(self.slurm_folder)
+
+        global_config = FailingTaskSlurm.default_global_config()
+        global_config['shebang'] = '#! %s' % sys.executable
+        global_config['block_shape'] = [10, 256, 256]
+        global_config['max_num_retries'] = 1
+        global_config['min_poll_interval'] = 0.1
+        global_config['max_poll_interval'] = 1
+        # split the jobs into several array jobs
+        global_config['max_array_size'] = 3
+        with open(os.path.join(self.config_folder, 'global.config'), 'w') as f:
+            json.dump(global_config, f)
+
+    def tearDown(self):
+        os.environ['PATH'] = self.old_path
+        try:
+            rmtree(self.tmp_folder)
+        except OSError:
+            pass
+
+    def test_slurm_tracking(self):
+        max_jobs = 8
+        task = FailingTaskSlurm(output_path=self.output_path, output_key=self.output_key,
+                                shape=self.shape,
+                                config_dir=self.config_folder,
+                                tmp_folder=self.tmp_folder,
+                                max_jobs=max_jobs)
+        ret = luigi.build([task], local_scheduler=True)
+        self.assertTrue(ret)
+        with z5py.File(self.output_path) as f:
+            data = f[self.output_key][:]
+        self.assertTrue(np.allclose(data, 1))
+
+        # the failed jobs of the first try must have been reported by the tracker
+        with open(task.output().path) as f:
+            log = f.read()
+        self.assertIn('submitted %i jobs with scheduler ids' % max_jobs, log)
+        self.assertIn('jobs failed', log)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -25,16 +25,20 @@ class TestRetry(unittest.TestCase):
         except OSError:
             pass
 
-    def setUp(self):
-        self._mkdir(self.tmp_folder)
-        self._mkdir(self.config_folder)
+    def _write_global_config(self, local_executor='subprocess'):
         global_config = FailingTaskLocal.default_global_config()
         global_config['shebang'] = '#! /home/cpape/Work/software/conda/miniconda3/envs/affogato/bin/python'
         global_config['block_shape'] = [10, 256, 256]
         global_config['max_num_retries'] = 1
+        global_config['local_executor'] = local_executor
         with open(os.path.join(self.config_folder, 'global.config'), 'w') as f:
             json.dump(global_config, f)
 
+    def setUp(self):
+        self._mkdir(self.tmp_folder)
+        self._mkdir(self.config_folder)
+        self._write_global_config()
+
     def tearDown(self):
         try:
             rmtree(self.tmp_folder)
@@ -53,6 +57,19 @@ class TestRetry(unittest.TestCase):
             data = f[self.output_key][:]
         self.assertTrue(np.allclose(data, 1))
 
+    def test_retry_in_process(self):
+        self._write_global_config('in_process')
+        max_jobs = 32
+        ret = luigi.build([FailingTaskLocal(output_path=self.output_path, output_key=self.output_key,
+                                            shape=self.shape,
+                                            config_dir=self.config_folder,
+                                            tmp_folder=self.tmp_folder,
+                                            max_jobs=max_jobs)], local_scheduler=True)
+        self.assertTrue(ret)
+        with z5py.File(self.output_path) as f:
+            data = f[self.output_key][:]
+        self.assertTrue(np.allclose(data, 1))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -43,6 +43,115 @@ class TestFunctionUtils(unittest.TestCase):
         for li, lo in zip(lines[1:], out_lines):
             self.assertEqual(li, lo)
 
+    def test_map_blocks(self):
+        import time
+        import threading
+        from cluster_tools.utils.function_utils import map_blocks
+        n_threads = 4
+        lock = threading.Lock()
+        state = {'running': 0, 'max_running': 0, 'pulled': 0}
+        processed = []
+
+        def block_ids():
+            for block_id in range(20):
+                # blocks are only pulled when a thread is free
+                with lock:
+                    self.assertLessEqual(state['pulled'] - len(processed), n_threads)
+                    state['pulled'] += 1
+                yield block_id
+
+        def process(block_id):
+            with lock:
+                state['running'] += 1
+                state['max_running'] = max(state['running'], state['max_running'])
+            time.sleep(0.01)
+            with lock:
+                state['running'] -= 1
+                processed.append(block_id)
+
+        map_blocks(process, block_ids(), n_threads)
+        self.assertEqual(sorted(processed), list(range(20)))
+        self.assertLessEqual(state['max_running'], n_threads)
+
+        # errors in a block are raised
+        def fail(block_id):
+            if block_id == 3:
+                raise RuntimeError()
+        with self.assertRaises(RuntimeError):
+            map_blocks(fail, range(10), n_threads)
+
+    def test_instrument_block(self):
+        import numpy as np
+        from cluster_tools.utils.function_utils import instrument_block
+        from cluster_tools.utils.parse_utils import (parse_instrumentation_task,
+                                                     summarize_instrumentation)
+        path = os.path.join(self.tmp_dir, 'task_0.jsonl')
+        config = {'instrumentation_path': path}
+        ds_in = np.random.rand(10, 10, 10)
+        ds_out = np.zeros_like(ds_in)
+        bb = np.s_[:5, :5, :5]
+
+        block_list = list(range(4))
+        for block_id in block_list:
+            with instrument_block(config, block_id) as stats:
+                data = stats.read(ds_in, bb)
+                stats.write(ds_out, bb, data)
+        self.assertTrue(np.allclose(ds_out[bb], ds_in[bb]))
+
+        # a failed block is not recorded
+        with self.assertRaises(RuntimeError):
+            with instrument_block(config, 4) as stats:
+                raise RuntimeError()
+
+        records = parse_instrumentation_task(os.path.join(self.tmp_dir, 'task_'), 2)
+        self.assertEqual([rec['block_id'] for rec in records], block_list)
+        for rec in records:
+            self.assertEqual(rec['bytes_read'], data.nbytes)
+            self.assertEqual(rec['bytes_written'], data.nbytes)
+            self.assertGreater(rec['peak_rss'], 0)
+
+        summary = summarize_instrumentation(records)
+        self.assertEqual(summary['n_blocks'], len(block_list))
+        self.assertEqual(summary['bytes_read'], len(block_list) * data.nbytes)
+        self.assertIn(summary['bound'], ('io', 'cpu'))
+
+    def test_pipeline_blocks(self):
+        import numpy as np
+        from cluster_tools.utils.function_utils import pipeline_blocks
+        from cluster_tools.utils.parse_utils import parse_instrumentation_task
+        path = os.path.join(self.tmp_dir, 'task_0.jsonl')
+        config = {'instrumentation_path': path}
+        ds_in = np.random.rand(20, 10, 10)
+        ds_out = np.zeros_like(ds_in)
+
+        def _bb(block_id):
+            return np.s_[block_id:block_id + 1]
+
+        def read(block_id, stats):
+            return stats.read(ds_in, _bb(block_id))
+
+        def compute(block_id, data):
+            # odd blocks have nothing to write
+            return None if block_id % 2 else 2 * data
+
+        def write(block_id, data, stats):
+            stats.write(ds_out, _bb(block_id), data)
+
+        block_list = list(range(20))
+        pipeline_blocks(block_list, read, compute, write, config, n_threads=4)
+        self.assertTrue(np.allclose(ds_out[::2], 2 * ds_in[::2]))
+        self.assertTrue((ds_out[1::2] == 0).all())
+
+        records = parse_instrumentation_task(os.path.join(self.tmp_dir, 'task_'), 2)
+        self.assertEqual(sorted(rec['block_id'] for rec in records), block_list)
+
+        # errors in a block are raised
+        def fail(block_id, data):
+            if block_id == 3:
+                raise RuntimeError()
+        with self.assertRaises(RuntimeError):
+            pipeline_blocks(block_list, read, fail, write, {}, n_threads=4)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,168 @@
+import os
+import sys
+import unittest
+import numpy as np
+from shutil import rmtree
+
+import z5py
+import nifty.tools as nt
+import nifty.ufd as nufd
+import nifty.distributed as ndist
+
+try:
+    import cluster_tools.utils.graph_utils as gu
+except ImportError:
+    sys.path.append('../..')
+    import cluster_tools.utils.graph_utils as gu
+import cluster_tools.multicut.reduce_problem as rp
+
+
+class TestGraphUtils(unittest.TestCase):
+    tmp_folder = './tmp'
+    input_path = './tmp/data.n5'
+    input_key = 'labels'
+    problem_path = './tmp/problem.n5'
+    shape = (32, 32, 32)
+    block_shape = [8, 8, 8]
+    n_scales = 2
+
+    @staticmethod
+    def _mkdir(dir_):
+        try:
+            os.mkdir(dir_)
+        except OSError:
+            pass
+
+    def setUp(self):
+        self._mkdir(self.tmp_folder)
+
+    def tearDown(self):
+        try:
+            rmtree(self.tmp_folder)
+        except OSError:
+            pass
+
+    # fragments of size 3, which are not aligned with the blocks
+    def _write_labels(self, ignore_label):
+        grid = np.meshgrid(*[np.arange(sh) // 3 for sh in self.shape], indexing='ij')
+        n_cells = [(sh + 2) // 3 for sh in self.shape]
+        labels = np.ravel_multi_index(grid, n_cells).astype('uint64') + 1
+        if ignore_label:
+            labels[:, :, :4] = 0
+        with z5py.File(self.input_path) as f:
+            ds = f.create_dataset(self.input_key, shape=self.shape, chunks=tuple(self.block_shape),
+                                  dtype='uint64')
+            ds[:] = labels
+
+    def _compute_graph(self, ignore_label):
+        with z5py.File(self.problem_path) as f:
+            f.attrs['shape'] = list(self.shape)
+        blocking = nt.blocking([0, 0, 0], list(self.shape), self.block_shape)
+        block_list = list(range(blocking.numberOfBlocks))
+        for block_id in block_list:
+            block = blocking.getBlock(block_id)
+            block_key = 's0/sub_graphs/block_%i' % block_id
+            ndist.computeMergeableRegionGraph(self.input_path, self.input_key,
+                                              block.begin, block.end,
+                                              self.problem_path, block_key,
+                                              ignore_label, increaseRoi=True)
+        ndist.mergeSubgraphs(self.problem_path, blockPrefix='s0/sub_graphs/block_',
+                             blockIds=block_list, outKey='s0/graph', numberOfThreads=1)
+        with z5py.File(self.problem_path) as f:
+            f['s0/graph'].attrs['ignoreLabel'] = ignore_label
+
+        gu.require_sub_problems(self.problem_path, 0, self.block_shape)
+        gu.serialize_sub_problems(self.problem_path, 0, self.block_shape, block_list)
+
+    def _load_sub_problems(self, scale, blocking):
+        with z5py.File(self.problem_path) as f:
+            group = f['s%i/sub_problems' % scale]
+            return [gu.load_sub_problem(group, blocking, block_id)
+                    for block_id in range(blocking.numberOfBlocks)]
+
+    # reduce the problem at scale like 'reduce_problem', cutting all outer edges
+    # of the blocks and a random subset of the inner edges
+    def _reduce_problem(self, scale, blocking):
+        with z5py.File(self.problem_path) as f:
+            group = f['s%i/graph' % scale]
+            uv_ids = group['edges'][:]
+            nodes = group['nodes'][:] if scale == 0 else\
+                np.arange(group.attrs['numberOfNodes'], dtype='uint64')
+            ignore_label = group.attrs['ignoreLabel']
+
+        cut_edges = np.zeros(len(uv_ids), dtype='bool')
+        for _, inner_edges, outer_edges, _ in self._load_sub_problems(scale, blocking):
+            cut_edges[outer_edges] = True
+            cut_edges[inner_edges[np.random.rand(len(inner_edges)) < .5]] = True
+
+        ufd = nufd.boost_ufd(nodes)
+        ufd.merge(uv_ids[np.logical_not(cut_edges)])
+        # label consecutively and map the first node (the ignore label, if we have it) to 0
+        _, labels = np.unique(ufd.find(nodes), return_inverse=True)
+        first_label = labels[0]
+        is_first = labels == first_label
+        labels[labels < first_label] += 1
+        labels[is_first] = 0
+        node_labeling = np.zeros(int(nodes.max()) + 1, dtype='uint64')
+        node_labeling[nodes] = labels
+
+        new_uv_ids = np.sort(node_labeling[uv_ids], axis=1)
+        valid = new_uv_ids[:, 0] != new_uv_ids[:, 1]
+        new_uv_ids, edge_labels = np.unique(new_uv_ids[valid], axis=0, return_inverse=True)
+        edge_labeling = np.full(len(uv_ids), -1, dtype='int64')
+        edge_labeling[valid] = edge_labels.ravel()
+        np.save(rp._tmp_path(self.tmp_folder, scale, 'node_labeling'), node_labeling)
+        np.save(rp._tmp_path(self.tmp_folder, scale, 'edge_labeling'), edge_labeling)
+
+        with z5py.File(self.problem_path) as f:
+            group = f.require_group('s%i/graph' % (scale + 1))
+            group.attrs['ignoreLabel'] = ignore_label
+            group.attrs['numberOfNodes'] = int(labels.max()) + 1
+            group.attrs['numberOfEdges'] = len(new_uv_ids)
+            ds = group.create_dataset('edges', shape=new_uv_ids.shape, chunks=(16, 2),
+                                      dtype='uint64')
+            ds[:] = new_uv_ids
+
+    def _check_merged_sub_problems(self, ignore_label):
+        np.random.seed(0)
+        self._write_labels(ignore_label)
+        self._compute_graph(ignore_label)
+
+        for scale in range(self.n_scales):
+            block_shape = [bs * 2**scale for bs in self.block_shape]
+            blocking = nt.blocking([0, 0, 0], list(self.shape), block_shape)
+            new_block_shape = [2 * bs for bs in block_shape]
+            new_blocking = nt.blocking([0, 0, 0], list(self.shape), new_block_shape)
+            block_list = list(range(new_blocking.numberOfBlocks))
+            self._reduce_problem(scale, blocking)
+
+            # serializes the sub-graphs and the sub-problems from the sub-problems at scale
+            gu.require_sub_problems(self.problem_path, scale + 1, new_block_shape)
+            rp._serialize_sub_graphs(self.problem_path, scale, self.tmp_folder, list(self.shape),
+                                     self.block_shape, block_list, 1)
+            sub_problems = self._load_sub_problems(scale + 1, new_blocking)
+
+            # extract the sub-problems from the reduced graph
+            gu.require_sub_problems(self.problem_path, scale + 1, new_block_shape)
+            gu.serialize_sub_problems(self.problem_path, scale + 1, new_block_shape, block_list)
+            expected_sub_problems = self._load_sub_problems(scale + 1, new_blocking)
+
+            self.assertTrue(any(len(sub_problem[1]) > 0 for sub_problem in sub_problems))
+            for sub_problem, expected in zip(sub_problems, expected_sub_problems):
+                nodes, inner_edges, outer_edges, sub_uvs = sub_problem
+                nodes_exp, inner_edges_exp, outer_edges_exp, sub_uvs_exp = expected
+                self.assertTrue(np.array_equal(nodes, nodes_exp))
+                self.assertTrue(np.array_equal(np.sort(outer_edges), np.sort(outer_edges_exp)))
+                order, order_exp = np.argsort(inner_edges), np.argsort(inner_edges_exp)
+                self.assertTrue(np.array_equal(inner_edges[order], inner_edges_exp[order_exp]))
+                self.assertTrue(np.array_equal(sub_uvs[order], sub_uvs_exp[order_exp]))
+
+    def test_merged_sub_problems(self):
+        self._check_merged_sub_problems(ignore_label=False)
+
+    def test_merged_sub_problems_ignore_label(self):
+        self._check_merged_sub_problems(ignore_label=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
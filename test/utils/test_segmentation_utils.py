@@ -89,6 +89,33 @@ class TestSegmentationUtil(unittest.TestCase):
         energy = self._check_result(graph, costs, node_labels)
         print("decomposition:", energy)
 
+    def test_mc_fusion_moves(self):
+        from cluster_tools.utils.segmentation_utils import key_to_agglomerator
+        graph, costs = self.load_problem(self.path)
+        for key in ('fusion-moves', 'fusion-moves-greedy'):
+            agglomerator = key_to_agglomerator(key, n_iterations=50)
+            node_labels = agglomerator(graph, costs, n_threads=4)
+            energy = self._check_result(graph, costs, node_labels)
+            print("%s:" % key, energy)
+
+    def test_warm_start(self):
+        from cluster_tools.utils.segmentation_utils import key_to_agglomerator
+        from cluster_tools.utils.segmentation_utils import multicut_gaec
+        graph, costs = self.toy_problem()
+        costs = costs.astype('float64')
+        obj = nmc.multicutObjective(graph, costs)
+        # start from the greedy solution and from the singleton labeling
+        initial_labels = [multicut_gaec(graph, costs),
+                          np.arange(graph.numberOfNodes, dtype='uint64')]
+        for node_labels in initial_labels:
+            initial_energy = obj.evalNodeLabels(node_labels)
+            for key in ('kernighan-lin', 'fusion-moves', 'fusion-moves-greedy'):
+                kwargs = {} if key == 'kernighan-lin' else {'n_iterations': 10}
+                agglomerator = key_to_agglomerator(key, **kwargs)
+                res = agglomerator(graph, costs, n_threads=1, node_labels=node_labels)
+                self.assertEqual(graph.numberOfNodes, len(res))
+                self.assertLessEqual(obj.evalNodeLabels(res), initial_energy)
+
     def test_decompose_toy(self):
         from cluster_tools.utils.segmentation_utils import multicut_decomposition
         from cluster_tools.utils.segmentation_utils import multicut_kernighan_lin
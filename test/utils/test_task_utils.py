@@ -0,0 +1,96 @@
+import sys
+import unittest
+
+import numpy as np
+
+try:
+    import cluster_tools
+except ImportError:
+    sys.path.append('../..')
+    import cluster_tools
+
+
+class TestTaskUtils(unittest.TestCase):
+
+    def _check_partition(self, partition, block_list, n_jobs):
+        self.assertEqual(len(partition), n_jobs)
+        blocks = [block_id for blocks in partition for block_id in blocks]
+        self.assertEqual(sorted(blocks), sorted(block_list))
+
+    def test_partition_blocks_by_cost(self):
+        from cluster_tools.utils.task_utils import partition_blocks_by_cost
+        n_blocks = 1000
+        n_jobs = 16
+        block_list = list(range(n_blocks))
+        # few expensive blocks, many cheap ones
+        costs = np.random.exponential(1., size=n_blocks) ** 3
+        block_costs = dict(zip(block_list, costs))
+
+        partition = partition_blocks_by_cost(block_list, block_costs, n_jobs,
+                                             min_cost_fraction=0)
+        self._check_partition(partition, block_list, n_jobs)
+
+        job_costs = [sum(block_costs[block_id] for block_id in blocks)
+                     for blocks in partition]
+        round_robin_costs = [sum(block_costs[block_id] for block_id in block_list[job_id::n_jobs])
+                             for job_id in range(n_jobs)]
+        # the LPT makespan is at most 4 / 3 of the optimum, which
+        # is bounded by the mean job cost and the max block cost
+        lower_bound = max(np.mean(job_costs), costs.max())
+        self.assertLessEqual(max(job_costs), 4. / 3 * lower_bound)
+        self.assertLessEqual(max(job_costs), max(round_robin_costs))
+
+    def test_partition_blocks_by_cost_consecutive(self):
+        from cluster_tools.utils.task_utils import partition_blocks_by_cost
+        n_blocks = 100
+        n_jobs = 8
+        block_list = list(range(n_blocks))
+        # the first half of the blocks is much more expensive
+        block_costs = {block_id: 10. if block_id < 50 else 1. for block_id in block_list}
+
+        partition = partition_blocks_by_cost(block_list, block_costs, n_jobs,
+                                             consecutive=True)
+        self._check_partition(partition, block_list, n_jobs)
+        for blocks in partition:
+            self.assertGreater(len(blocks), 0)
+            self.assertEqual(blocks, list(range(blocks[0], blocks[-1] + 1)))
+        # jobs in the expensive half get fewer blocks
+        self.assertLess(len(partition[0]), len(partition[-1]))
+
+    def test_missing_costs(self):
+        from cluster_tools.utils.task_utils import partition_blocks_by_cost
+        block_list = list(range(20))
+        partition = partition_blocks_by_cost(block_list, {0: 5.}, 4)
+        self._check_partition(partition, block_list, 4)
+
+    def test_zero_costs(self):
+        from cluster_tools.utils.task_utils import partition_blocks_by_cost
+        block_list = list(range(10))
+        block_costs = {block_id: 0. for block_id in block_list}
+        for consecutive in (False, True):
+            for min_cost_fraction in (0.01, 0.):
+                partition = partition_blocks_by_cost(block_list, block_costs, 3,
+                                                     consecutive=consecutive,
+                                                     min_cost_fraction=min_cost_fraction)
+                self._check_partition(partition, block_list, 3)
+                self.assertEqual(sorted(len(blocks) for blocks in partition), [3, 3, 4])
+
+    def test_ties(self):
+        from cluster_tools.utils.task_utils import partition_blocks_by_cost
+        block_list = list(range(12))
+        # the cheap blocks cost nothing, they should still be spread over the jobs
+        block_costs = {block_id: 1. if block_id < 3 else 0. for block_id in block_list}
+        partition = partition_blocks_by_cost(block_list, block_costs, 3,
+                                             min_cost_fraction=0)
+        self._check_partition(partition, block_list, 3)
+        self.assertEqual([len(blocks) for blocks in partition], [4, 4, 4])
+
+    def test_empty_block_list(self):
+        from cluster_tools.utils.task_utils import partition_blocks_by_cost
+        for consecutive in (False, True):
+            partition = partition_blocks_by_cost([], {}, 4, consecutive=consecutive)
+            self._check_partition(partition, [], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
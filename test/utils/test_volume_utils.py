@@ -51,6 +51,73 @@ class TestVolumeUtil(unittest.TestCase):
         with file_reader(path) as f:
             _test_io(f)
 
+    def test_block_io(self):
+        from cluster_tools.utils.volume_utils import file_reader, read_block, write_block
+        path = os.path.join(self.tmp_dir, 'a.n5')
+        shape = (40, 40, 45)
+        chunks = (10, 10, 10)
+        data = np.random.randint(0, 100, size=shape).astype('uint64')
+        data[:20, :20, :20] = 0
+        with file_reader(path) as f:
+            ds = f.create_dataset('data', shape=shape, chunks=chunks, dtype='uint64')
+            # aligned blocks, a non-aligned block and a block with boundary chunks
+            bbs = [np.s_[:20, :20, :20], np.s_[20:40, :20, :20], np.s_[:10, 20:30, 30:40],
+                   np.s_[5:15, 20:40, 20:40], np.s_[10:40, 20:40, :20], np.s_[:40, :40, 20:45]]
+            for bb in bbs:
+                write_block(ds, bb, data[bb])
+                out = read_block(ds, bb)
+                self.assertEqual(out.shape, data[bb].shape)
+                self.assertTrue(np.array_equal(out, data[bb]))
+            self.assertTrue(np.array_equal(ds[:], data))
+            # empty chunks are not written
+            self.assertFalse(ds.chunk_exists((0, 0, 0)))
+
+            # unchanged chunks are not written
+            digests = {}
+            bb = np.s_[20:40, 20:40, 20:40]
+            block = read_block(ds, bb, digests)
+            block[:10] += 1
+            write_block(ds, bb, block, digests)
+            self.assertTrue(np.array_equal(ds[bb], block))
+
+    def test_occupied_blocks(self):
+        from cluster_tools.utils.volume_utils import file_reader, blocks_in_volume
+        path = os.path.join(self.tmp_dir, 'a.n5')
+        shape = (40, 40, 40)
+        chunks = (10, 10, 10)
+        with file_reader(path) as f:
+            ds = f.create_dataset('data', shape=shape, chunks=chunks, dtype='uint8')
+            ds[5:15, 5:15, 5:15] = 1
+
+        # only the chunks overlapping with the data exist
+        block_list = blocks_in_volume(shape, (20, 20, 20), occupancy=(path, 'data'))
+        self.assertEqual(block_list, [0])
+        # the occupancy can be checked at a different scale and with a halo
+        block_list = blocks_in_volume((20, 20, 20), (5, 5, 5), occupancy=(path, 'data'))
+        self.assertEqual(block_list, [0, 1, 4, 5, 16, 17, 20, 21])
+        block_list = blocks_in_volume(shape, (20, 20, 20), occupancy=(path, 'data'),
+                                      occupancy_halo=(10, 10, 10))
+        self.assertEqual(block_list, list(range(8)))
+
+    def test_apply_size_filter(self):
+        from cluster_tools.utils.volume_utils import apply_size_filter
+        shape = (32, 32, 32)
+        hmap = np.random.rand(*shape).astype('float32')
+        size_filter = 100
+        exclude = [1, 2]
+        # dense and sparse label ids
+        for factor in (1, 10**6):
+            seg = np.random.randint(1, 400, size=shape).astype('uint32') * factor
+            seg[:4] = factor
+            seg[-4:] = 2 * factor
+            exclude_ids = [ex * factor for ex in exclude]
+            out, max_id = apply_size_filter(seg.copy(), hmap, size_filter, exclude=exclude_ids)
+            ids, sizes = np.unique(out, return_counts=True)
+            self.assertNotIn(0, ids)
+            self.assertEqual(int(max_id), int(ids.max()))
+            self.assertTrue(np.in1d(exclude_ids, ids).all())
+            self.assertTrue((sizes[~np.in1d(ids, exclude_ids)] >= size_filter).all())
+
     def test_interpol_volume(self):
         from cluster_tools.utils.volume_utils import InterpolatedVolume
         big_shape = (100, 1000, 1000)
@@ -66,6 +133,24 @@ class TestVolumeUtil(unittest.TestCase):
             self.assertEqual(out.shape, oshape)
             self.assertFalse((out == 0).all())
 
+    def test_interpol_volume_nearest(self):
+        from cluster_tools.utils.volume_utils import InterpolatedVolume
+        small_shape = (10, 32, 30)
+        big_shape = (100, 128, 75)
+        vol = np.random.randint(0, 1000, size=small_shape).astype('uint64')
+        vol[:5] = 0
+        index = [np.arange(bsh) * ssh // bsh for ssh, bsh in zip(small_shape, big_shape)]
+        expected = vol[np.ix_(*index)]
+
+        ivol = InterpolatedVolume(vol, big_shape)
+        ivol_cached = InterpolatedVolume(vol, big_shape, cache_size=8, tile_shape=(4, 8, 8))
+        bbs = [np.s_[:], np.s_[50:75, 10:60, 30:75], np.s_[5:45, 99:128, :7], np.s_[:10, 3:4]]
+        for bb in bbs:
+            for iv in (ivol, ivol_cached):
+                out = iv[bb]
+                self.assertEqual(out.dtype, vol.dtype)
+                self.assertTrue(np.array_equal(out, expected[bb]))
+
 
 if __name__ == '__main__':
     unittest.main()
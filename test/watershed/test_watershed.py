@@ -70,6 +70,19 @@ class TestWatershed(unittest.TestCase):
         ids1 = np.unique(res_cc)
         self.assertEqual(len(ids0), len(ids1))
 
+    def _check_block_faces(self, axes=(1, 2)):
+        with z5py.File(self.output_path) as f:
+            res = f[self.output_key][:]
+        with open(os.path.join(self.config_folder, 'global.config')) as f:
+            block_shape = json.load(f)['block_shape']
+        # fragments that cross a block face must have the same id on both sides,
+        # so most voxels of a face have the same label as their neighbor across it
+        for axis in axes:
+            for face in range(block_shape[axis], res.shape[axis], block_shape[axis]):
+                labels_a = np.take(res, face - 1, axis=axis)
+                labels_b = np.take(res, face, axis=axis)
+                self.assertGreater(np.mean(labels_a == labels_b), .5)
+
     def _run_ws(self):
         max_jobs = 8
         task = WatershedWorkflow(input_path=self.input_path,
@@ -110,6 +123,36 @@ class TestWatershed(unittest.TestCase):
         self.assertTrue(ret)
         self._check_result()
 
+    def test_ws_two_pass_2d_slice_threads(self):
+        config = WatershedLocal.default_task_config()
+        config['two_pass'] = True
+        config['apply_presmooth_2d'] = True
+        config['apply_dt_2d'] = True
+        config['apply_ws_2d'] = True
+        config['threshold'] = 0.25
+        config['halo'] = [0, 15, 15]
+        config['slice_threads'] = 4
+        with open(os.path.join(self.config_folder, 'watershed.config'), 'w') as f:
+            json.dump(config, f)
+        ret = self._run_ws()
+        self.assertTrue(ret)
+        self._check_result()
+
+    def test_ws_consistent_seeds_2d(self):
+        config = WatershedLocal.default_task_config()
+        config['consistent_seeds'] = True
+        config['apply_presmooth_2d'] = True
+        config['apply_dt_2d'] = True
+        config['apply_ws_2d'] = True
+        config['threshold'] = 0.25
+        config['halo'] = [0, 15, 15]
+        with open(os.path.join(self.config_folder, 'watershed.config'), 'w') as f:
+            json.dump(config, f)
+        ret = self._run_ws()
+        self.assertTrue(ret)
+        self._check_result()
+        self._check_block_faces()
+
     def test_ws_3d(self):
         config = WatershedLocal.default_task_config()
         config['apply_presmooth_2d'] = False
@@ -138,6 +181,22 @@ class TestWatershed(unittest.TestCase):
         self.assertTrue(ret)
         self._check_result()
 
+    def test_ws_two_pass_threads(self):
+        config = WatershedLocal.default_task_config()
+        config['two_pass'] = True
+        config['apply_presmooth_2d'] = False
+        config['apply_dt_2d'] = False
+        config['apply_ws_2d'] = False
+        config['sigma_seeds'] = (.5, 2., 2.)
+        config['sigma_weights'] = (.5, 2., 2.)
+        config['halo'] = [5, 15, 15]
+        config['threads_per_job'] = 4
+        with open(os.path.join(self.config_folder, 'watershed.config'), 'w') as f:
+            json.dump(config, f)
+        ret = self._run_ws()
+        self.assertTrue(ret)
+        self._check_result()
+
     def test_ws_pixel_pitch(self):
         config = WatershedLocal.default_task_config()
         config['apply_presmooth_2d'] = False
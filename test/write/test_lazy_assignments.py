@@ -0,0 +1,73 @@
+import os
+import sys
+import unittest
+import numpy as np
+from shutil import rmtree
+
+import z5py
+
+try:
+    from cluster_tools.write.write import LazyAssignments, _apply_assignments_with_offset
+except ImportError:
+    sys.path.append('../..')
+    from cluster_tools.write.write import LazyAssignments, _apply_assignments_with_offset
+
+
+class TestLazyAssignments(unittest.TestCase):
+    tmp_folder = './tmp'
+    path = './tmp/assignments.n5'
+    n_labels = 1000
+
+    def setUp(self):
+        try:
+            os.mkdir(self.tmp_folder)
+        except OSError:
+            pass
+        np.random.seed(0)
+        self.assignments = np.random.randint(0, 100, size=self.n_labels).astype('uint64')
+        self.assignments[0] = 0
+        # sparse table with every third label
+        keys = np.arange(0, self.n_labels, 3, dtype='uint64')
+        self.table = np.concatenate([keys[:, None], self.assignments[keys][:, None]], axis=1)
+        with z5py.File(self.path) as f:
+            ds = f.create_dataset('dense', shape=self.assignments.shape, chunks=(64,),
+                                  dtype='uint64')
+            ds[:] = self.assignments
+            ds = f.create_dataset('sparse', shape=self.table.shape, chunks=(64, 2),
+                                  dtype='uint64')
+            ds[:] = self.table
+
+    def tearDown(self):
+        try:
+            rmtree(self.tmp_folder)
+        except OSError:
+            pass
+
+    def _check_lookup(self, key, labels):
+        assignments = LazyAssignments(self.path, key, cache_size=2)
+        for dtype in ('uint64', 'uint32', 'int64'):
+            values = assignments[labels.astype(dtype)]
+            self.assertEqual(values.dtype, np.dtype('uint64'))
+            self.assertTrue(np.array_equal(values, self.assignments[labels]))
+
+    def test_dense(self):
+        labels = np.unique(np.random.randint(0, self.n_labels, size=200))
+        self._check_lookup('dense', labels)
+
+    def test_sparse(self):
+        labels = np.unique(np.random.choice(self.table[:, 0], size=100))
+        self._check_lookup('sparse', labels)
+
+    def test_offset(self):
+        assignments = LazyAssignments(self.path, 'dense', cache_size=2)
+        offset = 100
+        seg = np.random.randint(0, self.n_labels - offset, size=(10, 10, 10))
+        expected = np.where(seg == 0, self.assignments[0],
+                            self.assignments[seg + offset])
+        for dtype in ('uint64', 'int64'):
+            res = _apply_assignments_with_offset(assignments, seg.astype(dtype), offset)
+            self.assertTrue(np.array_equal(res, expected))
+
+
+if __name__ == '__main__':
+    unittest.main()